@@ -1,28 +1,263 @@
-from flask import Flask, request, jsonify
+from flask import Blueprint, Flask, Response, current_app, request, jsonify, g, has_app_context, has_request_context, stream_with_context
+from flask.json.provider import DefaultJSONProvider
 from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy.pagination import Pagination
+from flask_sqlalchemy.session import Session as SessaoFlaskSQLAlchemy
 from flask_cors import CORS
 from flask_bcrypt import Bcrypt # Usado para hashing de senhas
-from flask_jwt_extended import JWTManager, create_access_token, jwt_required, get_jwt_identity # NOVO: Importações JWT
+from flask_jwt_extended import JWTManager, create_access_token, create_refresh_token, jwt_required, get_jwt, get_jwt_identity, verify_jwt_in_request # NOVO: Importações JWT
 from decimal import Decimal, InvalidOperation
 from datetime import datetime, timedelta # NOVO: Para tempo de expiração do JWT
 from dotenv import load_dotenv
 import os # Para chave secreta
-from sqlalchemy.orm import joinedload
+import click
+import logging
+import sys
+import csv
+import functools
+import hashlib
+import heapq
+import io
+import json
+import random
+import tempfile
+import threading
+import time
+import unicodedata
+from array import array
+from collections import Counter, OrderedDict, defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturoTimeoutError
+from contextlib import contextmanager
+from itsdangerous import BadData, BadSignature, URLSafeSerializer, URLSafeTimedSerializer
+from sqlalchemy import Select, and_, bindparam, case, event, insert, inspect as sa_inspect, or_, select, text, union_all, update
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import DataError, IntegrityError, OperationalError
+from sqlalchemy.orm import Session as SessionORM, joinedload
+from sqlalchemy.schema import CreateColumn
+from werkzeug.utils import secure_filename
+
+try:
+    import orjson # Opcional: codificação JSON mais rápida nas respostas
+except ImportError:
+    orjson = None
 
 load_dotenv()
 
-app = Flask(__name__)
-
-app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DB_CONNECTION_STRING')
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-
-# Ex: secrets.token_hex(32) em Python
-app.config["JWT_SECRET_KEY"] = os.environ.get("JWT_SECRET_KEY") 
-app.config["JWT_ACCESS_TOKEN_EXPIRES"] = timedelta(hours=1)
-db = SQLAlchemy(app)
-CORS(app)
-bcrypt = Bcrypt(app)
-jwt = JWTManager(app) # NOVO: Inicializar JWTManager
+logger = logging.getLogger('estoque')
+
+class ProvedorJSON(DefaultJSONProvider):
+    # Usa orjson quando disponível; tipos que ele não conhece (Decimal, datas) caem no default do Flask
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        if orjson is None or self._app.debug:
+            return super().response(*args, **kwargs)
+        corpo = orjson.dumps(obj, default=self.default, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME)
+        return self._app.response_class(corpo + b'\n', mimetype=self.mimetype)
+
+def configurar(app):
+    # Configuração lida do ambiente; create_app() aplica e depois sobrepõe com o dict recebido
+    app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DB_CONNECTION_STRING')
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+
+    # Pool de conexões: valores não definidos no ambiente ficam com o padrão do SQLAlchemy
+    opcoes_engine = {
+        'pool_pre_ping': os.environ.get('DB_POOL_PRE_PING', 'true').lower() == 'true', # Descarta conexões derrubadas pelo servidor
+        'pool_recycle': int(os.environ.get('DB_POOL_RECYCLE', 1800)), # Segundos; abaixo do wait_timeout do MySQL
+    }
+    for variavel, opcao in [('DB_POOL_SIZE', 'pool_size'), ('DB_MAX_OVERFLOW', 'max_overflow'), ('DB_POOL_TIMEOUT', 'pool_timeout')]:
+        if os.environ.get(variavel):
+            opcoes_engine[opcao] = int(os.environ[variavel])
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = opcoes_engine
+
+    # Réplicas de leitura: URLs separadas por vírgula, registradas como binds 'replica_0', 'replica_1', ...
+    replicas = [url.strip() for url in os.environ.get('DB_REPLICA_URLS', '').split(',') if url.strip()]
+    app.config['SQLALCHEMY_BINDS'] = {f'replica_{indice}': url for indice, url in enumerate(replicas)}
+    app.config['DB_REPLICAS'] = list(app.config['SQLALCHEMY_BINDS'])
+    # Após uma escrita, as leituras do mesmo usuário vão ao primário por este tempo (atraso máximo de replicação)
+    app.config['REPLICA_ATRASO_MAX_SEGUNDOS'] = float(os.environ.get('REPLICA_ATRASO_MAX_SEGUNDOS', 5))
+
+    # Ex: secrets.token_hex(32) em Python
+    app.config["JWT_SECRET_KEY"] = os.environ.get("JWT_SECRET_KEY") 
+    app.config["JWT_ACCESS_TOKEN_EXPIRES"] = timedelta(hours=1)
+    app.config["JWT_REFRESH_TOKEN_EXPIRES"] = timedelta(days=int(os.environ.get('JWT_REFRESH_DIAS', 7)))
+    # Cache da versão de token por usuário: quanto tempo uma revogação leva para valer em outros workers
+    app.config['USUARIO_CACHE_TTL_SEGUNDOS'] = int(os.environ.get('USUARIO_CACHE_TTL_SEGUNDOS', 60))
+
+    # Lançamento de movimentações em lote: linhas por transação e limite de linhas por requisição
+    app.config['MOVIMENTACOES_LOTE_CHUNK'] = int(os.environ.get('MOVIMENTACOES_LOTE_CHUNK', 500))
+    app.config['MOVIMENTACOES_LOTE_MAX_LINHAS'] = int(os.environ.get('MOVIMENTACOES_LOTE_MAX_LINHAS', 10000))
+
+    # Journal de movimentações (write-behind): arquivo append-only do processo (vazio desativa), máximo de
+    # movimentações por transação e espera (ms) para juntar mais movimentações antes de aplicar um grupo pequeno
+    app.config['MOVIMENTACOES_JOURNAL_ARQUIVO'] = os.environ.get('MOVIMENTACOES_JOURNAL_ARQUIVO', '')
+    app.config['MOVIMENTACOES_JOURNAL_GRUPO_MAX'] = int(os.environ.get('MOVIMENTACOES_JOURNAL_GRUPO_MAX', 500))
+    app.config['MOVIMENTACOES_JOURNAL_ESPERA_MS'] = float(os.environ.get('MOVIMENTACOES_JOURNAL_ESPERA_MS', 5))
+
+    # Arquivamento de movimentações (`flask arquivar-movimentacoes`): meses completos mantidos na tabela quente
+    # e linhas movidas por transação
+    app.config['ARQUIVO_MOVIMENTACOES_MESES'] = int(os.environ.get('ARQUIVO_MOVIMENTACOES_MESES', 12))
+    app.config['ARQUIVO_MOVIMENTACOES_LOTE'] = int(os.environ.get('ARQUIVO_MOVIMENTACOES_LOTE', 5000))
+
+    # Atualização concorrente de estoque: tentativas em deadlock/lock timeout e base do backoff (segundos)
+    app.config['ESTOQUE_MAX_TENTATIVAS'] = int(os.environ.get('ESTOQUE_MAX_TENTATIVAS', 5))
+    app.config['ESTOQUE_BACKOFF_BASE'] = float(os.environ.get('ESTOQUE_BACKOFF_BASE', 0.02))
+    # Consolidação de produtos.estoque_atual, resumo e agregados por período: pendências por transação, espera (ms)
+    # para juntar escritas num lote e intervalo (segundos) da varredura da thread; 0 desativa a thread
+    # (consolidar com `flask consolidar-estoque`)
+    app.config['ESTOQUE_CONSOLIDACAO_LOTE'] = int(os.environ.get('ESTOQUE_CONSOLIDACAO_LOTE', 500))
+    app.config['ESTOQUE_CONSOLIDACAO_ESPERA_MS'] = float(os.environ.get('ESTOQUE_CONSOLIDACAO_ESPERA_MS', 20))
+    app.config['ESTOQUE_CONSOLIDACAO_SEGUNDOS'] = float(os.environ.get('ESTOQUE_CONSOLIDACAO_SEGUNDOS', 1))
+
+    # Expõe o número de consultas SQL da requisição no cabeçalho X-Consultas-SQL
+    app.config['SQL_CONTAR_CONSULTAS'] = os.environ.get('SQL_CONTAR_CONSULTAS', 'false').lower() == 'true'
+
+    # Instrumentação: nível de log, limite de consulta lenta, token opcional de /metrics e intervalo do profiler
+    app.config['LOG_LEVEL'] = os.environ.get('LOG_LEVEL', 'INFO').upper()
+    app.config['SQL_LENTA_MS'] = float(os.environ.get('SQL_LENTA_MS', 200))
+    app.config['METRICAS_TOKEN'] = os.environ.get('METRICAS_TOKEN') # Se definido, /metrics exige "Authorization: Bearer <token>"
+    app.config['PROFILER_INTERVALO_MS'] = float(os.environ.get('PROFILER_INTERVALO_MS', 5))
+
+    # Paginação por cursor (?cursor=&limit=): limite máximo de itens por página
+    app.config['PAGINACAO_CURSOR_MAX_LIMIT'] = int(os.environ.get('PAGINACAO_CURSOR_MAX_LIMIT', 1000))
+
+    # Exportação em streaming: linhas lidas do banco por vez (yield_per) e linhas por bloco enviado
+    app.config['EXPORTACAO_YIELD_PER'] = int(os.environ.get('EXPORTACAO_YIELD_PER', 1000))
+    app.config['EXPORTACAO_LINHAS_POR_BLOCO'] = int(os.environ.get('EXPORTACAO_LINHAS_POR_BLOCO', 500))
+
+    # Intervalo (segundos) da reconciliação periódica do resumo do dashboard; 0 desativa
+    app.config['RESUMO_RECONCILIACAO_SEGUNDOS'] = int(os.environ.get('RESUMO_RECONCILIACAO_SEGUNDOS', 600))
+
+    # Razão de estoque em memória (saldo e mínimo por produto): relatório crítico, filtro stock_status e contagens
+    # do dashboard sem consultar a tabela; intervalo da verificação contra o banco (corrige escritas de outros
+    # workers) e máximo de ids enviados num IN antes de voltar ao filtro pela coluna indexada
+    app.config['RAZAO_ESTOQUE_ATIVA'] = os.environ.get('RAZAO_ESTOQUE_ATIVA', 'true').lower() == 'true'
+    app.config['RAZAO_ESTOQUE_VERIFICAR_SEGUNDOS'] = int(os.environ.get('RAZAO_ESTOQUE_VERIFICAR_SEGUNDOS', 300))
+    app.config['RAZAO_ESTOQUE_MAX_IDS_CONSULTA'] = int(os.environ.get('RAZAO_ESTOQUE_MAX_IDS_CONSULTA', 5000))
+
+    # Snapshots de estoque: intervalo entre checkpoints (0 desativa a thread) e margem para transações em andamento
+    app.config['ESTOQUE_SNAPSHOT_SEGUNDOS'] = int(os.environ.get('ESTOQUE_SNAPSHOT_SEGUNDOS', 86400))
+    app.config['ESTOQUE_SNAPSHOT_MARGEM_SEGUNDOS'] = int(os.environ.get('ESTOQUE_SNAPSHOT_MARGEM_SEGUNDOS', 60))
+
+    # Eventos de estoque (Server-Sent Events): 'memoria' atende um processo; 'redis' distribui entre workers
+    app.config['EVENTOS_BACKEND'] = os.environ.get('EVENTOS_BACKEND', 'memoria')
+    app.config['EVENTOS_REDIS_URL'] = os.environ.get('EVENTOS_REDIS_URL', os.environ.get('CACHE_REDIS_URL', 'redis://localhost:6379/0'))
+    app.config['EVENTOS_HISTORICO'] = int(os.environ.get('EVENTOS_HISTORICO', 1000)) # Eventos guardados para reconexão (Last-Event-ID)
+    app.config['EVENTOS_FILA_MAX'] = int(os.environ.get('EVENTOS_FILA_MAX', 1000)) # Fila por assinante antes de pedir resync
+    app.config['EVENTOS_KEEPALIVE_SEGUNDOS'] = int(os.environ.get('EVENTOS_KEEPALIVE_SEGUNDOS', 15))
+    # EventSource não envia cabeçalhos: o stream abre com um ticket curto (?ticket=), que só vale para ele
+    app.config['EVENTOS_TICKET_SEGUNDOS'] = int(os.environ.get('EVENTOS_TICKET_SEGUNDOS', 60))
+
+    # Busca: 'trigramas' (índice em memória, ranqueado, com prefixo e aproximação) ou 'ilike' (SQL direto)
+    app.config['BUSCA_BACKEND'] = os.environ.get('BUSCA_BACKEND', 'trigramas')
+    app.config['BUSCA_SIMILARIDADE_MINIMA'] = float(os.environ.get('BUSCA_SIMILARIDADE_MINIMA', 0.5))
+    # Resultados mais relevantes por busca: os ids vão literais no IN, que precisa de um tamanho limitado
+    app.config['BUSCA_MAX_RESULTADOS'] = int(os.environ.get('BUSCA_MAX_RESULTADOS', 1000))
+    # Recarga periódica do índice (segundos), para refletir escritas feitas por outros workers
+    app.config['BUSCA_RECARREGAR_SEGUNDOS'] = int(os.environ.get('BUSCA_RECARREGAR_SEGUNDOS', 300))
+
+    # Recálculo de impostos em lote: produtos por UPDATE em lote/commit
+    app.config['IMPOSTOS_LOTE_CHUNK'] = int(os.environ.get('IMPOSTOS_LOTE_CHUNK', 1000))
+
+    # Cache das entidades serializadas (GET por id): 'memoria' (LRU por processo) ou 'redis'
+    app.config['CACHE_BACKEND'] = os.environ.get('CACHE_BACKEND', 'memoria')
+    app.config['CACHE_TTL_SEGUNDOS'] = int(os.environ.get('CACHE_TTL_SEGUNDOS', 60))
+    app.config['CACHE_MAX_ITENS'] = int(os.environ.get('CACHE_MAX_ITENS', 10000))
+    app.config['CACHE_REDIS_URL'] = os.environ.get('CACHE_REDIS_URL', 'redis://localhost:6379/0')
+
+    # Idempotency-Key: 'memoria' (por processo) ou 'redis' (compartilhado entre workers); TTL das respostas guardadas,
+    # tempo máximo de uma requisição em andamento com a chave reservada e limite de chaves em memória
+    app.config['IDEMPOTENCIA_BACKEND'] = os.environ.get('IDEMPOTENCIA_BACKEND', app.config['CACHE_BACKEND'])
+    app.config['IDEMPOTENCIA_REDIS_URL'] = os.environ.get('IDEMPOTENCIA_REDIS_URL', app.config['CACHE_REDIS_URL'])
+    app.config['IDEMPOTENCIA_TTL_SEGUNDOS'] = int(os.environ.get('IDEMPOTENCIA_TTL_SEGUNDOS', 86400))
+    app.config['IDEMPOTENCIA_TRAVA_SEGUNDOS'] = int(os.environ.get('IDEMPOTENCIA_TRAVA_SEGUNDOS', 60))
+    app.config['IDEMPOTENCIA_MAX_CHAVES'] = int(os.environ.get('IDEMPOTENCIA_MAX_CHAVES', 100000))
+
+    # Autenticação: custo do bcrypt, pool dedicado (threads + fila máxima) e limites de falhas de login
+    app.config['BCRYPT_LOG_ROUNDS'] = int(os.environ.get('BCRYPT_LOG_ROUNDS', 12))
+    app.config['AUTH_MAX_WORKERS'] = int(os.environ.get('AUTH_MAX_WORKERS', 2))
+    app.config['AUTH_FILA_MAX'] = int(os.environ.get('AUTH_FILA_MAX', 16))
+    app.config['AUTH_TIMEOUT_SEGUNDOS'] = float(os.environ.get('AUTH_TIMEOUT_SEGUNDOS', 10))
+    app.config['LOGIN_JANELA_SEGUNDOS'] = int(os.environ.get('LOGIN_JANELA_SEGUNDOS', 300))
+    app.config['LOGIN_MAX_FALHAS_CONTA'] = int(os.environ.get('LOGIN_MAX_FALHAS_CONTA', 5))
+    app.config['LOGIN_MAX_FALHAS_IP'] = int(os.environ.get('LOGIN_MAX_FALHAS_IP', 30))
+
+    # Importação de catálogo (CSV/XLSX) em segundo plano
+    app.config['IMPORTACAO_DIR'] = os.environ.get('IMPORTACAO_DIR', os.path.join(tempfile.gettempdir(), 'importacoes'))
+    app.config['IMPORTACAO_MAX_WORKERS'] = int(os.environ.get('IMPORTACAO_MAX_WORKERS', 1))
+    app.config['IMPORTACAO_LOTE'] = int(os.environ.get('IMPORTACAO_LOTE', 500))
+    app.config['IMPORTACAO_MAX_ERROS'] = int(os.environ.get('IMPORTACAO_MAX_ERROS', 1000)) # Erros detalhados guardados por job
+
+# --- Roteamento de Leituras para Réplicas ---
+_ultima_escrita = {} # chave do usuário -> time.monotonic() do último commit com escrita
+_ultima_escrita_lock = threading.Lock()
+
+def _chave_leitura():
+    try:
+        identidade = get_jwt_identity()
+    except Exception:
+        identidade = None
+    return f'usuario:{identidade}' if identidade is not None else f'ip:{request.remote_addr}'
+
+def rota_leitura(funcao):
+    # Marca a rota como somente leitura: seus SELECTs podem ir para uma réplica
+    @functools.wraps(funcao)
+    def wrapper(*args, **kwargs):
+        g.rota_leitura = True
+        return funcao(*args, **kwargs)
+    return wrapper
+
+def _leitura_em_replica():
+    if not current_app.config['DB_REPLICAS'] or not has_request_context() or not g.get('rota_leitura'):
+        return False
+    if request.headers.get('X-Ler-Primario', '').lower() in ('1', 'true'):
+        return False
+    if 'ler_primario' not in g:
+        # Read-your-writes: quem acabou de escrever lê do primário até a réplica alcançar
+        with _ultima_escrita_lock:
+            ultima = _ultima_escrita.get(_chave_leitura())
+        g.ler_primario = ultima is not None and time.monotonic() - ultima < current_app.config['REPLICA_ATRASO_MAX_SEGUNDOS']
+    return not g.ler_primario
+
+class SessaoRoteada(SessaoFlaskSQLAlchemy):
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if isinstance(clause, Select) and clause._for_update_arg is not None:
+            self.info['escreveu'] = True # SELECT ... FOR UPDATE prepara uma escrita: o resto da transação fica no primário
+        if (
+            bind is None
+            and isinstance(clause, Select)
+            and not self._flushing
+            and not self.info.get('escreveu')
+            and _leitura_em_replica()
+        ):
+            if 'replica' not in g:
+                g.replica = random.choice(current_app.config['DB_REPLICAS']) # Uma réplica por requisição
+            return self._db.engines[g.replica]
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+db = SQLAlchemy(session_options={'class_': SessaoRoteada})
+
+@event.listens_for(SessaoRoteada, 'after_flush')
+def _marcar_escrita(session, flush_context):
+    session.info['escreveu'] = True
+
+@event.listens_for(SessaoRoteada, 'after_commit')
+def _registrar_escrita(session):
+    if session.info.pop('escreveu', False) and has_request_context():
+        g.ler_primario = True # O restante da requisição também enxerga a própria escrita
+        with _ultima_escrita_lock:
+            _ultima_escrita[_chave_leitura()] = time.monotonic()
+            if len(_ultima_escrita) > 10000:
+                limite = time.monotonic() - current_app.config['REPLICA_ATRASO_MAX_SEGUNDOS']
+                for chave in [chave for chave, instante in _ultima_escrita.items() if instante < limite]:
+                    del _ultima_escrita[chave]
+
+@event.listens_for(SessaoRoteada, 'after_rollback')
+def _descartar_escrita(session):
+    session.info.pop('escreveu', None)
+
+bcrypt = Bcrypt()
+jwt = JWTManager() # NOVO: Inicializar JWTManager
+api = Blueprint('api', __name__, cli_group=None) # Rotas e comandos; registrados em create_app()
 
 # --- Modelo de Dados do Produto ---
 class Produto(db.Model):
@@ -63,6 +298,15 @@ class Produto(db.Model):
     fornecedor_id = db.Column(db.Integer, db.ForeignKey('fornecedores.id'), nullable=True)
     fornecedor = db.relationship('Fornecedor', backref='produtos_fornecidos', lazy=True)
 
+    # Coluna gerada pelo banco: permite indexar o filtro de estoque baixo (estoque_atual <= estoque_minimo)
+    estoque_baixo = db.Column(db.Boolean, db.Computed('estoque_atual <= estoque_minimo'))
+
+    __table_args__ = (
+        db.Index('ix_produtos_fornecedor_id', 'fornecedor_id', 'id'),
+        db.Index('ix_produtos_estoque_baixo_nome', 'estoque_baixo', 'nome'),
+        db.Index('ix_produtos_estoque_atual_nome', 'estoque_atual', 'nome'),
+    )
+
 
     def __repr__(self):
         return f'<Produto {self.nome} - Código: {self.codigo}>'
@@ -109,6 +353,16 @@ class Movimentacao(db.Model):
     numero_nota_fiscal = db.Column(db.String(100), nullable=True) # Para entradas/saídas com NF
     cliente_id = db.Column(db.Integer, db.ForeignKey('clientes.id'), nullable=True) # Vinculo com cliente
     cliente = db.relationship('Cliente', backref='movimentacoes_saida', lazy=True)
+    deposito_id = db.Column(db.Integer, db.ForeignKey('depositos.id'), nullable=True) # Nulo: lançada antes dos depósitos
+
+    # Ordenação padrão (data_hora, id) e filtros por produto, cliente e tipo combinados com período
+    __table_args__ = (
+        db.Index('ix_movimentacoes_data_hora_id', 'data_hora', 'id'),
+        db.Index('ix_movimentacoes_produto_data_hora', 'produto_id', 'data_hora', 'id'),
+        db.Index('ix_movimentacoes_cliente_data_hora', 'cliente_id', 'data_hora', 'id'),
+        db.Index('ix_movimentacoes_tipo_data_hora', 'tipo_movimentacao', 'data_hora', 'id'),
+        db.Index('ix_movimentacoes_deposito_data_hora', 'deposito_id', 'data_hora', 'id'),
+    )
 
 
     def __repr__(self):
@@ -124,7 +378,8 @@ class Movimentacao(db.Model):
             'observacao': self.observacao,
             'numero_nota_fiscal': self.numero_nota_fiscal,
             'cliente_id': self.cliente_id,
-            'cliente_nome': self.cliente.nome if self.cliente else None
+            'cliente_nome': self.cliente.nome if self.cliente else None,
+            'deposito_id': self.deposito_id
         }
 
 # --- Modelo de Dados do Fornecedor ---
@@ -182,28 +437,660 @@ class User(db.Model):
     username = db.Column(db.String(80), unique=True, nullable=False)
     email = db.Column(db.String(120), unique=True, nullable=False)
     password_hash = db.Column(db.String(128), nullable=False)
-    
+    papel = db.Column(db.String(20), nullable=False, default='usuario', server_default='usuario') # 'usuario' ou 'admin'
+    token_versao = db.Column(db.Integer, nullable=False, default=0, server_default='0') # Incrementar revoga todos os tokens
+
     def __repr__(self):
         return f'<User {self.username}>'
 
     def set_password(self, password):
-        self.password_hash = bcrypt.generate_password_hash(password).decode('utf-8')
+        # O bcrypt roda no pool de autenticação, nunca direto na thread da requisição
+        rounds = current_app.config['BCRYPT_LOG_ROUNDS']
+        self.password_hash = executar_auth(bcrypt.generate_password_hash, password, rounds).decode('utf-8')
 
     def check_password(self, password):
-        return bcrypt.check_password_hash(self.password_hash, password)
+        return executar_auth(bcrypt.check_password_hash, self.password_hash, password)
+
+    def precisa_rehash(self):
+        # Hash no formato $2b$<custo>$...: refaz no login quando o custo configurado muda
+        try:
+            return int(self.password_hash.split('$')[2]) != current_app.config['BCRYPT_LOG_ROUNDS']
+        except (IndexError, ValueError):
+            return True
 
     def to_dict(self):
         return {
             'id': self.id,
             'username': self.username,
             'email': self.email,
+            'papel': self.papel,
+        }
+
+# --- Modelo do Resumo do Dashboard (contadores mantidos incrementalmente) ---
+class ResumoDashboard(db.Model):
+    __tablename__ = 'resumo_dashboard'
+
+    id = db.Column(db.Integer, primary_key=True) # Linha única (id = 1)
+    total_produtos = db.Column(db.Integer, default=0, nullable=False)
+    produtos_estoque_baixo = db.Column(db.Integer, default=0, nullable=False)
+    produtos_em_falta = db.Column(db.Integer, default=0, nullable=False)
+    total_entradas = db.Column(db.BigInteger, default=0, nullable=False)
+    total_saidas = db.Column(db.BigInteger, default=0, nullable=False)
+    atualizado_em = db.Column(db.DateTime, nullable=True) # Última reconciliação completa
+
+    def to_dict(self):
+        return {
+            'total_produtos': self.total_produtos,
+            'produtos_estoque_baixo': self.produtos_estoque_baixo,
+            'produtos_em_falta': self.produtos_em_falta,
+            'total_entradas': self.total_entradas,
+            'total_saidas': self.total_saidas
+        }
+
+# --- Modelo de Dados da Importação de Catálogo ---
+class Importacao(db.Model):
+    __tablename__ = 'importacoes'
+
+    id = db.Column(db.Integer, primary_key=True)
+    arquivo_nome = db.Column(db.String(255), nullable=False)
+    status = db.Column(db.String(20), nullable=False, default='pendente') # 'pendente', 'processando', 'concluida' ou 'falhou'
+    processadas = db.Column(db.Integer, nullable=False, default=0)
+    inseridos = db.Column(db.Integer, nullable=False, default=0)
+    atualizados = db.Column(db.Integer, nullable=False, default=0)
+    com_erro = db.Column(db.Integer, nullable=False, default=0)
+    erros = db.Column(db.Text, nullable=True) # JSON: [{"linha": n, "message": "..."}]
+    mensagem = db.Column(db.Text, nullable=True)
+    usuario_id = db.Column(db.Integer, nullable=True)
+    criado_em = db.Column(db.DateTime, nullable=False, default=datetime.now)
+    finalizado_em = db.Column(db.DateTime, nullable=True)
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'arquivo_nome': self.arquivo_nome,
+            'status': self.status,
+            'processadas': self.processadas,
+            'inseridos': self.inseridos,
+            'atualizados': self.atualizados,
+            'com_erro': self.com_erro,
+            'erros': json.loads(self.erros) if self.erros else [],
+            'mensagem': self.mensagem,
+            'criado_em': self.criado_em.isoformat() if self.criado_em else None,
+            'finalizado_em': self.finalizado_em.isoformat() if self.finalizado_em else None
         }
 
+# --- Modelo de Dados dos Agregados de Movimentações ---
+class MovimentacaoRollup(db.Model):
+    __tablename__ = 'movimentacoes_rollup'
+
+    id = db.Column(db.Integer, primary_key=True)
+    dimensao = db.Column(db.String(10), nullable=False) # 'produto' ou 'cliente'
+    dimensao_id = db.Column(db.Integer, nullable=False)
+    granularidade = db.Column(db.String(6), nullable=False) # 'dia', 'semana' ou 'mes'
+    periodo = db.Column(db.Date, nullable=False) # Início do período (segunda-feira na semana, dia 1 no mês)
+    quantidade_entrada = db.Column(db.BigInteger, nullable=False, default=0)
+    quantidade_saida = db.Column(db.BigInteger, nullable=False, default=0)
+    entradas = db.Column(db.Integer, nullable=False, default=0) # Número de movimentações
+    saidas = db.Column(db.Integer, nullable=False, default=0)
+    saldo_final = db.Column(db.Integer, nullable=True) # Estoque ao fim do período; só na dimensão 'produto'
+
+    __table_args__ = (
+        db.UniqueConstraint('dimensao', 'dimensao_id', 'granularidade', 'periodo', name='uq_movimentacoes_rollup_periodo'),
+    )
+
+    def to_dict(self):
+        return {
+            'periodo': self.periodo.isoformat(),
+            'quantidade_entrada': self.quantidade_entrada,
+            'quantidade_saida': self.quantidade_saida,
+            'entradas': self.entradas,
+            'saidas': self.saidas,
+            'saldo_final': self.saldo_final
+        }
+
+# --- Modelo de Dados dos Snapshots de Estoque ---
+class EstoqueCheckpoint(db.Model):
+    __tablename__ = 'estoque_checkpoints'
+
+    id = db.Column(db.Integer, primary_key=True)
+    tirado_em = db.Column(db.DateTime, nullable=False, index=True) # Instante a que os saldos se referem
+    criado_em = db.Column(db.DateTime, nullable=False, default=datetime.now)
+    total_produtos = db.Column(db.Integer, nullable=False, default=0)
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'tirado_em': self.tirado_em.isoformat(),
+            'criado_em': self.criado_em.isoformat() if self.criado_em else None,
+            'total_produtos': self.total_produtos
+        }
+
+class EstoqueSnapshot(db.Model):
+    __tablename__ = 'estoque_snapshots'
+
+    checkpoint_id = db.Column(db.Integer, db.ForeignKey('estoque_checkpoints.id', ondelete='CASCADE'), primary_key=True)
+    produto_id = db.Column(db.Integer, primary_key=True) # Sem FK: o snapshot sobrevive à exclusão do produto
+    estoque = db.Column(db.Integer, nullable=False)
+
+# --- Modelo de Dados do Checkpoint do Journal de Movimentações ---
+class JournalCheckpoint(db.Model):
+    __tablename__ = 'journal_checkpoints'
+
+    nome = db.Column(db.String(255), primary_key=True) # Nome do arquivo do journal
+    ultima_sequencia = db.Column(db.BigInteger, nullable=False, default=0) # Última sequência aplicada (ou rejeitada)
+    atualizado_em = db.Column(db.DateTime, nullable=False, default=datetime.now)
+
+class JournalRejeicao(db.Model):
+    # Movimentação confirmada com 202 que não pôde ser aplicada; o cliente consulta em GET /movimentacoes/journal/<seq>
+    __tablename__ = 'journal_rejeicoes'
+
+    nome = db.Column(db.String(255), primary_key=True) # Nome do arquivo do journal
+    sequencia = db.Column(db.BigInteger, primary_key=True, autoincrement=False)
+    produto_id = db.Column(db.Integer, nullable=False)
+    deposito_id = db.Column(db.Integer, nullable=True)
+    tipo_movimentacao = db.Column(db.String(10), nullable=False)
+    quantidade = db.Column(db.Integer, nullable=False)
+    motivo = db.Column(db.String(255), nullable=False)
+    registro = db.Column(db.Text, nullable=False) # Registro do journal (JSON), para relançar manualmente
+    rejeitada_em = db.Column(db.DateTime, nullable=False, default=datetime.now)
+
+    def to_dict(self):
+        return {
+            'sequencia': self.sequencia,
+            'status': 'rejeitada',
+            'motivo': self.motivo,
+            'movimentacao': json.loads(self.registro),
+            'rejeitada_em': self.rejeitada_em.isoformat() if self.rejeitada_em else None
+        }
+
+# --- Modelo de Dados dos Depósitos ---
+DEPOSITO_PADRAO_ID = 1 # Criado pela migração 7 com todo o estoque existente; recebe as escritas sem depósito
+
+class Deposito(db.Model):
+    __tablename__ = 'depositos'
+
+    id = db.Column(db.Integer, primary_key=True)
+    nome = db.Column(db.String(100), unique=True, nullable=False)
+    localizacao = db.Column(db.String(255), nullable=True)
+    ativo = db.Column(db.Boolean, nullable=False, default=True)
+    criado_em = db.Column(db.DateTime, nullable=False, default=datetime.now)
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'nome': self.nome,
+            'localizacao': self.localizacao,
+            'ativo': self.ativo,
+            'criado_em': self.criado_em.isoformat() if self.criado_em else None
+        }
 
-# --- Criação das Tabelas no Banco de Dados ---
-with app.app_context():
-    db.create_all()
-    print("Tabelas criadas ou já existentes no banco de dados!")
+class EstoqueDeposito(db.Model):
+    # Saldo por (depósito, produto); produtos.estoque_atual é a soma, atualizada pela consolidação (EstoquePendente).
+    # A chave começa pelo depósito: o estoque de um depósito é um intervalo contíguo da chave primária.
+    __tablename__ = 'estoque_depositos'
+
+    deposito_id = db.Column(db.Integer, db.ForeignKey('depositos.id'), primary_key=True)
+    produto_id = db.Column(db.Integer, db.ForeignKey('produtos.id', ondelete='CASCADE'), primary_key=True)
+    estoque = db.Column(db.Integer, nullable=False, default=0)
+
+    __table_args__ = (
+        db.Index('ix_estoque_depositos_produto', 'produto_id', 'deposito_id'),
+    )
+
+class EstoquePendente(db.Model):
+    # Variação de produtos.estoque_atual ainda não consolidada, gravada na transação da escrita no depósito em vez
+    # de travar a linha do produto. Sempre vale: estoque_atual + soma das pendências do produto = soma dos depósitos.
+    __tablename__ = 'estoque_pendencias'
+
+    id = db.Column(db.Integer, primary_key=True) # Ordem de consolidação
+    produto_id = db.Column(db.Integer, nullable=False) # Sem FK: pendências de produto excluído são descartadas
+    variacao = db.Column(db.Integer, nullable=False)
+    tipo_movimentacao = db.Column(db.String(10), nullable=True) # 'entrada' ou 'saida'; nulo para ajuste manual
+    quantidade = db.Column(db.Integer, nullable=True)
+    cliente_id = db.Column(db.Integer, nullable=True)
+    data_hora = db.Column(db.DateTime, nullable=False, default=datetime.now)
+
+class Transferencia(db.Model):
+    # Move saldo entre depósitos sem alterar o agregado do produto (não é entrada nem saída)
+    __tablename__ = 'transferencias'
+
+    id = db.Column(db.Integer, primary_key=True)
+    produto_id = db.Column(db.Integer, db.ForeignKey('produtos.id'), nullable=False)
+    deposito_origem_id = db.Column(db.Integer, db.ForeignKey('depositos.id'), nullable=False)
+    deposito_destino_id = db.Column(db.Integer, db.ForeignKey('depositos.id'), nullable=False)
+    quantidade = db.Column(db.Integer, nullable=False)
+    observacao = db.Column(db.Text, nullable=True)
+    data_hora = db.Column(db.DateTime, nullable=False, default=datetime.now)
+
+    __table_args__ = (
+        db.Index('ix_transferencias_origem_data_hora', 'deposito_origem_id', 'data_hora', 'id'),
+        db.Index('ix_transferencias_destino_data_hora', 'deposito_destino_id', 'data_hora', 'id'),
+        db.Index('ix_transferencias_produto_data_hora', 'produto_id', 'data_hora', 'id'),
+    )
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'produto_id': self.produto_id,
+            'deposito_origem_id': self.deposito_origem_id,
+            'deposito_destino_id': self.deposito_destino_id,
+            'quantidade': self.quantidade,
+            'observacao': self.observacao,
+            'data_hora': self.data_hora.isoformat() if self.data_hora else None
+        }
+
+
+# --- Modelo de Dados do Arquivo de Movimentações ---
+class MovimentacaoArquivada(db.Model):
+    # Mesmas colunas de movimentacoes, sem chaves estrangeiras; no MySQL a tabela é particionada por mês
+    # (RANGE em data_hora), por isso data_hora faz parte da chave primária
+    __tablename__ = 'movimentacoes_arquivo'
+
+    id = db.Column(db.Integer, nullable=False, autoincrement=False) # Id original em movimentacoes
+    produto_id = db.Column(db.Integer, nullable=False)
+    tipo_movimentacao = db.Column(db.String(10), nullable=False)
+    quantidade = db.Column(db.Integer, nullable=False)
+    data_hora = db.Column(db.DateTime, nullable=False)
+    observacao = db.Column(db.Text, nullable=True)
+    numero_nota_fiscal = db.Column(db.String(100), nullable=True)
+    cliente_id = db.Column(db.Integer, nullable=True)
+    deposito_id = db.Column(db.Integer, nullable=True)
+
+    __table_args__ = (
+        db.PrimaryKeyConstraint('data_hora', 'id'),
+        db.Index('ix_movimentacoes_arquivo_produto_data_hora', 'produto_id', 'data_hora', 'id'),
+        db.Index('ix_movimentacoes_arquivo_cliente_data_hora', 'cliente_id', 'data_hora', 'id'),
+    )
+
+class ResumoArquivoMes(db.Model):
+    # Totais de cada mês arquivado: o dashboard e a contagem das listagens não precisam ler o arquivo
+    __tablename__ = 'movimentacoes_arquivo_meses'
+
+    mes = db.Column(db.Date, primary_key=True) # Primeiro dia do mês
+    total_linhas = db.Column(db.Integer, nullable=False, default=0)
+    quantidade_entrada = db.Column(db.BigInteger, nullable=False, default=0)
+    quantidade_saida = db.Column(db.BigInteger, nullable=False, default=0)
+    entradas = db.Column(db.Integer, nullable=False, default=0)
+    saidas = db.Column(db.Integer, nullable=False, default=0)
+    arquivado_em = db.Column(db.DateTime, nullable=False, default=datetime.now)
+
+    def to_dict(self):
+        return {
+            'mes': self.mes.isoformat(),
+            'total_linhas': self.total_linhas,
+            'quantidade_entrada': self.quantidade_entrada,
+            'quantidade_saida': self.quantidade_saida,
+            'entradas': self.entradas,
+            'saidas': self.saidas,
+            'arquivado_em': self.arquivado_em.isoformat() if self.arquivado_em else None
+        }
+
+
+# --- Migrações do Esquema ---
+# Cada migração é idempotente e roda uma única vez por banco, registrada em schema_migracoes.
+# Aplicar com `flask migrar` (ou automaticamente em `python app.py`); nada é criado no import nem em create_app().
+class SchemaMigracao(db.Model):
+    __tablename__ = 'schema_migracoes'
+
+    versao = db.Column(db.Integer, primary_key=True)
+    descricao = db.Column(db.String(255), nullable=False)
+    aplicada_em = db.Column(db.DateTime, nullable=False, default=datetime.now)
+
+MIGRACOES = []
+
+def migracao(versao, descricao):
+    def registrar(funcao):
+        MIGRACOES.append((versao, descricao, funcao))
+        return funcao
+    return registrar
+
+def _adicionar_coluna_se_ausente(conexao, coluna):
+    tabela = coluna.table.name
+    if coluna.name not in {c['name'] for c in sa_inspect(conexao).get_columns(tabela)}:
+        definicao = CreateColumn(coluna).compile(dialect=conexao.dialect)
+        conexao.execute(text(f'ALTER TABLE {tabela} ADD COLUMN {definicao}'))
+
+def _criar_indices_se_ausentes(conexao, modelo, nomes):
+    # Lista fixa por migração: índices declarados depois no modelo podem depender de colunas que só uma
+    # migração posterior adiciona
+    existentes = {indice['name'] for indice in sa_inspect(conexao).get_indexes(modelo.__tablename__)}
+    indices = {indice.name: indice for indice in modelo.__table__.indexes}
+    for nome in nomes:
+        if nome not in existentes:
+            indices[nome].create(conexao)
+
+@migracao(1, 'Esquema inicial')
+def _migracao_esquema_inicial(conexao):
+    # Bancos criados pelo antigo db.create_all() já têm as tabelas; bancos novos recebem o esquema atual
+    db.metadata.create_all(conexao, checkfirst=True)
+
+@migracao(2, 'Papel e versão de token em users')
+def _migracao_usuarios_papel(conexao):
+    _adicionar_coluna_se_ausente(conexao, User.__table__.c.papel)
+    _adicionar_coluna_se_ausente(conexao, User.__table__.c.token_versao)
+
+@migracao(3, 'Índices das consultas de movimentações e produtos; coluna gerada estoque_baixo')
+def _migracao_indices_consultas(conexao):
+    _adicionar_coluna_se_ausente(conexao, Produto.__table__.c.estoque_baixo)
+    _criar_indices_se_ausentes(conexao, Produto, [
+        'ix_produtos_fornecedor_id', 'ix_produtos_estoque_baixo_nome', 'ix_produtos_estoque_atual_nome'
+    ])
+    _criar_indices_se_ausentes(conexao, Movimentacao, [
+        'ix_movimentacoes_data_hora_id', 'ix_movimentacoes_produto_data_hora',
+        'ix_movimentacoes_cliente_data_hora', 'ix_movimentacoes_tipo_data_hora'
+    ])
+
+@migracao(4, 'Agregados de movimentações por período (movimentacoes_rollup)')
+def _migracao_rollups(conexao):
+    MovimentacaoRollup.__table__.create(conexao, checkfirst=True) # Preencher com `flask reconstruir-rollups`
+
+@migracao(5, 'Snapshots periódicos de estoque (estoque_checkpoints, estoque_snapshots)')
+def _migracao_snapshots_estoque(conexao):
+    EstoqueCheckpoint.__table__.create(conexao, checkfirst=True)
+    EstoqueSnapshot.__table__.create(conexao, checkfirst=True)
+
+@migracao(6, 'Checkpoint do journal de movimentações (journal_checkpoints)')
+def _migracao_journal_checkpoints(conexao):
+    JournalCheckpoint.__table__.create(conexao, checkfirst=True)
+
+@migracao(7, 'Depósitos: saldos por depósito, transferências e depósito nas movimentações')
+def _migracao_depositos(conexao):
+    Deposito.__table__.create(conexao, checkfirst=True)
+    EstoqueDeposito.__table__.create(conexao, checkfirst=True)
+    Transferencia.__table__.create(conexao, checkfirst=True)
+    _adicionar_coluna_se_ausente(conexao, Movimentacao.__table__.c.deposito_id)
+    _criar_indices_se_ausentes(conexao, Movimentacao, ['ix_movimentacoes_deposito_data_hora'])
+    if conexao.execute(select(Deposito.id).where(Deposito.id == DEPOSITO_PADRAO_ID)).first() is None:
+        conexao.execute(insert(Deposito).values(id=DEPOSITO_PADRAO_ID, nome='Principal', ativo=True, criado_em=datetime.now()))
+    # Todo o estoque existente passa a estar no depósito padrão
+    sem_saldo = ~select(EstoqueDeposito.produto_id).where(EstoqueDeposito.produto_id == Produto.id).exists()
+    conexao.execute(insert(EstoqueDeposito).from_select(
+        ['deposito_id', 'produto_id', 'estoque'],
+        select(db.literal(DEPOSITO_PADRAO_ID), Produto.id, Produto.estoque_atual).where(sem_saldo)
+    ))
+
+@migracao(8, 'Arquivo de movimentações (movimentacoes_arquivo particionada por mês, movimentacoes_arquivo_meses)')
+def _migracao_arquivo_movimentacoes(conexao):
+    MovimentacaoArquivada.__table__.create(conexao, checkfirst=True)
+    ResumoArquivoMes.__table__.create(conexao, checkfirst=True)
+    if conexao.dialect.name == 'mysql':
+        # Só a partição final; `flask arquivar-movimentacoes` cria uma partição por mês antes de copiá-lo
+        particionada = conexao.execute(text(
+            "SELECT COUNT(*) FROM information_schema.partitions WHERE table_schema = DATABASE() "
+            "AND table_name = 'movimentacoes_arquivo' AND partition_name IS NOT NULL"
+        )).scalar()
+        if not particionada:
+            conexao.execute(text(
+                "ALTER TABLE movimentacoes_arquivo PARTITION BY RANGE (TO_DAYS(data_hora)) "
+                "(PARTITION pmax VALUES LESS THAN MAXVALUE)"
+            ))
+
+@migracao(9, 'Movimentações rejeitadas pelo journal (journal_rejeicoes)')
+def _migracao_journal_rejeicoes(conexao):
+    JournalRejeicao.__table__.create(conexao, checkfirst=True)
+
+@migracao(10, 'Pendências de consolidação do estoque agregado (estoque_pendencias)')
+def _migracao_estoque_pendencias(conexao):
+    EstoquePendente.__table__.create(conexao, checkfirst=True)
+
+def aplicar_migracoes():
+    SchemaMigracao.__table__.create(db.engine, checkfirst=True)
+    aplicadas = {versao for (versao,) in db.session.query(SchemaMigracao.versao)}
+    db.session.rollback()
+    for versao, descricao, funcao in sorted(MIGRACOES, key=lambda migracao: migracao[0]):
+        if versao in aplicadas:
+            continue
+        with db.engine.begin() as conexao:
+            funcao(conexao)
+            conexao.execute(insert(SchemaMigracao).values(versao=versao, descricao=descricao, aplicada_em=datetime.now()))
+        logger.info("Migração %s aplicada: %s", versao, descricao)
+
+@api.cli.command('migrar')
+def migrar_command():
+    aplicar_migracoes()
+    print("Esquema do banco de dados atualizado!")
+
+# --- Verificação dos Planos de Consulta (EXPLAIN) ---
+# As consultas mais quentes das listagens; `flask verificar-indices` falha se alguma virar varredura completa.
+def _consultas_quentes():
+    inicio = datetime(2000, 1, 1)
+    recentes = (Movimentacao.data_hora.desc(), Movimentacao.id.desc())
+    return {
+        'movimentacoes_recentes': select(Movimentacao).order_by(*recentes).limit(20),
+        'movimentacoes_por_periodo': select(Movimentacao).where(Movimentacao.data_hora >= inicio).order_by(*recentes).limit(20),
+        'movimentacoes_por_produto': select(Movimentacao).where(Movimentacao.produto_id == 1).order_by(*recentes).limit(20),
+        'movimentacoes_por_cliente': select(Movimentacao).where(Movimentacao.cliente_id == 1).order_by(*recentes).limit(20),
+        'movimentacoes_por_deposito': select(Movimentacao).where(Movimentacao.deposito_id == 1).order_by(*recentes).limit(20),
+        'estoque_por_deposito': select(EstoqueDeposito).where(EstoqueDeposito.deposito_id == 1).order_by(EstoqueDeposito.produto_id).limit(20),
+        'arquivo_por_periodo': select(MovimentacaoArquivada).where(MovimentacaoArquivada.data_hora >= inicio).order_by(
+            MovimentacaoArquivada.data_hora.desc(), MovimentacaoArquivada.id.desc()).limit(20),
+        'arquivo_por_produto': select(MovimentacaoArquivada).where(MovimentacaoArquivada.produto_id == 1).order_by(
+            MovimentacaoArquivada.data_hora.desc(), MovimentacaoArquivada.id.desc()).limit(20),
+        'movimentacoes_por_tipo': select(Movimentacao).where(Movimentacao.tipo_movimentacao == 'saida', Movimentacao.data_hora >= inicio).order_by(*recentes).limit(20),
+        'produtos_por_fornecedor': select(Produto).where(Produto.fornecedor_id == 1).order_by(Produto.id).limit(20),
+        'produtos_estoque_baixo': select(Produto).where(Produto.estoque_baixo == True).order_by(Produto.nome),
+        'produtos_em_falta': select(Produto).where(Produto.estoque_atual == 0).order_by(Produto.nome),
+    }
+
+def _problemas_plano(conexao, consulta):
+    sql = str(consulta.compile(dialect=conexao.dialect, compile_kwargs={'literal_binds': True}))
+    dialeto = conexao.dialect.name
+    # Com filtro, percorrer um índice inteiro (só para aproveitar a ordenação) também conta como varredura
+    filtrada = consulta.whereclause is not None
+    if dialeto == 'sqlite':
+        detalhes = [linha[-1] for linha in conexao.execute(text(f'EXPLAIN QUERY PLAN {sql}'))]
+        return [d for d in detalhes if (d.startswith('SCAN ') and (filtrada or 'USING' not in d)) or 'TEMP B-TREE' in d]
+    if dialeto == 'postgresql':
+        plano = '\n'.join(linha[0] for linha in conexao.execute(text(f'EXPLAIN {sql}')))
+        return [linha.strip() for linha in plano.splitlines() if 'Seq Scan' in linha]
+    # MySQL/MariaDB: type=ALL é varredura completa; filesort indica ordenação fora do índice
+    linhas = [dict(linha._mapping) for linha in conexao.execute(text(f'EXPLAIN {sql}'))]
+    return [f"{linha.get('table')}: type={linha.get('type')} {linha.get('Extra') or ''}".strip()
+            for linha in linhas if linha.get('type') == 'ALL' or (filtrada and linha.get('type') == 'index') or 'filesort' in (linha.get('Extra') or '')]
+
+def verificar_planos_consultas():
+    # Retorna {nome da consulta: [trechos do plano com varredura completa]} apenas para as que falharam
+    falhas = {}
+    with db.engine.connect() as conexao:
+        for nome, consulta in _consultas_quentes().items():
+            problemas = _problemas_plano(conexao, consulta)
+            if problemas:
+                falhas[nome] = problemas
+    return falhas
+
+@api.cli.command('verificar-indices')
+def verificar_indices_command():
+    falhas = verificar_planos_consultas()
+    for nome in _consultas_quentes():
+        print(f"{'FALHOU' if nome in falhas else 'ok'}: {nome}" + (f" -> {'; '.join(falhas[nome])}" if nome in falhas else ''))
+    if falhas:
+        raise SystemExit(1)
+
+# --- Instrumentação: Consultas SQL, Latência por Rota e Métricas ---
+_contadores_consultas = []
+
+BUCKETS_LATENCIA = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+BUCKETS_CONSULTAS = (1, 2, 5, 10, 20, 50, 100, 250)
+
+class Histograma:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.contagens = [0] * (len(buckets) + 1) # O último é o +Inf
+        self.soma = 0.0
+        self.total = 0
+
+    def observar(self, valor):
+        posicao = next((indice for indice, limite in enumerate(self.buckets) if valor <= limite), len(self.buckets))
+        self.contagens[posicao] += 1
+        self.soma += valor
+        self.total += 1
+
+class MetricasProcesso:
+    # Métricas em memória do processo (cada worker expõe as suas em /metrics)
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencia = {} # (método, rota, status) -> Histograma de segundos
+        self.consultas_por_requisicao = {} # rota -> Histograma de nº de consultas
+        self.sql = defaultdict(lambda: {'consultas': 0, 'segundos': 0.0, 'linhas': 0, 'lentas': 0}) # rota -> totais
+
+    def registrar_requisicao(self, metodo, rota, status, duracao, consultas):
+        with self._lock:
+            self.latencia.setdefault((metodo, rota, status), Histograma(BUCKETS_LATENCIA)).observar(duracao)
+            self.consultas_por_requisicao.setdefault(rota, Histograma(BUCKETS_CONSULTAS)).observar(consultas)
+
+    def registrar_consulta(self, rota, duracao, linhas, lenta):
+        with self._lock:
+            totais = self.sql[rota]
+            totais['consultas'] += 1
+            totais['segundos'] += duracao
+            totais['linhas'] += max(linhas, 0)
+            totais['lentas'] += lenta
+
+    def formato_prometheus(self):
+        def rotulos(**valores):
+            return ','.join(f'{nome}="{str(valor).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"' for nome, valor in valores.items())
+
+        def histograma(nome, chave_rotulos, hist):
+            acumulado = 0
+            for limite, contagem in zip(list(hist.buckets) + ['+Inf'], hist.contagens):
+                acumulado += contagem
+                yield f'{nome}_bucket{{{rotulos(**chave_rotulos, le=limite)}}} {acumulado}'
+            yield f'{nome}_sum{{{rotulos(**chave_rotulos)}}} {hist.soma}'
+            yield f'{nome}_count{{{rotulos(**chave_rotulos)}}} {hist.total}'
+
+        linhas = []
+        with self._lock:
+            linhas += ['# HELP http_requisicao_duracao_segundos Latência das requisições por rota.', '# TYPE http_requisicao_duracao_segundos histogram']
+            for (metodo, rota, status), hist in sorted(self.latencia.items()):
+                linhas += histograma('http_requisicao_duracao_segundos', {'metodo': metodo, 'rota': rota, 'status': status}, hist)
+            linhas += ['# HELP http_requisicao_consultas_sql Consultas SQL por requisição.', '# TYPE http_requisicao_consultas_sql histogram']
+            for rota, hist in sorted(self.consultas_por_requisicao.items()):
+                linhas += histograma('http_requisicao_consultas_sql', {'rota': rota}, hist)
+            for nome, campo, tipo, ajuda in [
+                ('sql_consultas_total', 'consultas', 'counter', 'Consultas SQL executadas.'),
+                ('sql_duracao_segundos_total', 'segundos', 'counter', 'Tempo gasto em consultas SQL.'),
+                ('sql_linhas_total', 'linhas', 'counter', 'Linhas afetadas/retornadas segundo o driver (cursor.rowcount).'),
+                ('sql_consultas_lentas_total', 'lentas', 'counter', 'Consultas acima de SQL_LENTA_MS.'),
+            ]:
+                linhas += [f'# HELP {nome} {ajuda}', f'# TYPE {nome} {tipo}']
+                linhas += [f'{nome}{{{rotulos(rota=rota)}}} {totais[campo]}' for rota, totais in sorted(self.sql.items())]
+        return '\n'.join(linhas) + '\n'
+
+metricas = MetricasProcesso()
+
+def _rota_atual():
+    if not has_request_context():
+        return '(segundo_plano)'
+    return request.url_rule.rule if request.url_rule is not None else '(sem_rota)' # Padrão da rota: cardinalidade baixa
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _contar_consulta(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context():
+        g.consultas_sql = g.get('consultas_sql', 0) + 1
+    for contador in _contadores_consultas:
+        contador.append(statement)
+    conn.info.setdefault('inicio_consultas', []).append(time.perf_counter())
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _medir_consulta(conn, cursor, statement, parameters, context, executemany):
+    duracao = time.perf_counter() - conn.info['inicio_consultas'].pop()
+    rota = _rota_atual()
+    limite = current_app.config['SQL_LENTA_MS'] if has_app_context() else 200
+    lenta = duracao * 1000 >= limite
+    metricas.registrar_consulta(rota, duracao, cursor.rowcount, lenta)
+    if has_request_context():
+        g.tempo_sql = g.get('tempo_sql', 0.0) + duracao
+    if lenta:
+        # Só o SQL: os parâmetros podem conter dados pessoais ou hashes de senha
+        logger.warning('consulta_lenta duracao_ms=%.1f rota=%s sql=%s', duracao * 1000, rota, ' '.join(statement.split())[:2000])
+
+@contextmanager
+def contar_consultas():
+    # Uso: with contar_consultas() as consultas: ... ; len(consultas) == número de statements executados
+    consultas = []
+    _contadores_consultas.append(consultas)
+    try:
+        yield consultas
+    finally:
+        _contadores_consultas.remove(consultas)
+
+class AmostradorPerfil:
+    # Profiler por amostragem: lê a pilha da thread da requisição a cada intervalo e agrega no
+    # formato "collapsed stacks" (raiz;...;folha contagem), aceito por flamegraph.pl e speedscope
+    def __init__(self, thread_id, intervalo):
+        self._thread_id = thread_id
+        self._intervalo = intervalo
+        self._pilhas = Counter()
+        self._parar = threading.Event()
+        self._thread = threading.Thread(target=self._amostrar, daemon=True, name='profiler')
+        self._thread.start()
+
+    def _amostrar(self):
+        while not self._parar.wait(self._intervalo):
+            frame = sys._current_frames().get(self._thread_id)
+            pilha = []
+            while frame is not None:
+                codigo = frame.f_code
+                pilha.append(f'{codigo.co_name} ({os.path.basename(codigo.co_filename)}:{codigo.co_firstlineno})')
+                frame = frame.f_back
+            if pilha:
+                self._pilhas[';'.join(reversed(pilha))] += 1
+
+    def parar(self):
+        self._parar.set()
+        self._thread.join()
+        return self._pilhas
+
+def _perfil_solicitado():
+    # Opt-in por ?__profile=1 e só para administradores; para os demais o parâmetro é ignorado
+    if request.args.get('__profile') != '1':
+        return False
+    try:
+        verify_jwt_in_request(optional=True)
+        return (get_jwt() or {}).get('papel') == 'admin'
+    except Exception:
+        return False
+
+@api.before_app_request
+def _iniciar_instrumentacao():
+    g.inicio_requisicao = time.perf_counter()
+    if _perfil_solicitado():
+        g.amostrador = AmostradorPerfil(threading.get_ident(), current_app.config['PROFILER_INTERVALO_MS'] / 1000)
+
+@api.after_app_request
+def _registrar_instrumentacao(response):
+    duracao = time.perf_counter() - g.get('inicio_requisicao', time.perf_counter())
+    consultas, tempo_sql = g.get('consultas_sql', 0), g.get('tempo_sql', 0.0)
+    metricas.registrar_requisicao(request.method, _rota_atual(), str(response.status_code), duracao, consultas)
+
+    response.headers['Server-Timing'] = f'app;dur={duracao * 1000:.1f}, sql;dur={tempo_sql * 1000:.1f}'
+    if current_app.config['SQL_CONTAR_CONSULTAS']:
+        response.headers['X-Consultas-SQL'] = str(consultas)
+
+    amostrador = g.pop('amostrador', None)
+    if amostrador is not None:
+        pilhas = amostrador.parar()
+        if not response.is_streamed:
+            corpo = '\n'.join(f'{pilha} {contagem}' for pilha, contagem in pilhas.most_common()) + '\n'
+            perfil = Response(corpo, mimetype='text/plain')
+            perfil.headers['X-Perfil-Status-Original'] = str(response.status_code)
+            perfil.headers['X-Perfil-Amostras'] = str(sum(pilhas.values()))
+            perfil.headers['Server-Timing'] = response.headers['Server-Timing']
+            return perfil
+    return response
+
+@api.teardown_app_request
+def _encerrar_amostrador(exc):
+    amostrador = g.pop('amostrador', None)
+    if amostrador is not None:
+        amostrador.parar()
+
+@api.route('/metrics', methods=['GET'])
+def get_metricas():
+    token = current_app.config['METRICAS_TOKEN']
+    if token and request.headers.get('Authorization') != f'Bearer {token}':
+        return jsonify({"message": "Não autorizado."}), 401
+    return Response(metricas.formato_prometheus(), mimetype='text/plain; version=0.0.4')
 
 # --- Função auxiliar para calcular o valor do imposto com precisão Decimal ---
 def calculate_tax_value(price_decimal_input, aliquot_decimal_input):
@@ -221,8 +1108,562 @@ def calculate_tax_value(price_decimal_input, aliquot_decimal_input):
     except (InvalidOperation, TypeError):
         return Decimal(0)
 
+# --- Cálculo de impostos em lote (mesma semântica de calculate_tax_value) ---
+IMPOSTOS = ['icms', 'ipi', 'pis', 'cofins']
+CENTAVO = Decimal('0.01')
+
+def _fator_aliquota(aliquota):
+    # aliquota / 100 calculado uma única vez por valor distinto; None quando inválida (imposto = 0)
+    try:
+        aliquota = aliquota if isinstance(aliquota, Decimal) else Decimal(str(aliquota))
+        if aliquota < 0:
+            aliquota = Decimal(0)
+        return aliquota / Decimal(100)
+    except (InvalidOperation, TypeError):
+        return None
+
+def calcular_impostos_lote(linhas, novas_aliquotas):
+    # linhas: (id, preco_venda, icms_aliquota, ipi_aliquota, pis_aliquota, cofins_aliquota)
+    # novas_aliquotas: {'icms': Decimal, ...} apenas para os impostos alterados
+    fatores = {}
+    for produto_id, preco_venda, *aliquotas_atuais in linhas:
+        valores = {'id': produto_id}
+        for imposto, aliquota_atual in zip(IMPOSTOS, aliquotas_atuais):
+            aliquota = novas_aliquotas.get(imposto, aliquota_atual)
+            if aliquota not in fatores:
+                fatores[aliquota] = _fator_aliquota(aliquota)
+            fator = fatores[aliquota]
+
+            try:
+                valor = Decimal(0) if fator is None or preco_venda is None else (preco_venda * fator).quantize(CENTAVO)
+            except InvalidOperation:
+                valor = Decimal(0)
+
+            if imposto in novas_aliquotas:
+                valores[f'{imposto}_aliquota'] = aliquota
+            valores[f'{imposto}_valor'] = valor
+        yield valores
+
+# --- Serialização por Esquema (SELECT só das colunas pedidas, sem objetos ORM) ---
+def _converter_decimal(valor):
+    return float(valor) if valor is not None else None
+
+def _converter_data_hora(valor):
+    return valor.isoformat() if valor is not None else None
+
+class SerializadorModelo:
+    # Campos = colunas da tabela (mesma saída do to_dict) + campos de tabelas relacionadas via LEFT JOIN.
+    # Para cada combinação de ?fields= o SELECT e o codificador de linhas são montados uma única vez.
+    def __init__(self, modelo, chaves, relacionados=None):
+        self.campos = OrderedDict()
+        for coluna in modelo.__table__.columns:
+            conversor = None
+            if isinstance(coluna.type, db.Numeric):
+                conversor = _converter_decimal
+            elif isinstance(coluna.type, db.DateTime):
+                conversor = _converter_data_hora
+            self.campos[coluna.key] = (getattr(modelo, coluna.key), conversor, None)
+        self.campos.update(relacionados or {})
+        self.chaves = chaves # Sempre selecionadas (paginação por cursor), mesmo fora de ?fields=
+        self._compilados = {}
+
+    def compilar(self, nomes=None):
+        nomes = tuple(nomes) if nomes else tuple(self.campos)
+        compilado = self._compilados.get(nomes)
+        if compilado is None:
+            invalidos = [nome for nome in nomes if nome not in self.campos]
+            if invalidos:
+                raise ValueError(f"Campos inválidos: {', '.join(invalidos)}. Campos disponíveis: {', '.join(self.campos)}.")
+
+            selecionados = list(nomes) + [chave for chave in self.chaves if chave not in nomes]
+            colunas = [self.campos[nome][0].label(nome) for nome in selecionados]
+            joins = []
+            for nome in selecionados:
+                join = self.campos[nome][2]
+                if join is not None and not any(join is existente for existente in joins):
+                    joins.append(join)
+
+            conversores = [(posicao, nome, self.campos[nome][1]) for posicao, nome in enumerate(nomes)]
+            def codificar(linha):
+                return {nome: conversor(linha[posicao]) if conversor else linha[posicao] for posicao, nome, conversor in conversores}
+
+            compilado = (colunas, joins, codificar)
+            if len(self._compilados) >= 256:
+                self._compilados.clear()
+            self._compilados[nomes] = compilado
+        return compilado
+
+    def aplicar(self, query, nomes=None):
+        # Retorna (query de tuplas, função linha -> dict). Chamar depois dos filtros (filter_by usa a última entidade do join).
+        colunas, joins, codificar = self.compilar(nomes)
+        for modelo, condicao in joins:
+            query = query.outerjoin(modelo, condicao)
+        return query.with_entities(*colunas), codificar
+
+def campos_solicitados():
+    fields = request.args.get('fields', type=str)
+    return [campo.strip() for campo in fields.split(',') if campo.strip()] if fields else None
+
+# Joins compartilhados entre campos: o mesmo objeto só entra uma vez na consulta
+_JOIN_PRODUTO = (Produto, Movimentacao.produto_id == Produto.id)
+_JOIN_CLIENTE = (Cliente, Movimentacao.cliente_id == Cliente.id)
+_JOIN_PRODUTO_ARQUIVO = (Produto, MovimentacaoArquivada.produto_id == Produto.id)
+
+SERIALIZADORES = {
+    'produtos': SerializadorModelo(Produto, ['id'], {
+        'fornecedor_nome': (Fornecedor.nome, None, (Fornecedor, Produto.fornecedor_id == Fornecedor.id)),
+    }),
+    'movimentacoes': SerializadorModelo(Movimentacao, ['data_hora', 'id'], {
+        'cliente_nome': (Cliente.nome, None, _JOIN_CLIENTE),
+        'produto_nome': (Produto.nome, None, _JOIN_PRODUTO),
+        'produto_codigo': (Produto.codigo, None, _JOIN_PRODUTO),
+        'deposito_nome': (Deposito.nome, None, (Deposito, Movimentacao.deposito_id == Deposito.id)),
+    }),
+    # Mesmos campos, na mesma ordem: as linhas do arquivo saem com o codificador das movimentações
+    'movimentacoes_arquivadas': SerializadorModelo(MovimentacaoArquivada, ['data_hora', 'id'], {
+        'cliente_nome': (Cliente.nome, None, (Cliente, MovimentacaoArquivada.cliente_id == Cliente.id)),
+        'produto_nome': (Produto.nome, None, _JOIN_PRODUTO_ARQUIVO),
+        'produto_codigo': (Produto.codigo, None, _JOIN_PRODUTO_ARQUIVO),
+        'deposito_nome': (Deposito.nome, None, (Deposito, MovimentacaoArquivada.deposito_id == Deposito.id)),
+    }),
+    'fornecedores': SerializadorModelo(Fornecedor, ['id']),
+    'clientes': SerializadorModelo(Cliente, ['id']),
+}
+
+@api.cli.command('medir-serializacao')
+@click.option('--linhas', default=20000, show_default=True, help='Produtos sintéticos serializados.')
+def medir_serializacao_command(linhas):
+    # Produtos com fornecedor: to_dict + JSON padrão contra o serializador compilado (tuplas do Core), num
+    # processo novo com SQLite temporário; mediana de 5 execuções, da consulta até o corpo da resposta
+    import benchmarks
+    medicao = benchmarks.executar('serializacao', linhas, log_level='ERROR')
+    print(f"to_dict + jsonify: {medicao['to_dict_ms']:.0f}ms")
+    print(f"serializador ({'orjson' if medicao['orjson'] else 'json'}): {medicao['serializador_ms']:.0f}ms "
+          f"({medicao['to_dict_ms'] / medicao['serializador_ms']:.1f}x)")
+    print(f"serializador com fields=id,nome,estoque_atual: {medicao['serializador_campos_ms']:.0f}ms "
+          f"({medicao['to_dict_ms'] / medicao['serializador_campos_ms']:.1f}x)")
+
+# --- Paginação por Cursor (keyset) ---
+def _serializador_cursor():
+    # Cursores opacos e assinados: o cliente não consegue forjar nem editar a posição
+    return URLSafeSerializer(current_app.config['JWT_SECRET_KEY'], salt='cursor-paginacao')
+
+def _condicao_keyset(colunas_chave, valores, descendente):
+    # (a, b) > (va, vb)  =>  a >= va AND (a > va OR (a = va AND b > vb)), portável entre dialetos. O limite
+    # redundante em `a` faz o banco começar a leitura do índice na posição do cursor (só com o OR, o SQLite
+    # percorre o índice desde o início e a página profunda fica tão lenta quanto o OFFSET)
+    coluna, valor = colunas_chave[0], valores[0]
+    apos = coluna < valor if descendente else coluna > valor
+    if len(colunas_chave) == 1:
+        return apos
+    limite = coluna <= valor if descendente else coluna >= valor
+    return and_(limite, or_(apos, and_(coluna == valor, _condicao_keyset(colunas_chave[1:], valores[1:], descendente))))
+
+def _resposta_por_cursor(query, colunas_chave, serializar, descendente=False, continuacao=None):
+    # continuacao: (query, colunas_chave) lida depois que `query` se esgota, com as mesmas chaves de ordenação
+    # (movimentações arquivadas, todas anteriores às da tabela quente)
+    limit = request.args.get('limit', 10, type=int)
+    if limit <= 0:
+        return jsonify({"message": "O parâmetro limit deve ser maior que zero."}), 400
+    limit = min(limit, current_app.config['PAGINACAO_CURSOR_MAX_LIMIT'])
+    partes = [(query, colunas_chave)] + ([continuacao] if continuacao is not None else [])
+
+    # O COUNT(*) é opcional no modo cursor (?com_total=true)
+    total_items = None
+    if request.args.get('com_total', 'false').lower() == 'true':
+        total_items = sum(parte.order_by(None).count() for parte, _ in partes)
+
+    cursor = request.args.get('cursor', '')
+    if cursor:
+        try:
+            valores = _serializador_cursor().loads(cursor)
+            valores = [
+                datetime.fromisoformat(valor) if isinstance(coluna.type, db.DateTime) else valor
+                for coluna, valor in zip(colunas_chave, valores)
+            ]
+        except (BadSignature, TypeError, ValueError):
+            return jsonify({"message": "Cursor de paginação inválido."}), 400
+        partes = [(parte.filter(_condicao_keyset(chaves, valores, descendente)), chaves) for parte, chaves in partes]
+
+    items = []
+    for parte, chaves in partes:
+        if len(items) > limit:
+            break
+        ordenacao = [coluna.desc() if descendente else coluna.asc() for coluna in chaves]
+        items += parte.order_by(None).order_by(*ordenacao).limit(limit + 1 - len(items)).all()
+    has_next = len(items) > limit
+    items = items[:limit]
+
+    next_cursor = None
+    if has_next:
+        ultimo = items[-1]
+        next_cursor = _serializador_cursor().dumps([
+            valor.isoformat() if isinstance(valor, datetime) else valor
+            for valor in (getattr(ultimo, coluna.key) for coluna in colunas_chave)
+        ])
+
+    return jsonify({
+        'items': [serializar(item) for item in items],
+        'per_page': limit,
+        'has_next': has_next,
+        'next_cursor': next_cursor,
+        'total_items': total_items
+    }), 200
+
+@api.cli.command('medir-paginacao')
+@click.option('--linhas', default=200000, show_default=True, help='Movimentações sintéticas.')
+@click.option('--por-pagina', default=20, show_default=True, help='Itens por página.')
+@click.option('--pagina', default=10000, show_default=True, help='Página profunda comparada com a primeira.')
+@click.option('--banco', default=None, help='URL de um banco descartável (padrão: SQLite temporário).')
+def medir_paginacao_command(linhas, por_pagina, pagina, banco):
+    # Latência (mediana de 5) da página 1 e da página N de GET /movimentacoes, por offset e por cursor
+    import benchmarks
+    if pagina * por_pagina > linhas:
+        raise click.BadParameter(f"A página {pagina} precisa de ao menos {pagina * por_pagina} linhas.", param_hint='--linhas')
+    medicao = benchmarks.executar('paginacao', linhas, por_pagina, pagina, banco=banco, log_level='ERROR')
+    print(f"offset: pagina 1={medicao['offset_pagina_1_ms']:.1f}ms pagina {pagina}={medicao['offset_pagina_n_ms']:.1f}ms")
+    print(f"cursor: pagina 1={medicao['cursor_pagina_1_ms']:.1f}ms pagina {pagina}={medicao['cursor_pagina_n_ms']:.1f}ms")
+
+# --- Cache de Entidades (read-through, TTL + LRU) ---
+class CacheMemoria:
+    def __init__(self, max_itens, ttl):
+        self._itens = OrderedDict() # chave -> (expira_em, valor), do menos para o mais recente
+        self._lock = threading.Lock()
+        self._max_itens = max_itens
+        self._ttl = ttl
+
+    def obter(self, chave):
+        with self._lock:
+            item = self._itens.get(chave)
+            if item is None:
+                return None
+            if item[0] < time.monotonic():
+                del self._itens[chave]
+                return None
+            self._itens.move_to_end(chave)
+            return item[1]
+
+    def definir(self, chave, valor):
+        with self._lock:
+            self._itens[chave] = (time.monotonic() + self._ttl, valor)
+            self._itens.move_to_end(chave)
+            while len(self._itens) > self._max_itens:
+                self._itens.popitem(last=False)
+
+    def remover(self, *chaves):
+        with self._lock:
+            for chave in chaves:
+                self._itens.pop(chave, None)
+
+    def limpar_prefixo(self, prefixo):
+        with self._lock:
+            for chave in [chave for chave in self._itens if chave.startswith(prefixo)]:
+                del self._itens[chave]
+
+class CacheRedis:
+    # Compartilhado entre workers; qualquer servidor compatível com o protocolo Redis serve.
+    # A evicção LRU fica a cargo do servidor (maxmemory-policy allkeys-lru).
+    def __init__(self, url, ttl):
+        import redis # Dependência opcional, só necessária com CACHE_BACKEND=redis
+        self._cliente = redis.Redis.from_url(url)
+        self._ttl = ttl
+
+    def obter(self, chave):
+        valor = self._cliente.get(chave)
+        return json.loads(valor) if valor is not None else None
+
+    def definir(self, chave, valor):
+        self._cliente.setex(chave, self._ttl, json.dumps(valor))
+
+    def remover(self, *chaves):
+        if chaves:
+            self._cliente.delete(*chaves)
+
+    def limpar_prefixo(self, prefixo):
+        for chave in self._cliente.scan_iter(match=f'{prefixo}*'):
+            self._cliente.delete(chave)
+
+_cache_entidades = None
+
+def obter_cache():
+    global _cache_entidades
+    if _cache_entidades is None:
+        if current_app.config['CACHE_BACKEND'] == 'redis':
+            _cache_entidades = CacheRedis(current_app.config['CACHE_REDIS_URL'], current_app.config['CACHE_TTL_SEGUNDOS'])
+        else:
+            _cache_entidades = CacheMemoria(current_app.config['CACHE_MAX_ITENS'], current_app.config['CACHE_TTL_SEGUNDOS'])
+    return _cache_entidades
+
+def invalidar_cache(entidade, *ids):
+    obter_cache().remover(*[f'{entidade}:{entidade_id}' for entidade_id in ids])
+
+def responder_com_cache(chave, carregar):
+    # Serve o dict serializado do cache (ou carrega do banco) com ETag; If-None-Match -> 304.
+    # Retorna None quando a entidade não existe.
+    cache = obter_cache()
+    entrada = cache.obter(chave)
+    if entrada is None:
+        dados = carregar()
+        if dados is None:
+            return None
+        etag = hashlib.sha1(json.dumps(dados, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+        entrada = {'dados': dados, 'etag': etag}
+        cache.definir(chave, entrada)
+
+    if request.if_none_match.contains(entrada['etag']):
+        response = Response(status=304)
+    else:
+        response = jsonify(entrada['dados'])
+    response.set_etag(entrada['etag'])
+    return response
+
+# --- Idempotência (Idempotency-Key) e Detecção de Duplicados ---
+class ArmazemIdempotenciaMemoria:
+    # Travas (IDEMPOTENCIA_TRAVA_SEGUNDOS) e respostas (IDEMPOTENCIA_TTL_SEGUNDOS) em dicts separados: com um
+    # único prazo por dict, a ordem de inserção é a ordem de expiração e a limpeza para no primeiro item válido
+    def __init__(self, max_chaves, ttl, trava):
+        self._em_andamento = OrderedDict() # chave -> (expira_em, impressao)
+        self._respostas = OrderedDict() # chave -> (expira_em, impressao, registro)
+        self._lock = threading.Lock()
+        self._max_chaves = max_chaves
+        self._ttl = ttl
+        self._trava = trava
+
+    def _expirar(self, itens, agora):
+        while itens and (len(itens) > self._max_chaves or next(iter(itens.values()))[0] < agora):
+            itens.popitem(last=False)
+
+    def reservar(self, chave, impressao):
+        # None se a chave foi reservada agora; senão (impressao, registro) de quem chegou antes (registro None = em andamento)
+        with self._lock:
+            agora = time.monotonic()
+            self._expirar(self._respostas, agora)
+            self._expirar(self._em_andamento, agora)
+            item = self._respostas.get(chave)
+            if item is not None:
+                return item[1], item[2]
+            item = self._em_andamento.get(chave)
+            if item is not None:
+                return item[1], None
+            self._em_andamento[chave] = (agora + self._trava, impressao)
+            return None
+
+    def concluir(self, chave, impressao, registro):
+        with self._lock:
+            self._em_andamento.pop(chave, None)
+            self._respostas.pop(chave, None)
+            self._respostas[chave] = (time.monotonic() + self._ttl, impressao, registro)
+            self._expirar(self._respostas, time.monotonic())
+
+    def liberar(self, chave):
+        with self._lock:
+            self._em_andamento.pop(chave, None)
+
+class ArmazemIdempotenciaRedis:
+    # SET NX garante que só uma requisição por chave executa, mesmo entre workers e servidores
+    def __init__(self, url, ttl, trava):
+        import redis # Dependência opcional, só necessária com IDEMPOTENCIA_BACKEND=redis
+        self._cliente = redis.Redis.from_url(url)
+        self._ttl = ttl
+        self._trava = trava
+
+    def reservar(self, chave, impressao):
+        while True:
+            if self._cliente.set(chave, json.dumps({'impressao': impressao, 'registro': None}), nx=True, ex=self._trava):
+                return None
+            valor = self._cliente.get(chave)
+            if valor is not None: # Senão expirou entre o SET e o GET: tenta reservar de novo
+                item = json.loads(valor)
+                return item['impressao'], item['registro']
+
+    def concluir(self, chave, impressao, registro):
+        self._cliente.setex(chave, self._ttl, json.dumps({'impressao': impressao, 'registro': registro}))
+
+    def liberar(self, chave):
+        self._cliente.delete(chave)
+
+_armazem_idempotencia = None
+
+def obter_armazem_idempotencia():
+    global _armazem_idempotencia
+    if _armazem_idempotencia is None:
+        ttl, trava = current_app.config['IDEMPOTENCIA_TTL_SEGUNDOS'], current_app.config['IDEMPOTENCIA_TRAVA_SEGUNDOS']
+        if current_app.config['IDEMPOTENCIA_BACKEND'] == 'redis':
+            _armazem_idempotencia = ArmazemIdempotenciaRedis(current_app.config['IDEMPOTENCIA_REDIS_URL'], ttl, trava)
+        else:
+            _armazem_idempotencia = ArmazemIdempotenciaMemoria(current_app.config['IDEMPOTENCIA_MAX_CHAVES'], ttl, trava)
+    return _armazem_idempotencia
+
+def idempotente(funcao):
+    # Com o cabeçalho Idempotency-Key a rota executa uma única vez por usuário e chave: repetições recebem a
+    # resposta original sem tocar no banco. Usar abaixo de @jwt_required(); sem o cabeçalho nada muda.
+    # Com o journal, a resposta guardada é o 202: a repetição devolve a mesma sequência, e o resultado final
+    # (aplicada ou rejeitada) se consulta em /movimentacoes/journal/<seq>, não com um novo POST.
+    @functools.wraps(funcao)
+    def wrapper(*args, **kwargs):
+        chave_cliente = request.headers.get('Idempotency-Key')
+        if not chave_cliente:
+            return funcao(*args, **kwargs)
+        if len(chave_cliente) > 255:
+            return jsonify({"message": "Idempotency-Key deve ter no máximo 255 caracteres."}), 400
+
+        chave = 'idempotencia:' + hashlib.sha256(
+            f'{get_jwt_identity()}:{request.method}:{request.path}:{chave_cliente}'.encode('utf-8')
+        ).hexdigest()
+        impressao = hashlib.sha256(request.query_string + b'?' + request.get_data()).hexdigest()
+        armazem = obter_armazem_idempotencia()
+
+        existente = armazem.reservar(chave, impressao)
+        if existente is not None:
+            impressao_original, registro = existente
+            if impressao_original != impressao:
+                return jsonify({"message": "Idempotency-Key já usada com outra requisição. Gere uma nova chave."}), 422
+            if registro is None:
+                response = jsonify({"message": "Requisição com esta Idempotency-Key ainda em processamento."})
+                response.status_code = 409
+                response.headers['Retry-After'] = '1'
+                return response
+            response = Response(registro['corpo'], status=registro['status'], mimetype=registro['mimetype'])
+            response.headers['Idempotent-Replayed'] = 'true'
+            return response
+
+        try:
+            response = current_app.make_response(funcao(*args, **kwargs))
+        except Exception:
+            armazem.liberar(chave)
+            raise
+        if response.status_code >= 500:
+            armazem.liberar(chave) # Falha do servidor: o cliente pode repetir com a mesma chave
+        else:
+            armazem.concluir(chave, impressao, {
+                'status': response.status_code, 'corpo': response.get_data(as_text=True), 'mimetype': response.mimetype
+            })
+        return response
+    return wrapper
+
+def campo_duplicado(modelo, valores, ignorar_id=None):
+    # Depois de um IntegrityError (e do rollback), descobre no próprio banco qual coluna única colidiu,
+    # sem depender do texto do erro, que muda com o dialeto/driver. `valores` deve ser lido antes do commit.
+    for campo, valor in valores.items():
+        if valor is None:
+            continue
+        query = db.session.query(modelo.id).filter(getattr(modelo, campo) == valor)
+        if ignorar_id is not None:
+            query = query.filter(modelo.id != ignorar_id)
+        if db.session.query(query.exists()).scalar():
+            return campo
+    return None
+
+# --- Execução da Autenticação (pool do bcrypt e limite de tentativas) ---
+class AutenticacaoSobrecarregada(Exception):
+    pass
+
+_auth_executor = None
+_auth_vagas = None
+_auth_lock = threading.Lock()
+
+def executar_auth(funcao, *args):
+    # Pool próprio e limitado: uma rajada de logins ocupa no máximo AUTH_MAX_WORKERS núcleos
+    # e, além de AUTH_FILA_MAX pedidos em espera, é recusada em vez de segurar os workers HTTP
+    global _auth_executor, _auth_vagas
+    if _auth_executor is None:
+        with _auth_lock:
+            if _auth_executor is None:
+                _auth_vagas = threading.BoundedSemaphore(current_app.config['AUTH_MAX_WORKERS'] + current_app.config['AUTH_FILA_MAX'])
+                _auth_executor = ThreadPoolExecutor(max_workers=current_app.config['AUTH_MAX_WORKERS'], thread_name_prefix='auth')
+
+    if not _auth_vagas.acquire(blocking=False):
+        raise AutenticacaoSobrecarregada()
+    try:
+        futuro = _auth_executor.submit(funcao, *args)
+    except Exception:
+        _auth_vagas.release()
+        raise
+    futuro.add_done_callback(lambda _: _auth_vagas.release())
+    try:
+        return futuro.result(timeout=current_app.config['AUTH_TIMEOUT_SEGUNDOS'])
+    except FuturoTimeoutError:
+        # Fila cheia por mais que AUTH_TIMEOUT_SEGUNDOS: o pedido ainda na fila é descartado (libera a vaga)
+        # e a rota responde 503, como na recusa imediata
+        futuro.cancel()
+        raise AutenticacaoSobrecarregada()
+
+class LimitadorTentativas:
+    # Janela deslizante de falhas por chave (conta ou IP), em memória do processo
+    def __init__(self):
+        self._falhas = defaultdict(deque)
+        self._lock = threading.Lock()
+
+    def _podar(self, falhas, agora, janela):
+        while falhas and falhas[0] <= agora - janela:
+            falhas.popleft()
+
+    def espera(self, chave, limite, janela):
+        # Segundos até a próxima tentativa permitida (0 = liberado)
+        agora = time.monotonic()
+        with self._lock:
+            falhas = self._falhas.get(chave)
+            if not falhas:
+                return 0
+            self._podar(falhas, agora, janela)
+            if len(falhas) < limite:
+                return 0
+            return int(falhas[0] + janela - agora) + 1
+
+    def registrar_falha(self, chave, janela):
+        agora = time.monotonic()
+        with self._lock:
+            falhas = self._falhas[chave]
+            self._podar(falhas, agora, janela)
+            falhas.append(agora)
+            if len(self._falhas) > 100000:
+                for outra in [k for k, f in self._falhas.items() if not f or f[-1] <= agora - janela]:
+                    del self._falhas[outra]
+
+    def limpar(self, chave):
+        with self._lock:
+            self._falhas.pop(chave, None)
+
+limitador_login = LimitadorTentativas()
+
+# --- Identidade JWT (claims no token + cache de versão para revogação) ---
+_versoes_token = {} # user_id -> (token_versao, expira_em)
+_versoes_token_lock = threading.Lock()
+
+def claims_usuario(user):
+    return {'username': user.username, 'papel': user.papel, 'ver': user.token_versao}
+
+def versao_token_usuario(user_id):
+    # Única consulta do caminho de autorização, e só quando o cache expira; None = usuário removido
+    agora = time.monotonic()
+    item = _versoes_token.get(user_id)
+    if item is not None and item[1] > agora:
+        return item[0]
+    versao = db.session.query(User.token_versao).filter(User.id == user_id).scalar()
+    with _versoes_token_lock:
+        _versoes_token[user_id] = (versao, agora + current_app.config['USUARIO_CACHE_TTL_SEGUNDOS'])
+    return versao
+
+def esquecer_versao_token(user_id):
+    with _versoes_token_lock:
+        _versoes_token.pop(user_id, None)
+
+@jwt.token_in_blocklist_loader
+def _token_revogado(jwt_header, jwt_payload):
+    try:
+        user_id = int(jwt_payload['sub'])
+    except (KeyError, TypeError, ValueError):
+        return True
+    versao = versao_token_usuario(user_id)
+    return versao is None or jwt_payload.get('ver') != versao
+
+def usuario_atual():
+    # Usuário autenticado a partir das claims do token, sem consultar o banco
+    claims = get_jwt()
+    return {'id': int(get_jwt_identity()), 'username': claims.get('username'), 'papel': claims.get('papel')}
+
 # --- Rotas de Autenticação ---
-@app.route('/register', methods=['POST'])
+@api.route('/register', methods=['POST'])
 def register_user():
     data = request.get_json()
     username = data.get('username')
@@ -239,7 +1680,10 @@ def register_user():
         return jsonify({"message": "Email já registrado."}), 409
 
     new_user = User(username=username, email=email)
-    new_user.set_password(password)
+    try:
+        new_user.set_password(password)
+    except AutenticacaoSobrecarregada:
+        return jsonify({"message": "Serviço de autenticação ocupado. Tente novamente em instantes."}), 503, {'Retry-After': '1'}
 
     try:
         db.session.add(new_user)
@@ -249,44 +1693,387 @@ def register_user():
         db.session.rollback()
         return jsonify({"message": f"Erro ao registrar usuário: {str(e)}"}), 500
 
-@app.route('/login', methods=['POST'])
+@api.route('/login', methods=['POST'])
 def login():
     data = request.get_json()
     email = data.get('email')
     password = data.get('password')
 
-    # Remova as linhas de print de depuração em produção
-    print(f"Tentativa de login para o email: {email}")
-    print(f"Senha recebida: {password}")
-
     if not email or not password:
         return jsonify({'message': 'Email e senha são obrigatórios.'}), 400
 
+    janela = current_app.config['LOGIN_JANELA_SEGUNDOS']
+    chave_conta, chave_ip = ('conta', email.lower()), ('ip', request.remote_addr)
+    espera = max(
+        limitador_login.espera(chave_conta, current_app.config['LOGIN_MAX_FALHAS_CONTA'], janela),
+        limitador_login.espera(chave_ip, current_app.config['LOGIN_MAX_FALHAS_IP'], janela)
+    )
+    if espera:
+        return jsonify({'message': 'Muitas tentativas de login. Tente novamente mais tarde.'}), 429, {'Retry-After': str(espera)}
+
     user = User.query.filter_by(email=email).first()
 
-    if user and user.check_password(password):
+    try:
+        senha_valida = user is not None and user.check_password(password)
+    except AutenticacaoSobrecarregada:
+        return jsonify({'message': 'Serviço de autenticação ocupado. Tente novamente em instantes.'}), 503, {'Retry-After': '1'}
+
+    if senha_valida:
+        limitador_login.limpar(chave_conta)
+        if user.precisa_rehash():
+            try:
+                user.set_password(password)
+                db.session.commit()
+            except Exception:
+                db.session.rollback() # O login segue válido; o rehash fica para a próxima vez
+
         # Gerar o token de acesso JWT
-        access_token = create_access_token(identity=user.id) # 'identity' pode ser o ID do usuário
-        print("Login bem-sucedido. Token gerado.") # DEBUG
-        return jsonify({'message': 'Login realizado com sucesso!', 'token': access_token, 'username': user.username}), 200
+        # Claims do usuário embutidas no token: as rotas autorizam sem buscar o usuário no banco
+        access_token = create_access_token(identity=str(user.id), additional_claims=claims_usuario(user))
+        refresh_token = create_refresh_token(identity=str(user.id), additional_claims=claims_usuario(user))
+        logger.info('login_ok usuario_id=%s', user.id)
+        return jsonify({'message': 'Login realizado com sucesso!', 'token': access_token, 'refresh_token': refresh_token, 'username': user.username}), 200
     else:
-        print("Credenciais inválidas.") # DEBUG
+        limitador_login.registrar_falha(chave_conta, janela)
+        limitador_login.registrar_falha(chave_ip, janela)
+        logger.info('login_falhou ip=%s', request.remote_addr) # Nunca registrar a senha
         return jsonify({'message': 'Credenciais inválidas.'}), 401
 
+@api.cli.command('medir-autenticacao')
+@click.option('--threads', default=16, show_default=True, help='Clientes fazendo login sem parar.')
+@click.option('--movimentacoes', default=200, show_default=True, help='Movimentações medidas em cada fase.')
+def medir_autenticacao_command(threads, movimentacoes):
+    # Latência das movimentações em repouso e durante uma tempestade de logins (pool do bcrypt limitado a
+    # AUTH_MAX_WORKERS; o excedente recebe 503), num processo novo com SQLite temporário
+    import benchmarks
+    medicao = benchmarks.executar('autenticacao', threads, movimentacoes, log_level='ERROR')
+    print(f"movimentações em repouso: p50={medicao['repouso_p50_ms']:.1f}ms p99={medicao['repouso_p99_ms']:.1f}ms")
+    print(f"movimentações na tempestade: p50={medicao['tempestade_p50_ms']:.1f}ms p99={medicao['tempestade_p99_ms']:.1f}ms")
+    print(f"logins: {medicao['logins_por_segundo']:.1f}/s aceitos, por status {medicao['logins']}")
+
 # --- Rota Protegida (para teste) ---
-@app.route('/protected', methods=['GET'])
+@api.route('/protected', methods=['GET'])
 @jwt_required() # Protege esta rota
 def protected():
-    current_user_id = get_jwt_identity() # Obtém a identidade do token (o user.id)
-    user = User.query.get(current_user_id)
-    if user:
-        return jsonify({'message': f'Bem-vindo, {user.username}! Você acessou uma rota protegida.', 'user_id': current_user_id}), 200
-    return jsonify({'message': 'Usuário não encontrado.'}), 404
+    user = usuario_atual() # Identidade e claims vêm do token, sem consulta ao banco
+    return jsonify({'message': f'Bem-vindo, {user["username"]}! Você acessou uma rota protegida.', 'user_id': user['id']}), 200
+
+@api.route('/token/refresh', methods=['POST'])
+@jwt_required(refresh=True) # Exige o refresh token
+def refresh_token():
+    # Papel e versão vêm do banco, não do refresh token: uma mudança de papel vale no próximo refresh e
+    # um refresh de versão antiga não renova o acesso enquanto o cache da versão não expira
+    user = db.session.get(User, int(get_jwt_identity()))
+    if user is None or user.token_versao != get_jwt().get('ver'):
+        return jsonify({'message': 'Token revogado.'}), 401
+    access_token = create_access_token(identity=str(user.id), additional_claims=claims_usuario(user))
+    return jsonify({'token': access_token}), 200
+
+@api.route('/logout-todos', methods=['POST'])
+@jwt_required() # Revoga todos os tokens do usuário autenticado
+def logout_todos():
+    user_id = usuario_atual()['id']
+    try:
+        db.session.execute(
+            update(User).where(User.id == user_id).values(token_versao=User.token_versao + 1)
+            .execution_options(synchronize_session=False)
+        )
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'message': f'Erro ao revogar tokens: {str(e)}'}), 500
+    esquecer_versao_token(user_id)
+    return jsonify({'message': 'Todos os tokens deste usuário foram revogados.'}), 200
+
+
+# --- Índice de Busca (trigramas em memória) ---
+def _normalizar_busca(texto):
+    # Minúsculas e sem acentos: "Parafuso Sextavado" e "parafuso sextavádo" são equivalentes
+    texto = unicodedata.normalize('NFKD', str(texto or '')).encode('ascii', 'ignore').decode('ascii').lower()
+    return ' '.join(texto.split())
+
+def _trigramas(texto):
+    return {texto[i:i + 3] for i in range(len(texto) - 2)}
+
+class IndiceBuscaTrigramas:
+    # Índice invertido trigrama -> ids. A busca por substring intersecta as listas do termo e
+    # confirma o resultado; sem nenhuma correspondência, cai para similaridade de trigramas.
+    def __init__(self, linhas):
+        self._lock = threading.Lock()
+        self._documentos = {}
+        self._indice = defaultdict(set)
+        for doc_id, *valores in linhas:
+            self._inserir(doc_id, valores)
+        self.carregado_em = time.monotonic()
+
+    def _inserir(self, doc_id, valores):
+        campos = tuple(_normalizar_busca(valor) for valor in valores)
+        self._documentos[doc_id] = campos
+        for campo in campos:
+            for trigrama in _trigramas(f' {campo} '):
+                self._indice[trigrama].add(doc_id)
+
+    def _remover(self, doc_id):
+        campos = self._documentos.pop(doc_id, None)
+        if campos is None:
+            return
+        for campo in campos:
+            for trigrama in _trigramas(f' {campo} '):
+                ids = self._indice.get(trigrama)
+                if ids is not None:
+                    ids.discard(doc_id)
+                    if not ids:
+                        del self._indice[trigrama]
+
+    def atualizar(self, doc_id, valores):
+        with self._lock:
+            self._remover(doc_id)
+            if valores is not None:
+                self._inserir(doc_id, valores)
+
+    def _pontuar(self, termo, campos):
+        # Campos na ordem (nome, código/documento): igualdade no código > prefixo > substring
+        nome, codigo = campos[0], campos[1] if len(campos) > 1 else ''
+        if codigo == termo:
+            return 100
+        if codigo.startswith(termo):
+            return 80
+        if nome.startswith(termo) or f' {termo}' in nome:
+            return 60
+        if termo in nome or termo in codigo:
+            return 40
+        return 0
+
+    def buscar(self, termo, similaridade_minima, limite=None):
+        # Documentos encontrados, do mais para o menos relevante; com `limite`, só os `limite` primeiros
+        termo = _normalizar_busca(termo)
+        if not termo:
+            return []
+
+        with self._lock:
+            trigramas_termo = _trigramas(termo)
+            if trigramas_termo:
+                listas = sorted((self._indice.get(t, set()) for t in trigramas_termo), key=len)
+                candidatos = set(listas[0]).intersection(*listas[1:])
+            else:
+                candidatos = self._documentos.keys() # Termos de 1-2 caracteres: varredura em memória
+
+            pontuados = []
+            for doc_id in candidatos:
+                pontos = self._pontuar(termo, self._documentos[doc_id])
+                if pontos:
+                    pontuados.append((-pontos, self._documentos[doc_id][0], doc_id))
+
+            if not pontuados and len(termo) >= 3:
+                # Busca aproximada (erros de digitação): fração dos trigramas do termo presentes no documento
+                trigramas_aproximados = _trigramas(f' {termo} ')
+                ocorrencias = Counter()
+                for trigrama in trigramas_aproximados:
+                    ocorrencias.update(self._indice.get(trigrama, ()))
+                for doc_id, total in ocorrencias.items():
+                    similaridade = total / len(trigramas_aproximados)
+                    if similaridade >= similaridade_minima:
+                        pontuados.append((-20 * similaridade, self._documentos[doc_id][0], doc_id))
+
+        if limite is not None and len(pontuados) > limite:
+            pontuados = heapq.nsmallest(limite, pontuados) # Sem ordenar a cauda que fica de fora
+        else:
+            pontuados.sort()
+        return [doc_id for _, _, doc_id in pontuados]
+
+# Entidades com busca textual: modelo e colunas indexadas (nome primeiro, código/documento depois)
+ENTIDADES_BUSCA = {
+    'produtos': ('Produto', ['nome', 'codigo']),
+    'fornecedores': ('Fornecedor', ['nome', 'cnpj']),
+    'clientes': ('Cliente', ['nome', 'cpf']),
+}
+BACKENDS_BUSCA = {'trigramas': IndiceBuscaTrigramas}
+
+_indices_busca = {}
+_indices_busca_lock = threading.Lock()
+_indices_em_recarga = set()
+
+def _modelo_busca(entidade):
+    nome_modelo, colunas = ENTIDADES_BUSCA[entidade]
+    modelo = globals()[nome_modelo]
+    return modelo, [getattr(modelo, coluna) for coluna in colunas]
+
+def _construir_indice_busca(entidade):
+    modelo, colunas = _modelo_busca(entidade)
+    linhas = db.session.query(modelo.id, *colunas).execution_options(stream_results=True).yield_per(10000)
+    return BACKENDS_BUSCA[current_app.config['BUSCA_BACKEND']](linhas)
+
+def _recarregar_indice_em_segundo_plano(flask_app, entidade):
+    try:
+        with flask_app.app_context():
+            indice = _construir_indice_busca(entidade)
+            with _indices_busca_lock:
+                _indices_busca[entidade] = indice
+    except Exception:
+        logger.exception("Erro ao recarregar o índice de busca de %s", entidade)
+    finally:
+        _indices_em_recarga.discard(entidade)
+
+def obter_indice_busca(entidade):
+    indice = _indices_busca.get(entidade)
+    if indice is None:
+        with _indices_busca_lock:
+            indice = _indices_busca.get(entidade)
+            if indice is None:
+                indice = _indices_busca[entidade] = _construir_indice_busca(entidade)
+    elif (current_app.config['BUSCA_RECARREGAR_SEGUNDOS'] > 0
+          and time.monotonic() - indice.carregado_em > current_app.config['BUSCA_RECARREGAR_SEGUNDOS']
+          and entidade not in _indices_em_recarga):
+        # Índice antigo continua respondendo enquanto o novo é construído
+        _indices_em_recarga.add(entidade)
+        threading.Thread(target=_recarregar_indice_em_segundo_plano, args=(current_app._get_current_object(), entidade), daemon=True).start()
+    return indice
+
+def filtrar_busca(query, entidade, termo):
+    # Substitui o ILIKE '%termo%' (sempre full scan) pelos ids vindos do índice, limitados aos BUSCA_MAX_RESULTADOS
+    # mais relevantes: um termo curto ou comum não vira um IN com o catálogo inteiro. Totais, cursores e exportação
+    # enxergam esse mesmo conjunto. Os ids vão literais no IN (sem um parâmetro por id, que estoura o limite do
+    # SQLite); a ordem de relevância segue junto com a consulta e é aplicada por paginar()
+    modelo, colunas = _modelo_busca(entidade)
+    if current_app.config['BUSCA_BACKEND'] not in BACKENDS_BUSCA:
+        return query.filter(or_(*[coluna.ilike(f'%{termo}%') for coluna in colunas]))
+
+    ids = obter_indice_busca(entidade).buscar(termo, current_app.config['BUSCA_SIMILARIDADE_MINIMA'], current_app.config['BUSCA_MAX_RESULTADOS'])
+    return query.filter(
+        modelo.id.in_(bindparam('ids_busca', ids, expanding=True, literal_execute=True))
+    ).execution_options(ranking_busca=(modelo.id, ids))
+
+class PaginacaoRelevancia(Pagination):
+    # Página na ordem de relevância do índice de busca: o SQL só confirma quais ids passam nos demais filtros
+    # (uma consulta só de ids) e carrega as linhas da página
+    def _ids_filtrados(self):
+        if not hasattr(self, '_filtrados'):
+            query, coluna_id, ids = self._query_args['query'], self._query_args['coluna_id'], self._query_args['ids']
+            encontrados = {linha[0] for linha in query.order_by(None).with_entities(coluna_id)} if ids else set()
+            self._filtrados = [doc_id for doc_id in ids if doc_id in encontrados]
+        return self._filtrados
+
+    def _query_items(self):
+        pagina = self._ids_filtrados()[self._query_offset:self._query_offset + self.per_page]
+        if not pagina:
+            return []
+        query, coluna_id = self._query_args['query'], self._query_args['coluna_id']
+        posicoes = {doc_id: posicao for posicao, doc_id in enumerate(pagina)}
+        linhas = query.order_by(None).filter(coluna_id.in_(pagina)).all()
+        return sorted(linhas, key=lambda linha: posicoes[linha.id])
+
+    def _query_count(self):
+        return len(self._ids_filtrados())
+
+def paginar(query, page, per_page):
+    # query.paginate(), respeitando a relevância quando a consulta veio de filtrar_busca()
+    ranking = query.get_execution_options().get('ranking_busca')
+    if ranking is None:
+        return query.paginate(page=page, per_page=per_page, error_out=False)
+    coluna_id, ids = ranking
+    return PaginacaoRelevancia(page=page, per_page=per_page, max_per_page=None, error_out=False, query=query, coluna_id=coluna_id, ids=ids)
+
+# Sincronização do índice: alterações coletadas no flush e aplicadas só depois do commit
+@event.listens_for(SessionORM, 'after_flush')
+def _coletar_alteracoes_busca(session, flush_context):
+    pendentes = session.info.setdefault('busca_pendente', [])
+    for entidade, (nome_modelo, colunas) in ENTIDADES_BUSCA.items():
+        modelo = globals()[nome_modelo]
+        for obj in list(session.new) + list(session.dirty):
+            if isinstance(obj, modelo):
+                pendentes.append((entidade, obj.id, [getattr(obj, coluna) for coluna in colunas]))
+        for obj in session.deleted:
+            if isinstance(obj, modelo):
+                pendentes.append((entidade, obj.id, None))
+
+@event.listens_for(SessionORM, 'after_commit')
+def _aplicar_alteracoes_busca(session):
+    for entidade, doc_id, valores in session.info.pop('busca_pendente', []):
+        indice = _indices_busca.get(entidade)
+        if indice is not None:
+            indice.atualizar(doc_id, valores)
+
+@event.listens_for(SessionORM, 'after_rollback')
+def _descartar_alteracoes_busca(session):
+    session.info.pop('busca_pendente', None)
+
+# --- Filtros compartilhados entre listagens e exportação ---
+def _filtrar_produtos(query):
+    search_term = request.args.get('search', type=str)
+    stock_status = request.args.get('stock_status', type=str)
+    unidade_medida_filter = request.args.get('unidade_medida', type=str)
+    fornecedor_id_filter = request.args.get('fornecedor_id', type=int)
+
+    if search_term:
+        query = filtrar_busca(query, 'produtos', search_term)
+
+    if stock_status:
+        if stock_status in ('baixo', 'em_falta'):
+            query = query.filter(filtro_situacao_estoque(stock_status))
+        elif stock_status == 'disponivel':
+            query = query.filter(Produto.estoque_baixo == False, Produto.estoque_atual > 0)
+
+    if unidade_medida_filter:
+        query = query.filter(Produto.unidade_medida.ilike(f'%{unidade_medida_filter}%'))
+
+    if fornecedor_id_filter:
+        query = query.filter_by(fornecedor_id=fornecedor_id_filter)
+
+    return query
 
+def _filtrar_movimentacoes(query, modelo=Movimentacao):
+    # Lança ValueError com a mensagem para o cliente quando uma data é inválida. `modelo` também pode ser
+    # MovimentacaoArquivada: os mesmos filtros valem para o arquivo
+    produto_id_filter = request.args.get('produto_id', type=int)
+    tipo_movimentacao_filter = request.args.get('tipo', type=str)
+    start_date_filter = request.args.get('start_date', type=str)
+    end_date_filter = request.args.get('end_date', type=str)
+    cliente_id_filter = request.args.get('cliente_id', type=int)
+    deposito_id_filter = request.args.get('deposito_id', type=int)
+
+    if produto_id_filter:
+        query = query.filter_by(produto_id=produto_id_filter)
+    if deposito_id_filter:
+        query = query.filter(modelo.deposito_id == deposito_id_filter)
+    if tipo_movimentacao_filter:
+        query = query.filter_by(tipo_movimentacao=tipo_movimentacao_filter)
+
+    if start_date_filter:
+        try:
+            start_dt = datetime.fromisoformat(start_date_filter)
+        except ValueError:
+            raise ValueError("Formato de data de início inválido. UseYYYY-MM-DD.")
+        query = query.filter(modelo.data_hora >= start_dt)
+
+    if end_date_filter:
+        try:
+            end_dt = datetime.fromisoformat(end_date_filter)
+        except ValueError:
+            raise ValueError("Formato de data de fim inválido. UseYYYY-MM-DD.")
+        end_dt = end_dt.replace(hour=23, minute=59, second=59, microsecond=999999)
+        query = query.filter(modelo.data_hora <= end_dt)
+
+    if cliente_id_filter:
+        query = query.filter_by(cliente_id=cliente_id_filter)
+
+    return query
+
+def _filtrar_fornecedores(query):
+    search_term = request.args.get('search', type=str)
+    if search_term:
+        query = filtrar_busca(query, 'fornecedores', search_term)
+    return query
+
+def _filtrar_clientes(query):
+    search_term = request.args.get('search', type=str)
+    if search_term:
+        query = filtrar_busca(query, 'clientes', search_term)
+    return query
 
 # --- Rotas da API (Produto) ---
-@app.route('/produtos', methods=['POST'])
+@api.route('/produtos', methods=['POST'])
 @jwt_required() # Protege a rota de adicionar produto
+@idempotente
 def add_produto():
     data = request.get_json()
 
@@ -299,6 +2086,10 @@ def add_produto():
     except InvalidOperation:
         return jsonify({"message": "Preço de compra ou venda inválido."}), 400
 
+    deposito_id = data.get('deposito_id') or DEPOSITO_PADRAO_ID # Depósito do estoque inicial
+    if not deposito_ativo(deposito_id):
+        return jsonify({"message": "Depósito não encontrado ou inativo."}), 400
+
     icms_aliquota = Decimal(str(data.get('icms_aliquota', 0)))
     icms_valor = calculate_tax_value(preco_venda, icms_aliquota)
 
@@ -348,50 +2139,45 @@ def add_produto():
 
     try:
         db.session.add(novo_produto)
+        db.session.flush()
+        if novo_produto.estoque_atual:
+            ajustar_estoque_deposito(novo_produto.id, deposito_id, novo_produto.estoque_atual)
+        ajustar_resumo(variacao_resumo_produto(None, (novo_produto.estoque_atual, novo_produto.estoque_minimo)))
+        registrar_evento_estoque(novo_produto.id, None, (novo_produto.estoque_atual, novo_produto.estoque_minimo), novo_produto)
         db.session.commit()
         return jsonify({"message": "Produto adicionado com sucesso!", "produto": novo_produto.to_dict()}), 201
+    except EstoqueInsuficiente:
+        db.session.rollback()
+        return jsonify({"message": "Estoque inicial não pode ser negativo."}), 400
+    except IntegrityError as e:
+        db.session.rollback()
+        if campo_duplicado(Produto, {'codigo': data['codigo']}):
+            return jsonify({"message": "Erro: Código de produto já existente. Por favor, use um código único."}), 409
+        return jsonify({"message": f"Erro ao adicionar produto: {str(e)}"}), 500
     except Exception as e:
         db.session.rollback()
-        if "Duplicate entry" in str(e) and "for key 'produtos.codigo'" in str(e):
-             return jsonify({"message": "Erro: Código de produto já existente. Por favor, use um código único."}), 409
         return jsonify({"message": f"Erro ao adicionar produto: {str(e)}"}), 500
 
-@app.route('/produtos', methods=['GET'])
+@api.route('/produtos', methods=['GET'])
 @jwt_required() # Protege a rota de listar produtos
+@rota_leitura
 def get_produtos():
-    query = Produto.query
-
-    search_term = request.args.get('search', type=str)
-    stock_status = request.args.get('stock_status', type=str)
-    unidade_medida_filter = request.args.get('unidade_medida', type=str)
-    fornecedor_id_filter = request.args.get('fornecedor_id', type=int)
+    query = _filtrar_produtos(Produto.query)
 
     page = request.args.get('page', 1, type=int)
     per_page = request.args.get('per_page', 10, type=int)
 
-    if search_term:
-        query = query.filter(
-            (Produto.nome.ilike(f'%{search_term}%')) |
-            (Produto.codigo.ilike(f'%{search_term}%'))
-        )
-
-    if stock_status:
-        if stock_status == 'baixo':
-            query = query.filter(Produto.estoque_atual <= Produto.estoque_minimo)
-        elif stock_status == 'em_falta':
-            query = query.filter(Produto.estoque_atual == 0)
-        elif stock_status == 'disponivel':
-            query = query.filter(Produto.estoque_atual > Produto.estoque_minimo, Produto.estoque_atual > 0)
-
-    if unidade_medida_filter:
-        query = query.filter(Produto.unidade_medida.ilike(f'%{unidade_medida_filter}%'))
+    try:
+        query, codificar = SERIALIZADORES['produtos'].aplicar(query, campos_solicitados())
+    except ValueError as e:
+        return jsonify({"message": str(e)}), 400
 
-    if fornecedor_id_filter:
-        query = query.filter_by(fornecedor_id=fornecedor_id_filter)
+    if 'cursor' in request.args:
+        return _resposta_por_cursor(query, [Produto.id], codificar)
 
-    paginated_products = query.paginate(page=page, per_page=per_page, error_out=False)
+    paginated_products = paginar(query, page, per_page)
 
-    produtos_json = [produto.to_dict() for produto in paginated_products.items]
+    produtos_json = [codificar(linha) for linha in paginated_products.items]
     
     return jsonify({
         'items': produtos_json,
@@ -403,109 +2189,1532 @@ def get_produtos():
         'has_prev': paginated_products.has_prev
     }), 200
 
-@app.route('/produtos/<int:produto_id>', methods=['GET'])
+@api.route('/produtos/recalcular-impostos', methods=['POST'])
+@jwt_required() # Protege a rota de recálculo de impostos em lote
+def recalcular_impostos():
+    # Corpo: {"regras": [{"ncm": ..., "cfop": ..., "cst_csosn": ..., "icms_aliquota": ..., ...}]}.
+    # Os seletores (ncm/cfop/cst_csosn) escolhem os produtos; as alíquotas informadas substituem as atuais.
+    # Toda regra precisa de ao menos um seletor: uma regra sem seletor reescreveria o catálogo inteiro.
+    data = request.get_json(silent=True)
+    regras = data.get('regras') if isinstance(data, dict) else None
+    if not isinstance(regras, list) or not regras or not all(isinstance(regra, dict) for regra in regras):
+        return jsonify({"message": "Informe ao menos uma regra de alíquotas em 'regras'."}), 400
+    for posicao, regra in enumerate(regras, start=1):
+        if all(regra.get(seletor) in (None, '') for seletor in ['ncm', 'cfop', 'cst_csosn']):
+            return jsonify({"message": f"A regra {posicao} precisa de ao menos um seletor (ncm, cfop ou cst_csosn)."}), 400
+
+    # Valida todas as regras antes de escrever qualquer uma
+    aliquotas_regras = []
+    for posicao, regra in enumerate(regras, start=1):
+        try:
+            aliquotas_regras.append({
+                imposto: Decimal(str(regra[f'{imposto}_aliquota']))
+                for imposto in IMPOSTOS if regra.get(f'{imposto}_aliquota') is not None
+            })
+        except InvalidOperation:
+            return jsonify({"message": f"Alíquota inválida na regra {posicao}."}), 400
+
+    # Uma única transação para todas as regras: os UPDATEs vão em chunks, mas uma falha não deixa o catálogo
+    # recalculado pela metade (as regras seguintes enxergam o que as anteriores gravaram)
+    tamanho_chunk = current_app.config['IMPOSTOS_LOTE_CHUNK']
+    resultado_regras = []
+    atualizados_ids = []
+    posicao = 0
+    try:
+        for posicao, (regra, novas_aliquotas) in enumerate(zip(regras, aliquotas_regras), start=1):
+            query = db.session.query(
+                Produto.id, Produto.preco_venda,
+                *[getattr(Produto, f'{imposto}_aliquota') for imposto in IMPOSTOS]
+            )
+            for seletor in ['ncm', 'cfop', 'cst_csosn']:
+                if regra.get(seletor) is not None:
+                    query = query.filter(getattr(Produto, seletor) == regra[seletor])
+
+            # Lê todas as linhas antes de escrever: o UPDATE em lote não pode disputar o cursor aberto
+            linhas = query.order_by(Produto.id).all()
+            atualizados = 0
+            lote = []
+            for valores in calcular_impostos_lote(linhas, novas_aliquotas):
+                lote.append(valores)
+                if len(lote) >= tamanho_chunk:
+                    db.session.execute(update(Produto), lote)
+                    atualizados_ids.extend(valores['id'] for valores in lote)
+                    atualizados += len(lote)
+                    lote = []
+            if lote:
+                db.session.execute(update(Produto), lote)
+                atualizados_ids.extend(valores['id'] for valores in lote)
+                atualizados += len(lote)
+            resultado_regras.append({'regra': posicao, 'produtos_atualizados': atualizados})
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({
+            "message": f"Erro ao recalcular impostos na regra {posicao}: {str(e)}. Nenhum produto foi alterado.",
+            "produtos_atualizados": 0
+        }), 500
+    invalidar_cache('produto', *set(atualizados_ids))
+    total_atualizados = sum(resultado['produtos_atualizados'] for resultado in resultado_regras)
+
+    return jsonify({
+        "message": f"Impostos recalculados para {total_atualizados} produtos.",
+        "produtos_atualizados": total_atualizados,
+        "regras": resultado_regras
+    }), 200
+
+@api.route('/produtos/<int:produto_id>', methods=['GET'])
 @jwt_required() # Protege a rota de obter produto por ID
 def get_produto(produto_id):
-    produto = Produto.query.get(produto_id)
-    if produto:
-        return jsonify(produto.to_dict()), 200
+    def carregar():
+        produto = Produto.query.get(produto_id)
+        return produto.to_dict() if produto else None
+
+    response = responder_com_cache(f'produto:{produto_id}', carregar)
+    if response is not None:
+        return response
     return jsonify({"message": "Produto não encontrado."}), 404
 
-@app.route('/produtos/<int:produto_id>', methods=['PUT'])
+@api.route('/produtos/<int:produto_id>', methods=['PUT'])
 @jwt_required() # Protege a rota de atualizar produto
 def update_produto(produto_id):
-    produto = Produto.query.get(produto_id)
-    if not produto:
-        return jsonify({"message": "Produto não encontrado."}), 404
-
     data = request.get_json()
     if not data:
         return jsonify({"message": "Nenhum dado fornecido para atualização."}), 400
 
-    produto.nome = data.get('nome', produto.nome)
-    produto.codigo = data.get('codigo', produto.codigo)
-    produto.descricao = data.get('descricao', produto.descricao)
-    produto.unidade_medida = data.get('unidade_medida', produto.unidade_medida)
-    produto.estoque_atual = data.get('estoque_atual', produto.estoque_atual)
-    produto.estoque_minimo = data.get('estoque_minimo', produto.estoque_minimo)
-    produto.localizacao = data.get('localizacao', produto.localizacao)
-    produto.info_adicionais_nf = data.get('info_adicionais_nf', produto.info_adicionais_nf)
+    deposito_ajuste_id = data.get('deposito_id') or DEPOSITO_PADRAO_ID # Depósito que absorve ajuste manual de estoque_atual
+    if not deposito_ativo(deposito_ajuste_id):
+        return jsonify({"message": "Depósito não encontrado ou inativo."}), 400
+    novo_estoque = data.get('estoque_atual')
+    if novo_estoque is not None and journal_em_outro_processo():
+        return _resposta_journal_em_outro_processo()
+    if not db.session.get(Produto, produto_id):
+        return jsonify({"message": "Produto não encontrado."}), 404
 
     try:
-        if 'preco_compra' in data and data['preco_compra'] is not None:
-            produto.preco_compra = Decimal(str(data['preco_compra']))
-        if 'preco_venda' in data and data['preco_venda'] is not None:
-            produto.preco_venda = Decimal(str(data['preco_venda']))
+        preco_compra = Decimal(str(data['preco_compra'])) if data.get('preco_compra') is not None else None
+        preco_venda = Decimal(str(data['preco_venda'])) if data.get('preco_venda') is not None else None
     except InvalidOperation:
         return jsonify({"message": "Preço de compra ou venda inválido na atualização."}), 400
-
-    current_preco_venda = produto.preco_venda
-
-    if 'ncm' in data: produto.ncm = data['ncm']
-    if 'cst_csosn' in data: produto.cst_csosn = data['cst_csosn']
-    if 'cfop' in data: produto.cfop = data['cfop']
-    if 'origem_mercadoria' in data: produto.origem_mercadoria = data['origem_mercadoria']
-
-    icms_aliquota_data = data.get('icms_aliquota')
-    if icms_aliquota_data is not None:
-        produto.icms_aliquota = Decimal(str(icms_aliquota_data))
-    produto.icms_valor = calculate_tax_value(current_preco_venda, produto.icms_aliquota)
-
-    ipi_aliquota_data = data.get('ipi_aliquota')
-    if ipi_aliquota_data is not None:
-        produto.ipi_aliquota = Decimal(str(ipi_aliquota_data))
-    produto.ipi_valor = calculate_tax_value(current_preco_venda, produto.ipi_aliquota)
-
-    pis_aliquota_data = data.get('pis_aliquota')
-    if pis_aliquota_data is not None:
-        produto.pis_aliquota = Decimal(str(pis_aliquota_data))
-    produto.pis_valor = calculate_tax_value(current_preco_venda, produto.pis_aliquota)
-
-    cofins_aliquota_data = data.get('cofins_aliquota')
-    if cofins_aliquota_data is not None:
-        produto.cofins_aliquota = Decimal(str(cofins_aliquota_data))
-    produto.cofins_valor = calculate_tax_value(current_preco_venda, produto.cofins_aliquota)
-
-    if 'fornecedor_id' in data:
-        if data['fornecedor_id'] is not None and data['fornecedor_id'] != '':
-            fornecedor = Fornecedor.query.get(data['fornecedor_id'])
-            if not fornecedor:
-                return jsonify({"message": "Fornecedor não encontrado com o ID fornecido."}), 400
-            produto.fornecedor_id = data['fornecedor_id']
-        else:
-            produto.fornecedor_id = None
-
+    if data.get('fornecedor_id') not in (None, '') and not db.session.get(Fornecedor, data['fornecedor_id']):
+        return jsonify({"message": "Fornecedor não encontrado com o ID fornecido."}), 400
+
+    def aplicar_campos(produto):
+        produto.nome = data.get('nome', produto.nome)
+        produto.codigo = data.get('codigo', produto.codigo)
+        produto.descricao = data.get('descricao', produto.descricao)
+        produto.unidade_medida = data.get('unidade_medida', produto.unidade_medida)
+        produto.estoque_minimo = data.get('estoque_minimo', produto.estoque_minimo)
+        produto.localizacao = data.get('localizacao', produto.localizacao)
+        produto.info_adicionais_nf = data.get('info_adicionais_nf', produto.info_adicionais_nf)
+        if preco_compra is not None:
+            produto.preco_compra = preco_compra
+        if preco_venda is not None:
+            produto.preco_venda = preco_venda
+
+        current_preco_venda = produto.preco_venda
+
+        if 'ncm' in data: produto.ncm = data['ncm']
+        if 'cst_csosn' in data: produto.cst_csosn = data['cst_csosn']
+        if 'cfop' in data: produto.cfop = data['cfop']
+        if 'origem_mercadoria' in data: produto.origem_mercadoria = data['origem_mercadoria']
+
+        icms_aliquota_data = data.get('icms_aliquota')
+        if icms_aliquota_data is not None:
+            produto.icms_aliquota = Decimal(str(icms_aliquota_data))
+        produto.icms_valor = calculate_tax_value(current_preco_venda, produto.icms_aliquota)
+
+        ipi_aliquota_data = data.get('ipi_aliquota')
+        if ipi_aliquota_data is not None:
+            produto.ipi_aliquota = Decimal(str(ipi_aliquota_data))
+        produto.ipi_valor = calculate_tax_value(current_preco_venda, produto.ipi_aliquota)
+
+        pis_aliquota_data = data.get('pis_aliquota')
+        if pis_aliquota_data is not None:
+            produto.pis_aliquota = Decimal(str(pis_aliquota_data))
+        produto.pis_valor = calculate_tax_value(current_preco_venda, produto.pis_aliquota)
+
+        cofins_aliquota_data = data.get('cofins_aliquota')
+        if cofins_aliquota_data is not None:
+            produto.cofins_aliquota = Decimal(str(cofins_aliquota_data))
+        produto.cofins_valor = calculate_tax_value(current_preco_venda, produto.cofins_aliquota)
+
+        if 'fornecedor_id' in data:
+            produto.fornecedor_id = data['fornecedor_id'] if data['fornecedor_id'] not in (None, '') else None
+
+    def atualizar():
+        if novo_estoque is not None:
+            # Mesma ordem das movimentações: saldo no journal, linha do depósito e só depois a do produto
+            # (a consolidação trava produtos sem tocar nos depósitos)
+            travar_saldos_journal([(produto_id, deposito_ajuste_id)])
+            db.session.query(EstoqueDeposito.estoque).filter_by(produto_id=produto_id, deposito_id=deposito_ajuste_id).with_for_update().all()
+            # estoque_atual pedido vale para o total nos depósitos (o agregado pode ter pendências); a diferença vai ao
+            # depósito do ajuste e, como ajuste manual sem movimentação, à consolidação
+            estoque_total = db.session.query(db.func.coalesce(db.func.sum(EstoqueDeposito.estoque), 0)).filter_by(produto_id=produto_id).scalar()
+            variacao = novo_estoque - estoque_total
+            if variacao:
+                ajustar_estoque_deposito(produto_id, deposito_ajuste_id, variacao)
+                registrar_pendencias_estoque([pendencia_estoque(produto_id, variacao)])
+
+        # Linha travada até o commit: a mudança de estoque_minimo (resumo, evento) parte do estoque consolidado atual,
+        # que a consolidação não altera enquanto isso
+        produto = Produto.query.filter_by(id=produto_id).with_for_update().populate_existing().first()
+        if not produto:
+            db.session.rollback()
+            return None
+        estoque_antes = (produto.estoque_atual, produto.estoque_minimo)
+        aplicar_campos(produto)
+        ajustar_resumo(variacao_resumo_produto(estoque_antes, (produto.estoque_atual, produto.estoque_minimo)))
+        if produto.estoque_minimo != estoque_antes[1]:
+            db.session.flush()
+            registrar_evento_estoque(produto.id, estoque_antes, (produto.estoque_atual, produto.estoque_minimo), produto)
+        db.session.commit()
+        return produto
 
     try:
-        db.session.commit()
-        return jsonify({"message": "Produto atualizado com sucesso!", "produto": produto.to_dict()}), 200
+        produto = _com_retentativas(atualizar)
+        if produto is None:
+            return jsonify({"message": "Produto não encontrado."}), 404
+        invalidar_cache('produto', produto_id)
+        resposta = produto.to_dict()
+        if novo_estoque is not None:
+            resposta['estoque_atual'] = novo_estoque
+        return jsonify({"message": "Produto atualizado com sucesso!", "produto": resposta}), 200
+    except EstoqueInsuficiente:
+        db.session.rollback()
+        return jsonify({"message": "O ajuste deixaria o depósito com saldo negativo. Ajuste o estoque por depósito."}), 400
+    except IntegrityError as e:
+        db.session.rollback()
+        if campo_duplicado(Produto, {'codigo': data.get('codigo')}, ignorar_id=produto_id):
+            return jsonify({"message": "Erro: Código de produto já existente. Por favor, use um código único."}), 409
+        return jsonify({"message": f"Erro ao atualizar produto: {str(e)}"}), 500
     except Exception as e:
         db.session.rollback()
-        if "Duplicate entry" in str(e) and "for key 'produtos.codigo'" in str(e):
-             return jsonify({"message": "Erro: Código de produto já existente. Por favor, use um código único."}), 409
         return jsonify({"message": f"Erro ao atualizar produto: {str(e)}"}), 500
 
 
-@app.route('/produtos/<int:produto_id>', methods=['DELETE'])
+@api.route('/produtos/<int:produto_id>', methods=['DELETE'])
 @jwt_required() # Protege a rota de deletar produto
 def delete_produto(produto_id):
     produto = Produto.query.get(produto_id)
     if not produto:
         return jsonify({"message": "Produto não encontrado."}), 404
+    if journal_em_outro_processo():
+        return _resposta_journal_em_outro_processo()
 
     try:
+        # Com o journal: nenhuma reserva nova para o produto até o commit, e nenhuma pendente pode ficar órfã
+        travar_saldos_journal([(produto_id, deposito_id) for (deposito_id,) in db.session.query(Deposito.id).all()])
+        if _journal_movimentacoes is not None and _journal_movimentacoes.tem_pendentes(produto_id):
+            db.session.rollback()
+            return jsonify({"message": "O produto tem movimentações ainda sendo aplicadas. Tente novamente em instantes."}), 409, {'Retry-After': '1'}
+        # Estoque consolidado travado: a consolidação não muda o status do produto entre a leitura e a exclusão
+        # (pendências do produto excluído são descartadas por ela)
+        db.session.refresh(produto, with_for_update=True)
+        ajustar_resumo(variacao_resumo_produto((produto.estoque_atual, produto.estoque_minimo), None))
+        registrar_evento_estoque(produto_id, (produto.estoque_atual, produto.estoque_minimo), None)
+        EstoqueDeposito.query.filter_by(produto_id=produto_id).delete(synchronize_session=False)
         db.session.delete(produto)
+        MovimentacaoRollup.query.filter_by(dimensao='produto', dimensao_id=produto_id).delete(synchronize_session=False)
         db.session.commit()
+        invalidar_cache('produto', produto_id)
         return jsonify({"message": "Produto excluído com sucesso!"}), 200
     except Exception as e:
         db.session.rollback()
         return jsonify({"message": f"Erro ao excluir produto: {str(e)}"}), 500
 
 
+# --- Atualização Concorrente de Estoque ---
+class EstoqueInsuficiente(Exception):
+    pass
+
+def ajustar_estoque_deposito(produto_id, deposito_id, delta):
+    # UPDATE atômico e condicional na linha (depósito, produto): o próprio banco garante que o saldo nunca fica
+    # negativo, sem ler o valor em Python e escrever de volta (lost update entre workers). Só movimentações do mesmo
+    # depósito disputam essa linha; o agregado do produto vai por registrar_pendencias_estoque.
+    query = update(EstoqueDeposito).where(EstoqueDeposito.deposito_id == deposito_id, EstoqueDeposito.produto_id == produto_id)
+    if delta < 0:
+        query = query.where(EstoqueDeposito.estoque >= -delta)
+    resultado = db.session.execute(
+        query.values(estoque=EstoqueDeposito.estoque + delta).execution_options(synchronize_session=False)
+    )
+    if resultado.rowcount:
+        if delta < 0 and _journal_movimentacoes is not None and not db.session.info.get('aplicando_journal'):
+            # Débito síncrono com o journal ativo: as movimentações já confirmadas (202) têm que continuar cabendo
+            _journal_movimentacoes.conferir_reservas(produto_id, deposito_id)
+        return
+    if delta < 0:
+        raise EstoqueInsuficiente(produto_id)
+    try:
+        with db.session.begin_nested(): # Primeira entrada do produto no depósito; outra transação pode criar a linha junto
+            db.session.execute(insert(EstoqueDeposito).values(deposito_id=deposito_id, produto_id=produto_id, estoque=delta))
+    except IntegrityError:
+        ajustar_estoque_deposito(produto_id, deposito_id, delta)
+
+def deposito_ativo(deposito_id):
+    deposito = db.session.get(Deposito, deposito_id)
+    return deposito if deposito is not None and deposito.ativo else None
+
+def _com_retentativas(operacao):
+    # Reexecuta a transação em caso de deadlock, lock wait timeout ou "database is locked",
+    # com backoff exponencial e jitter
+    tentativas = current_app.config['ESTOQUE_MAX_TENTATIVAS']
+    for tentativa in range(1, tentativas + 1):
+        try:
+            return operacao()
+        except OperationalError:
+            db.session.rollback()
+            if tentativa == tentativas:
+                raise
+            time.sleep(current_app.config['ESTOQUE_BACKOFF_BASE'] * (2 ** (tentativa - 1)) * (0.5 + random.random()))
+
+# --- Consolidação do Estoque Agregado ---
+# A escrita no depósito grava só a variação pendente (um INSERT, sem trava compartilhada); produtos.estoque_atual,
+# o resumo do dashboard, os eventos de estoque e os agregados por período são atualizados em lote pela consolidação.
+# Assim movimentações em depósitos diferentes do mesmo produto não disputam a linha do produto nem a do resumo.
+def pendencia_estoque(produto_id, variacao, tipo_movimentacao=None, quantidade=None, cliente_id=None, data_hora=None):
+    return {
+        'produto_id': produto_id, 'variacao': variacao, 'tipo_movimentacao': tipo_movimentacao, 'quantidade': quantidade,
+        'cliente_id': cliente_id, 'data_hora': data_hora or datetime.now()
+    }
+
+def pendencia_movimentacao(mov):
+    # mov: dict com produto_id, tipo_movimentacao, quantidade, cliente_id e data_hora
+    quantidade = mov['quantidade']
+    return pendencia_estoque(
+        mov['produto_id'], quantidade if mov['tipo_movimentacao'] == 'entrada' else -quantidade,
+        mov['tipo_movimentacao'], quantidade, mov.get('cliente_id'), mov['data_hora']
+    )
+
+def registrar_pendencias_estoque(pendencias):
+    # Na transação da escrita, junto com o ajuste dos depósitos
+    if pendencias:
+        db.session.execute(insert(EstoquePendente), pendencias)
+        db.session.info['estoque_pendente'] = True
+
+def estoque_pendente_subquery():
+    # (produto_id, variacao): soma por produto do que ainda não foi consolidado em estoque_atual
+    return select(
+        EstoquePendente.produto_id, db.func.sum(EstoquePendente.variacao).label('variacao')
+    ).group_by(EstoquePendente.produto_id).subquery()
+
+def _consolidar_lote_estoque(limite):
+    # SKIP LOCKED: processos diferentes consolidam lotes diferentes; as linhas dos produtos são travadas em ordem de id
+    pendencias = db.session.query(
+        EstoquePendente.id, EstoquePendente.produto_id, EstoquePendente.variacao, EstoquePendente.tipo_movimentacao,
+        EstoquePendente.quantidade, EstoquePendente.cliente_id, EstoquePendente.data_hora
+    ).order_by(EstoquePendente.id).limit(limite).with_for_update(skip_locked=True).all()
+    if not pendencias:
+        db.session.rollback()
+        return 0
+    # Remove antes de ler os produtos: no SQLite (sem FOR UPDATE) é o que abre a transação de escrita
+    tabela = EstoquePendente.__table__
+    removidas = db.session.execute(tabela.delete().where(tabela.c.id.in_([pendencia.id for pendencia in pendencias]))).rowcount
+    if removidas != len(pendencias):
+        # Banco sem SKIP LOCKED: outro processo consolidou parte do lote primeiro
+        db.session.rollback()
+        return 0
+
+    antes = {
+        produto_id: (estoque_atual, estoque_minimo) for produto_id, estoque_atual, estoque_minimo in
+        db.session.query(Produto.id, Produto.estoque_atual, Produto.estoque_minimo)
+        .filter(Produto.id.in_({pendencia.produto_id for pendencia in pendencias})).order_by(Produto.id).with_for_update()
+    }
+    saldos = {produto_id: estoque_atual for produto_id, (estoque_atual, _) in antes.items()}
+    deltas_resumo = defaultdict(int)
+    eventos = []
+    for pendencia in pendencias:
+        if pendencia.produto_id not in saldos:
+            continue # Produto excluído depois da escrita
+        saldos[pendencia.produto_id] += pendencia.variacao
+        if pendencia.tipo_movimentacao is not None:
+            deltas_resumo['total_entradas' if pendencia.tipo_movimentacao == 'entrada' else 'total_saidas'] += pendencia.quantidade
+        eventos.append({
+            'produto_id': pendencia.produto_id, 'cliente_id': pendencia.cliente_id, 'tipo_movimentacao': pendencia.tipo_movimentacao,
+            'quantidade': pendencia.quantidade, 'data_hora': pendencia.data_hora, 'saldo': saldos[pendencia.produto_id]
+        })
+
+    alterados = []
+    for produto_id, saldo in saldos.items():
+        depois = (saldo, antes[produto_id][1])
+        if depois != antes[produto_id]:
+            alterados.append({'b_id': produto_id, 'd_estoque_atual': saldo - antes[produto_id][0]})
+            for coluna, variacao in variacao_resumo_produto(antes[produto_id], depois).items():
+                deltas_resumo[coluna] += variacao
+            registrar_evento_estoque(produto_id, antes[produto_id], depois)
+    if alterados:
+        tabela = Produto.__table__
+        db.session.execute(
+            tabela.update().where(tabela.c.id == bindparam('b_id')).values(estoque_atual=tabela.c.estoque_atual + bindparam('d_estoque_atual')),
+            alterados
+        )
+    ajustar_resumo(deltas_resumo)
+    atualizar_rollups(eventos)
+    db.session.commit()
+    invalidar_cache('produto', *[alterado['b_id'] for alterado in alterados])
+    return len(pendencias)
+
+_consolidacao_lock = threading.Lock()
+_consolidacao_aviso = threading.Event()
+
+def consolidar_estoque():
+    # Aplica as pendências em lotes de ESTOQUE_CONSOLIDACAO_LOTE até não sobrar nenhuma; retorna quantas aplicou
+    limite = current_app.config['ESTOQUE_CONSOLIDACAO_LOTE']
+    total = 0
+    with _consolidacao_lock:
+        while True:
+            aplicadas = _com_retentativas(lambda: _consolidar_lote_estoque(limite))
+            total += aplicadas
+            if aplicadas < limite:
+                return total
+
+@event.listens_for(SessionORM, 'after_commit')
+def _avisar_consolidacao(session):
+    if session.info.pop('estoque_pendente', False):
+        _consolidacao_aviso.set()
+
+@event.listens_for(SessionORM, 'after_rollback')
+def _descartar_aviso_consolidacao(session):
+    session.info.pop('estoque_pendente', None)
+
+def _loop_consolidacao_estoque(flask_app):
+    while True:
+        _consolidacao_aviso.wait(flask_app.config['ESTOQUE_CONSOLIDACAO_SEGUNDOS'])
+        _consolidacao_aviso.clear()
+        time.sleep(flask_app.config['ESTOQUE_CONSOLIDACAO_ESPERA_MS'] / 1000) # Junta as escritas seguintes no mesmo lote
+        with flask_app.app_context():
+            try:
+                consolidar_estoque()
+            except Exception:
+                db.session.rollback()
+                logger.exception("Erro ao consolidar o estoque")
+
+_consolidacao_thread_lock = threading.Lock()
+_consolidacao_iniciada = False
+
+@api.before_app_request
+def _iniciar_consolidacao_estoque():
+    # Uma thread por processo (worker), iniciada na primeira requisição
+    global _consolidacao_iniciada
+    if _consolidacao_iniciada or current_app.config['ESTOQUE_CONSOLIDACAO_SEGUNDOS'] <= 0:
+        return
+    with _consolidacao_thread_lock:
+        if not _consolidacao_iniciada:
+            threading.Thread(target=_loop_consolidacao_estoque, args=(current_app._get_current_object(),), daemon=True, name='consolidacao-estoque').start()
+            _consolidacao_iniciada = True
+
+@api.cli.command('consolidar-estoque')
+def consolidar_estoque_command():
+    print(f"Pendências de estoque consolidadas: {consolidar_estoque()}")
+
+# --- Resumo do Dashboard (contadores incrementais) ---
+def _status_estoque(estoque_atual, estoque_minimo):
+    # (conta como estoque baixo, conta como em falta), com os mesmos critérios do relatório
+    estoque_atual, estoque_minimo = int(estoque_atual or 0), int(estoque_minimo or 0)
+    return int(estoque_atual <= estoque_minimo), int(estoque_atual == 0)
+
+def variacao_resumo_produto(antes, depois):
+    # antes/depois: (estoque_atual, estoque_minimo), ou None quando o produto não existe
+    baixo_antes, falta_antes = _status_estoque(*antes) if antes else (0, 0)
+    baixo_depois, falta_depois = _status_estoque(*depois) if depois else (0, 0)
+    return {
+        'total_produtos': (depois is not None) - (antes is not None),
+        'produtos_estoque_baixo': baixo_depois - baixo_antes,
+        'produtos_em_falta': falta_depois - falta_antes
+    }
+
+def ajustar_resumo(deltas):
+    # Incremento atômico na mesma transação da escrita; se a linha ainda não existe, a
+    # próxima leitura do dashboard faz a reconciliação completa
+    valores = {coluna: getattr(ResumoDashboard, coluna) + delta for coluna, delta in deltas.items() if delta}
+    if valores:
+        db.session.execute(
+            update(ResumoDashboard).where(ResumoDashboard.id == 1).values(**valores)
+            .execution_options(synchronize_session=False)
+        )
+
+def reconciliar_resumo_dashboard():
+    # Recalcula tudo a partir das tabelas e corrige qualquer desvio dos contadores.
+    # O SELECT ... FOR UPDATE segura os incrementos concorrentes até o fim do recálculo.
+    resumo = ResumoDashboard.query.filter_by(id=1).with_for_update().first()
+    if resumo is None:
+        resumo = ResumoDashboard(id=1)
+        db.session.add(resumo)
+
+    resumo.total_produtos = Produto.query.count()
+    resumo.produtos_estoque_baixo = Produto.query.filter(Produto.estoque_baixo == True).count()
+    resumo.produtos_em_falta = Produto.query.filter(Produto.estoque_atual == 0).count()
+
+    def soma(coluna, *filtros):
+        return select(db.func.coalesce(db.func.sum(coluna), 0)).where(*filtros).scalar_subquery()
+    # Uma leitura só: movimentações cuja pendência ainda não foi consolidada ficam de fora, e entram no resumo quando
+    # a consolidação (presa no FOR UPDATE acima) somar as quantidades delas
+    resumo.total_entradas, resumo.total_saidas = db.session.query(
+        soma(Movimentacao.quantidade, Movimentacao.tipo_movimentacao == 'entrada') + soma(ResumoArquivoMes.quantidade_entrada)
+        - soma(EstoquePendente.quantidade, EstoquePendente.tipo_movimentacao == 'entrada'),
+        soma(Movimentacao.quantidade, Movimentacao.tipo_movimentacao == 'saida') + soma(ResumoArquivoMes.quantidade_saida)
+        - soma(EstoquePendente.quantidade, EstoquePendente.tipo_movimentacao == 'saida')
+    ).one()
+    resumo.atualizado_em = datetime.now()
+
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # Outro worker criou a linha ao mesmo tempo; basta reconciliar sobre ela
+        db.session.rollback()
+        return reconciliar_resumo_dashboard()
+    return resumo
+
+def _loop_reconciliacao_resumo(flask_app):
+    while True:
+        time.sleep(flask_app.config['RESUMO_RECONCILIACAO_SEGUNDOS'])
+        with flask_app.app_context():
+            try:
+                reconciliar_resumo_dashboard()
+            except Exception:
+                db.session.rollback()
+                logger.exception("Erro ao reconciliar o resumo do dashboard")
+
+_reconciliacao_lock = threading.Lock()
+_reconciliacao_iniciada = False
+
+@api.before_app_request
+def _iniciar_reconciliacao_periodica():
+    # Uma thread por processo (worker), iniciada na primeira requisição
+    global _reconciliacao_iniciada
+    if _reconciliacao_iniciada or current_app.config['RESUMO_RECONCILIACAO_SEGUNDOS'] <= 0:
+        return
+    with _reconciliacao_lock:
+        if not _reconciliacao_iniciada:
+            threading.Thread(target=_loop_reconciliacao_resumo, args=(current_app._get_current_object(),), daemon=True, name='reconciliacao-resumo').start()
+            _reconciliacao_iniciada = True
+
+@api.cli.command('reconciliar-resumo')
+def reconciliar_resumo_command():
+    resumo = reconciliar_resumo_dashboard()
+    print(f"Resumo do dashboard reconciliado: {resumo.to_dict()}")
+
+# --- Agregados de Movimentações (Rollups) ---
+GRANULARIDADES = {
+    'dia': lambda data: data,
+    'semana': lambda data: data - timedelta(days=data.weekday()),
+    'mes': lambda data: data.replace(day=1),
+}
+
+def _chaves_rollup(produto_id, cliente_id, data_hora):
+    for granularidade, inicio_periodo in GRANULARIDADES.items():
+        periodo = inicio_periodo(data_hora.date())
+        yield ('produto', produto_id, granularidade, periodo)
+        if cliente_id:
+            yield ('cliente', cliente_id, granularidade, periodo)
+
+def atualizar_rollups(eventos):
+    # eventos: dicts com produto_id, cliente_id, tipo_movimentacao ('entrada', 'saida' ou None para
+    # ajuste manual de estoque), quantidade, data_hora e saldo (estoque do produto depois do evento).
+    # Roda na transação da escrita: um SELECT, INSERT das linhas novas e um UPDATE em lote.
+    variacoes = {}
+    for evento in eventos:
+        tipo = evento.get('tipo_movimentacao')
+        for chave in _chaves_rollup(evento['produto_id'], evento.get('cliente_id'), evento['data_hora']):
+            variacao = variacoes.setdefault(chave, {'d_quantidade_entrada': 0, 'd_quantidade_saida': 0, 'd_entradas': 0, 'd_saidas': 0, 'b_saldo_final': None})
+            if tipo in ('entrada', 'saida'):
+                variacao[f'd_quantidade_{tipo}'] += evento['quantidade']
+                variacao['d_entradas' if tipo == 'entrada' else 'd_saidas'] += 1
+            if chave[0] == 'produto':
+                variacao['b_saldo_final'] = evento['saldo'] # Eventos em ordem: vale o último saldo do período
+    if not variacoes:
+        return
+
+    tabela = MovimentacaoRollup.__table__
+    existentes = set(db.session.execute(
+        select(tabela.c.dimensao, tabela.c.dimensao_id, tabela.c.granularidade, tabela.c.periodo).where(
+            tabela.c.dimensao_id.in_({chave[1] for chave in variacoes}),
+            tabela.c.periodo.in_({chave[3] for chave in variacoes})
+        )
+    ).all())
+    for chave in variacoes:
+        if chave in existentes:
+            continue
+        try:
+            with db.session.begin_nested(): # Outra transação pode criar a mesma linha ao mesmo tempo
+                db.session.execute(insert(tabela).values(
+                    dimensao=chave[0], dimensao_id=chave[1], granularidade=chave[2], periodo=chave[3],
+                    quantidade_entrada=0, quantidade_saida=0, entradas=0, saidas=0
+                ))
+        except IntegrityError:
+            pass
+
+    db.session.execute(
+        tabela.update().where(
+            tabela.c.dimensao == bindparam('b_dimensao'),
+            tabela.c.dimensao_id == bindparam('b_dimensao_id'),
+            tabela.c.granularidade == bindparam('b_granularidade'),
+            tabela.c.periodo == bindparam('b_periodo')
+        ).values(
+            quantidade_entrada=tabela.c.quantidade_entrada + bindparam('d_quantidade_entrada'),
+            quantidade_saida=tabela.c.quantidade_saida + bindparam('d_quantidade_saida'),
+            entradas=tabela.c.entradas + bindparam('d_entradas'),
+            saidas=tabela.c.saidas + bindparam('d_saidas'),
+            saldo_final=db.func.coalesce(bindparam('b_saldo_final', type_=db.Integer), tabela.c.saldo_final)
+        ),
+        [dict(variacao, b_dimensao=chave[0], b_dimensao_id=chave[1], b_granularidade=chave[2], b_periodo=chave[3])
+         for chave, variacao in variacoes.items()]
+    )
+
+def reconstruir_rollups(tamanho_lote=5000):
+    # Recalcula tudo a partir de movimentacoes. O saldo inicial de cada produto é o estoque atual
+    # menos o efeito líquido de todas as suas movimentações; daí os saldos avançam em ordem cronológica.
+    # Consolida antes: pendência aplicada depois da reconstrução contaria de novo a movimentação dela
+    consolidar_estoque()
+    tabela = MovimentacaoRollup.__table__
+    db.session.execute(tabela.delete())
+
+    efeito = _efeito_posterior(datetime.min)
+    saldos = dict(
+        db.session.query(Produto.id, Produto.estoque_atual - db.func.coalesce(efeito.c.efeito, 0)).outerjoin(
+            efeito, efeito.c.produto_id == Produto.id
+        ).all()
+    )
+
+    def gravar(finais):
+        novas = [dict(zip(('dimensao', 'dimensao_id', 'granularidade', 'periodo'), chave), **valores) for chave, valores in finais]
+        for inicio in range(0, len(novas), tamanho_lote):
+            db.session.execute(insert(tabela), novas[inicio:inicio + tamanho_lote])
+
+    linhas = {}
+    produto_atual = None
+    def colunas(modelo):
+        return modelo.produto_id, modelo.cliente_id, modelo.tipo_movimentacao, modelo.quantidade, modelo.data_hora, modelo.id
+    if _limite_arquivo_no_banco() is None:
+        consulta = db.session.query(*colunas(Movimentacao)[:5]).order_by(Movimentacao.produto_id, Movimentacao.data_hora, Movimentacao.id)
+    else:
+        # Meses arquivados entram na mesma ordem cronológica por produto
+        fonte = union_all(select(*colunas(Movimentacao)), select(*colunas(MovimentacaoArquivada))).subquery()
+        consulta = db.session.query(
+            fonte.c.produto_id, fonte.c.cliente_id, fonte.c.tipo_movimentacao, fonte.c.quantidade, fonte.c.data_hora
+        ).order_by(fonte.c.produto_id, fonte.c.data_hora, fonte.c.id)
+    consulta = consulta.execution_options(stream_results=True, yield_per=tamanho_lote)
+    for produto_id, cliente_id, tipo, quantidade, data_hora in consulta:
+        if produto_id != produto_atual:
+            # As linhas do produto anterior já estão completas: grava e libera a memória
+            gravar([(chave, linhas.pop(chave)) for chave in [chave for chave in linhas if chave[0] == 'produto']])
+            produto_atual = produto_id
+        saldos[produto_id] = saldos.get(produto_id, 0) + (quantidade if tipo == 'entrada' else -quantidade)
+        for chave in _chaves_rollup(produto_id, cliente_id, data_hora):
+            valores = linhas.setdefault(chave, {'quantidade_entrada': 0, 'quantidade_saida': 0, 'entradas': 0, 'saidas': 0, 'saldo_final': None})
+            valores[f'quantidade_{tipo}'] += quantidade
+            valores['entradas' if tipo == 'entrada' else 'saidas'] += 1
+            if chave[0] == 'produto':
+                valores['saldo_final'] = saldos[produto_id]
+    gravar(list(linhas.items()))
+    db.session.commit()
+
+@api.cli.command('reconstruir-rollups')
+def reconstruir_rollups_command():
+    reconstruir_rollups()
+    print(f"Agregados de movimentações reconstruídos: {MovimentacaoRollup.query.count()} linhas.")
+
+@api.route('/relatorios/movimentacoes/serie', methods=['GET'])
+@jwt_required() # Protege a rota da série histórica de movimentações
+@rota_leitura
+def get_serie_movimentacoes():
+    produto_id = request.args.get('produto_id', type=int)
+    cliente_id = request.args.get('cliente_id', type=int)
+    granularidade = request.args.get('granularidade', 'dia', type=str)
+
+    if (produto_id is None) == (cliente_id is None):
+        return jsonify({"message": "Informe produto_id ou cliente_id."}), 400
+    if granularidade not in GRANULARIDADES:
+        return jsonify({"message": "Granularidade inválida. Use 'dia', 'semana' ou 'mes'."}), 400
+
+    query = MovimentacaoRollup.query.filter_by(
+        dimensao='produto' if produto_id is not None else 'cliente',
+        dimensao_id=produto_id if produto_id is not None else cliente_id,
+        granularidade=granularidade
+    )
+
+    start_date_filter = request.args.get('inicio', type=str)
+    end_date_filter = request.args.get('fim', type=str)
+    try:
+        if start_date_filter:
+            inicio = GRANULARIDADES[granularidade](datetime.fromisoformat(start_date_filter).date())
+            query = query.filter(MovimentacaoRollup.periodo >= inicio)
+        if end_date_filter:
+            query = query.filter(MovimentacaoRollup.periodo <= datetime.fromisoformat(end_date_filter).date())
+    except ValueError:
+        return jsonify({"message": "Formato de data inválido. Use YYYY-MM-DD."}), 400
+
+    serie = [linha.to_dict() for linha in query.order_by(MovimentacaoRollup.periodo).all()]
+    return jsonify({'granularidade': granularidade, 'items': serie}), 200
+
+
+# --- Eventos de Estoque Crítico (pub/sub + Server-Sent Events) ---
+class AssinaturaMemoria:
+    def __init__(self, broker, tamanho_max):
+        self._broker = broker
+        self._fila = deque()
+        self._tamanho_max = tamanho_max
+        self._condicao = threading.Condition()
+        self._perdeu_eventos = False
+
+    def entregar(self, evento):
+        with self._condicao:
+            if len(self._fila) >= self._tamanho_max:
+                # Cliente lento: descarta a fila e pede que ele recarregue a lista inteira
+                self._fila.clear()
+                self._perdeu_eventos = True
+            else:
+                self._fila.append(evento)
+            self._condicao.notify()
+
+    def proximo(self, timeout):
+        # Próximo evento, ou None se nada chegou dentro do timeout
+        with self._condicao:
+            self._condicao.wait_for(lambda: self._fila or self._perdeu_eventos, timeout)
+            if self._perdeu_eventos:
+                self._perdeu_eventos = False
+                return {'tipo': 'resync'}
+            return self._fila.popleft() if self._fila else None
+
+    def cancelar(self):
+        self._broker.remover_assinatura(self)
+
+class BrokerMemoria:
+    def __init__(self, tamanho_historico, tamanho_fila):
+        self._lock = threading.Lock()
+        self._sequencia = 0
+        self._historico = deque(maxlen=tamanho_historico)
+        self._assinaturas = set()
+        self._tamanho_fila = tamanho_fila
+
+    def publicar(self, evento):
+        with self._lock:
+            self._sequencia += 1
+            evento = dict(evento, id=self._sequencia)
+            self._historico.append(evento)
+            assinaturas = list(self._assinaturas)
+        for assinatura in assinaturas:
+            assinatura.entregar(evento)
+
+    def assinar(self):
+        assinatura = AssinaturaMemoria(self, self._tamanho_fila)
+        with self._lock:
+            self._assinaturas.add(assinatura)
+        return assinatura
+
+    def remover_assinatura(self, assinatura):
+        with self._lock:
+            self._assinaturas.discard(assinatura)
+
+    def historico(self, desde_id):
+        # (eventos com id > desde_id, completo?) — incompleto quando o histórico já descartou parte deles
+        with self._lock:
+            eventos = [evento for evento in self._historico if evento['id'] > desde_id]
+            completo = desde_id >= self._sequencia or (bool(self._historico) and self._historico[0]['id'] <= desde_id + 1)
+        return eventos, completo
+
+class AssinaturaRedis:
+    def __init__(self, pubsub):
+        self._pubsub = pubsub
+
+    def proximo(self, timeout):
+        mensagem = self._pubsub.get_message(ignore_subscribe_messages=True, timeout=timeout)
+        return json.loads(mensagem['data']) if mensagem else None
+
+    def cancelar(self):
+        self._pubsub.close()
+
+class BrokerRedis:
+    # Mesmo contrato do BrokerMemoria; qualquer servidor compatível com o protocolo Redis serve
+    CANAL = 'eventos:estoque'
+
+    def __init__(self, url, tamanho_historico):
+        import redis # Dependência opcional, só necessária com EVENTOS_BACKEND=redis
+        self._cliente = redis.Redis.from_url(url)
+        self._tamanho_historico = tamanho_historico
+
+    def publicar(self, evento):
+        evento = dict(evento, id=self._cliente.incr(f'{self.CANAL}:sequencia'))
+        dados = json.dumps(evento, default=str)
+        pipeline = self._cliente.pipeline()
+        pipeline.lpush(f'{self.CANAL}:historico', dados)
+        pipeline.ltrim(f'{self.CANAL}:historico', 0, self._tamanho_historico - 1)
+        pipeline.publish(self.CANAL, dados)
+        pipeline.execute()
+
+    def assinar(self):
+        pubsub = self._cliente.pubsub()
+        pubsub.subscribe(self.CANAL)
+        return AssinaturaRedis(pubsub)
+
+    def historico(self, desde_id):
+        eventos = sorted((json.loads(dados) for dados in self._cliente.lrange(f'{self.CANAL}:historico', 0, -1)), key=lambda evento: evento['id'])
+        sequencia = int(self._cliente.get(f'{self.CANAL}:sequencia') or 0)
+        completo = desde_id >= sequencia or (bool(eventos) and eventos[0]['id'] <= desde_id + 1)
+        return [evento for evento in eventos if evento['id'] > desde_id], completo
+
+_broker_eventos = None
+_broker_eventos_lock = threading.Lock()
+
+def obter_broker_eventos():
+    global _broker_eventos
+    with _broker_eventos_lock:
+        if _broker_eventos is None:
+            if current_app.config['EVENTOS_BACKEND'] == 'redis':
+                _broker_eventos = BrokerRedis(current_app.config['EVENTOS_REDIS_URL'], current_app.config['EVENTOS_HISTORICO'])
+            else:
+                _broker_eventos = BrokerMemoria(current_app.config['EVENTOS_HISTORICO'], current_app.config['EVENTOS_FILA_MAX'])
+    return _broker_eventos
+
+def _nome_status_estoque(estoque):
+    # estoque: (estoque_atual, estoque_minimo), ou None quando o produto não existe
+    if estoque is None:
+        return 'removido'
+    baixo, em_falta = _status_estoque(*estoque)
+    return 'em_falta' if em_falta else 'baixo' if baixo else 'normal'
+
+def registrar_evento_estoque(produto_id, antes, depois, produto=None):
+    # Chamado na transação da escrita, com os mesmos (antes, depois) de variacao_resumo_produto.
+    # Publica mudanças de status e qualquer alteração de produto que continue crítico (lista sempre atual);
+    # o envio só acontece depois do commit, assim como a atualização do razão de estoque em memória.
+    # `produto`: o Produto que o chamador já carregou. Sem ele (lote, journal), os dados dos eventos da
+    # transação saem de uma única consulta antes do commit.
+    db.session.info.setdefault('razao_estoque', []).append((produto_id, depois))
+    status_antes, status_depois = _nome_status_estoque(antes), _nome_status_estoque(depois)
+    if status_antes == status_depois and status_depois in ('normal', 'removido'):
+        return
+    if status_antes == 'removido' and status_depois == 'normal':
+        return
+    evento = {'tipo': 'estoque', 'status': status_depois, 'status_anterior': status_antes, 'produto': {'id': produto_id}}
+    if depois is not None and produto is not None:
+        # Mesma saída do serializador de produtos; o saldo vem de `depois` (o UPDATE relativo não atualiza o objeto)
+        evento['produto'] = dict(produto.to_dict(), estoque_atual=depois[0], estoque_minimo=depois[1], estoque_baixo=depois[0] <= depois[1])
+    elif depois is not None:
+        db.session.info.setdefault('eventos_estoque_sem_produto', []).append(evento)
+    db.session.info.setdefault('eventos_estoque', []).append(evento)
+
+def publicar_evento_resync():
+    # Para escritas em massa (importação): os clientes recarregam a lista crítica inteira
+    obter_broker_eventos().publicar({'tipo': 'resync'})
+
+@event.listens_for(SessionORM, 'before_commit')
+def _carregar_produtos_eventos(session):
+    pendentes = session.info.pop('eventos_estoque_sem_produto', [])
+    if not pendentes:
+        return
+    query, codificar = SERIALIZADORES['produtos'].aplicar(
+        session.query(Produto).filter(Produto.id.in_({evento['produto']['id'] for evento in pendentes}))
+    )
+    produtos = {produto['id']: produto for produto in map(codificar, query)}
+    for evento in pendentes:
+        evento['produto'] = produtos.get(evento['produto']['id'], evento['produto'])
+
+@event.listens_for(SessionORM, 'after_commit')
+def _publicar_eventos_estoque(session):
+    eventos = session.info.pop('eventos_estoque', [])
+    if eventos:
+        broker = obter_broker_eventos()
+        for evento in eventos:
+            try:
+                broker.publicar(evento)
+            except Exception:
+                logger.exception("Erro ao publicar evento de estoque")
+
+@event.listens_for(SessionORM, 'after_rollback')
+def _descartar_eventos_estoque(session):
+    session.info.pop('eventos_estoque', None)
+    session.info.pop('eventos_estoque_sem_produto', None)
+
+def _formatar_sse(evento):
+    linhas = [f"event: {evento['tipo']}"]
+    if 'id' in evento:
+        linhas.insert(0, f"id: {evento['id']}")
+    linhas.append(f"data: {json.dumps(evento, default=str, ensure_ascii=False)}")
+    return '\n'.join(linhas) + '\n\n'
+
+def _stream_eventos_estoque(broker, assinatura, ultimo_id, keepalive, sessao_valida):
+    try:
+        yield 'retry: 3000\n\n'
+        if ultimo_id is not None:
+            eventos, completo = broker.historico(ultimo_id)
+            if not completo:
+                yield _formatar_sse({'tipo': 'resync'})
+            for evento in eventos:
+                ultimo_id = evento['id']
+                yield _formatar_sse(evento)
+        proxima_verificacao = time.monotonic() + keepalive
+        while True:
+            if time.monotonic() >= proxima_verificacao:
+                # Token expirado ou revogado (logout-todos) durante o stream: encerra; o cliente pede outro ticket
+                if not sessao_valida():
+                    yield _formatar_sse({'tipo': 'expirado'})
+                    return
+                proxima_verificacao = time.monotonic() + keepalive
+            evento = assinatura.proximo(keepalive)
+            if evento is None:
+                yield ': keepalive\n\n' # Mantém proxies e o navegador com a conexão aberta
+            elif 'id' not in evento or ultimo_id is None or evento['id'] > ultimo_id: # Já enviado pelo histórico
+                yield _formatar_sse(evento)
+    finally:
+        assinatura.cancelar()
+
+def _serializador_ticket_eventos():
+    # Assinatura própria: o ticket não vale como token de acesso em outras rotas, nem um token vale como ticket
+    return URLSafeTimedSerializer(current_app.config['JWT_SECRET_KEY'], salt='ticket-eventos-estoque')
+
+def _sessao_eventos_valida(app, identidade):
+    if time.time() >= identidade['exp']:
+        return False
+    with app.app_context():
+        return versao_token_usuario(identidade['sub']) == identidade['ver']
+
+@api.route('/eventos/estoque/ticket', methods=['POST'])
+@jwt_required() # O ticket é emitido com o token no cabeçalho e vai na URL no lugar dele
+def criar_ticket_eventos():
+    claims = get_jwt()
+    ticket = _serializador_ticket_eventos().dumps({'sub': int(get_jwt_identity()), 'ver': claims.get('ver'), 'exp': claims['exp']})
+    return jsonify({'ticket': ticket, 'expira_em_segundos': current_app.config['EVENTOS_TICKET_SEGUNDOS']}), 201
+
+@api.route('/eventos/estoque', methods=['GET'])
+def stream_eventos_estoque():
+    # EventSource abre com ?ticket=<ticket> (POST /eventos/estoque/ticket); outros clientes podem usar o cabeçalho
+    ticket = request.args.get('ticket')
+    if ticket is not None:
+        try:
+            identidade = _serializador_ticket_eventos().loads(ticket, max_age=current_app.config['EVENTOS_TICKET_SEGUNDOS'])
+        except BadData:
+            return jsonify({"message": "Ticket inválido ou expirado."}), 401
+    else:
+        verify_jwt_in_request()
+        claims = get_jwt()
+        identidade = {'sub': int(get_jwt_identity()), 'ver': claims.get('ver'), 'exp': claims['exp']}
+    aplicacao = current_app._get_current_object()
+    if not _sessao_eventos_valida(aplicacao, identidade):
+        return jsonify({"message": "Token revogado ou expirado."}), 401
+
+    ultimo_id = request.headers.get('Last-Event-ID', type=int)
+    if ultimo_id is None:
+        ultimo_id = request.args.get('ultimo_id', type=int) # Reconexão manual, sem o cabeçalho do EventSource
+    broker = obter_broker_eventos()
+    assinatura = broker.assinar() # Antes de ler o histórico, para não perder eventos no intervalo
+    db.session.close() # A conexão não fica presa durante o stream
+    return Response(
+        _stream_eventos_estoque(broker, assinatura, ultimo_id, current_app.config['EVENTOS_KEEPALIVE_SEGUNDOS'],
+                                lambda: _sessao_eventos_valida(aplicacao, identidade)),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+
+# --- Razão de Estoque em Memória (conjuntos de estoque baixo/em falta) ---
+class RazaoEstoque:
+    # Saldo e mínimo em arrays indexados pelo id do produto (4 bytes cada) e um byte de situação por id;
+    # os conjuntos de estoque baixo e em falta são mantidos a cada alteração, com os critérios de _status_estoque.
+    # Os ids são autoincrementais, então o índice direto desperdiça só as lacunas de produtos excluídos.
+    EXISTE, BAIXO, EM_FALTA = 1, 2, 4
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._estoque = array('i')
+        self._minimo = array('i')
+        self._situacao = bytearray()
+        self._conjuntos = {'baixo': set(), 'em_falta': set()}
+        self._total = 0
+        self._tocados = None # Ids alterados durante uma verificação, que a verificação não deve corrigir
+
+    def _garantir(self, produto_id):
+        if produto_id >= len(self._situacao):
+            extra = max(produto_id + 1, len(self._situacao) * 5 // 4) - len(self._situacao)
+            self._estoque.frombytes(bytes(extra * self._estoque.itemsize))
+            self._minimo.frombytes(bytes(extra * self._minimo.itemsize))
+            self._situacao.extend(bytes(extra))
+
+    def _definir(self, produto_id, estoque):
+        # estoque: (estoque_atual, estoque_minimo), ou None quando o produto não existe mais
+        situacao_antes = self._situacao[produto_id] if produto_id < len(self._situacao) else 0
+        if estoque is None:
+            situacao = 0
+        else:
+            self._garantir(produto_id)
+            estoque_atual, estoque_minimo = int(estoque[0] or 0), int(estoque[1] or 0)
+            self._estoque[produto_id], self._minimo[produto_id] = estoque_atual, estoque_minimo
+            baixo, em_falta = _status_estoque(estoque_atual, estoque_minimo)
+            situacao = self.EXISTE | (self.BAIXO if baixo else 0) | (self.EM_FALTA if em_falta else 0)
+        if situacao == situacao_antes:
+            return
+        if situacao_antes or situacao:
+            self._situacao[produto_id] = situacao
+        self._total += bool(situacao & self.EXISTE) - bool(situacao_antes & self.EXISTE)
+        for nome, bit in [('baixo', self.BAIXO), ('em_falta', self.EM_FALTA)]:
+            if situacao & bit:
+                self._conjuntos[nome].add(produto_id)
+            else:
+                self._conjuntos[nome].discard(produto_id)
+
+    def carregar(self, linhas):
+        # linhas: (id, estoque_atual, estoque_minimo)
+        with self._lock:
+            for produto_id, estoque_atual, estoque_minimo in linhas:
+                self._definir(produto_id, (estoque_atual, estoque_minimo))
+
+    def definir(self, produto_id, estoque):
+        with self._lock:
+            self._definir(produto_id, estoque)
+            if self._tocados is not None:
+                self._tocados.add(produto_id)
+
+    def obter(self, produto_id):
+        with self._lock:
+            if produto_id >= len(self._situacao) or not self._situacao[produto_id] & self.EXISTE:
+                return None
+            return self._estoque[produto_id], self._minimo[produto_id]
+
+    def ids(self, situacao):
+        with self._lock:
+            return list(self._conjuntos[situacao])
+
+    def contagens(self):
+        with self._lock:
+            return {
+                'total_produtos': self._total,
+                'produtos_estoque_baixo': len(self._conjuntos['baixo']),
+                'produtos_em_falta': len(self._conjuntos['em_falta'])
+            }
+
+    def verificar(self, linhas, tamanho_bloco=10000):
+        # Compara com (id, estoque_atual, estoque_minimo) lidos do banco e corrige as divergências. Ids alterados
+        # durante a verificação ficam como estão: o valor lido pode ser anterior à alteração.
+        with self._lock:
+            self._tocados = set()
+        vistos = set()
+        divergencias = 0
+        try:
+            bloco = []
+            for linha in linhas:
+                bloco.append(linha)
+                if len(bloco) >= tamanho_bloco:
+                    divergencias += self._verificar_bloco(bloco, vistos)
+                    bloco = []
+            divergencias += self._verificar_bloco(bloco, vistos)
+            with self._lock:
+                for produto_id, situacao in enumerate(self._situacao):
+                    if situacao and produto_id not in vistos and produto_id not in self._tocados:
+                        self._definir(produto_id, None) # Excluído no banco por outro processo
+                        divergencias += 1
+        finally:
+            with self._lock:
+                self._tocados = None
+        return divergencias
+
+    def _verificar_bloco(self, bloco, vistos):
+        divergencias = 0
+        with self._lock:
+            for produto_id, estoque_atual, estoque_minimo in bloco:
+                vistos.add(produto_id)
+                if produto_id in self._tocados:
+                    continue
+                esperado = (int(estoque_atual or 0), int(estoque_minimo or 0))
+                atual = None
+                if produto_id < len(self._situacao) and self._situacao[produto_id] & self.EXISTE:
+                    atual = (self._estoque[produto_id], self._minimo[produto_id])
+                if atual != esperado:
+                    self._definir(produto_id, esperado)
+                    divergencias += 1
+        return divergencias
+
+_razao_estoque = None
+_razao_estoque_lock = threading.Lock()
+_razao_pendentes = None # Alterações confirmadas durante a carga inicial, reaplicadas ao final dela
+_razao_verificar_agora = threading.Event()
+_razao_iniciada = False
+
+def obter_razao_estoque():
+    # None com o recurso desativado ou antes do fim da carga inicial: quem chama usa o SQL
+    return _razao_estoque if current_app.config['RAZAO_ESTOQUE_ATIVA'] else None
+
+def _linhas_razao_estoque():
+    return db.session.query(Produto.id, Produto.estoque_atual, Produto.estoque_minimo).order_by(Produto.id) \
+        .execution_options(stream_results=True).yield_per(10000)
+
+def carregar_razao_estoque():
+    global _razao_estoque, _razao_pendentes
+    with _razao_estoque_lock:
+        _razao_pendentes = []
+    razao = RazaoEstoque()
+    try:
+        razao.carregar(_linhas_razao_estoque())
+    finally:
+        db.session.rollback()
+        with _razao_estoque_lock:
+            pendentes, _razao_pendentes = _razao_pendentes, None
+    for produto_id, estoque in pendentes:
+        razao.definir(produto_id, estoque)
+    with _razao_estoque_lock:
+        _razao_estoque = razao
+    return razao
+
+def agendar_verificacao_razao():
+    # Escritas que não passam por registrar_evento_estoque (importação em lote): verifica sem esperar o intervalo
+    _razao_verificar_agora.set()
+
+def filtro_situacao_estoque(situacao):
+    # 'baixo' ou 'em_falta'. Com o razão carregado e poucos ids, busca por chave primária; senão a condição
+    # na coluna (estoque_baixo é gerada e indexada)
+    razao = obter_razao_estoque()
+    if razao is not None:
+        ids = razao.ids(situacao)
+        if len(ids) <= current_app.config['RAZAO_ESTOQUE_MAX_IDS_CONSULTA']:
+            return Produto.id.in_(ids)
+    return Produto.estoque_baixo == True if situacao == 'baixo' else Produto.estoque_atual == 0
+
+@event.listens_for(SessionORM, 'after_commit')
+def _aplicar_alteracoes_razao(session):
+    alteracoes = session.info.pop('razao_estoque', None)
+    if not alteracoes:
+        return
+    with _razao_estoque_lock:
+        if _razao_pendentes is not None:
+            _razao_pendentes.extend(alteracoes)
+        razao = _razao_estoque
+    if razao is not None:
+        for produto_id, estoque in alteracoes:
+            razao.definir(produto_id, estoque)
+
+@event.listens_for(SessionORM, 'after_rollback')
+def _descartar_alteracoes_razao(session):
+    session.info.pop('razao_estoque', None)
+
+def _loop_razao_estoque(flask_app):
+    with flask_app.app_context():
+        try:
+            razao = carregar_razao_estoque()
+            logger.info("razao_estoque_carregado produtos=%s", razao.contagens()['total_produtos'])
+        except Exception:
+            db.session.rollback()
+            logger.exception("Erro ao carregar o razão de estoque")
+    while True:
+        _razao_verificar_agora.wait(flask_app.config['RAZAO_ESTOQUE_VERIFICAR_SEGUNDOS'])
+        _razao_verificar_agora.clear()
+        with flask_app.app_context():
+            try:
+                if _razao_estoque is None:
+                    carregar_razao_estoque()
+                    continue
+                divergencias = _razao_estoque.verificar(_linhas_razao_estoque())
+                if divergencias:
+                    logger.warning("razao_estoque_divergencias corrigidas=%s", divergencias)
+            except Exception:
+                logger.exception("Erro ao verificar o razão de estoque")
+            finally:
+                db.session.rollback()
+
+@api.before_app_request
+def _iniciar_razao_estoque():
+    # Carga em segundo plano na primeira requisição do processo; até terminar, as rotas usam o SQL
+    global _razao_iniciada
+    if _razao_iniciada or not current_app.config['RAZAO_ESTOQUE_ATIVA']:
+        return
+    with _razao_estoque_lock:
+        if not _razao_iniciada:
+            threading.Thread(target=_loop_razao_estoque, args=(current_app._get_current_object(),), daemon=True, name='razao-estoque').start()
+            _razao_iniciada = True
+
+@api.cli.command('medir-razao-estoque')
+@click.option('--produtos', default=1000000, show_default=True, help='Produtos sintéticos carregados.')
+@click.option('--fracao-baixo', default=0.1, show_default=True, help='Fração dos produtos com estoque baixo.')
+def medir_razao_estoque_command(produtos, fracao_baixo):
+    # Memória e tempos do razão com dados sintéticos (sem banco), para dimensionar os workers
+    import tracemalloc
+    gerador = random.Random(42)
+
+    def linhas():
+        for produto_id in range(1, produtos + 1):
+            estoque_minimo = gerador.randint(1, 50)
+            baixo = gerador.random() < fracao_baixo
+            yield produto_id, gerador.randint(0, estoque_minimo) if baixo else gerador.randint(estoque_minimo + 1, 1000), estoque_minimo
+
+    inicio = time.perf_counter()
+    RazaoEstoque().carregar(linhas())
+    carga = time.perf_counter() - inicio
+
+    # Segunda carga só para medir a memória: o tracemalloc deixa a carga várias vezes mais lenta
+    gerador.seed(42)
+    tracemalloc.start()
+    razao = RazaoEstoque()
+    razao.carregar(linhas())
+    memoria = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    atualizacoes = 100000
+    inicio = time.perf_counter()
+    for _ in range(atualizacoes):
+        razao.definir(gerador.randint(1, produtos), (gerador.randint(0, 100), gerador.randint(1, 50)))
+    atualizacao = time.perf_counter() - inicio
+
+    inicio = time.perf_counter()
+    for _ in range(1000):
+        razao.contagens()
+    contagem = time.perf_counter() - inicio
+
+    print(f"produtos={produtos} carga={carga:.2f}s memoria={memoria / (1024 * 1024):.1f}MB ({memoria / produtos:.1f} bytes/produto)")
+    print(f"atualizacao={atualizacao / atualizacoes * 1e6:.2f}us/op contagens={contagem / 1000 * 1e6:.2f}us/op")
+    print(f"contagens: {razao.contagens()}")
+
+
+# --- Snapshots de Estoque e Estoque em Data Passada ---
+def _efeito_movimentacoes(modelo=Movimentacao):
+    return db.func.coalesce(db.func.sum(case(
+        (modelo.tipo_movimentacao == 'entrada', modelo.quantidade), else_=-modelo.quantidade
+    )), 0)
+
+def _modelos_movimentacoes(depois_de):
+    # A tabela quente, mais o arquivo quando o período começa antes do limite dele
+    limite = limite_arquivo()
+    return [Movimentacao] if limite is None or depois_de >= limite else [Movimentacao, MovimentacaoArquivada]
+
+def _efeito_por_produto(produto_ids, depois_de, ate=None):
+    # {produto_id: entradas - saídas} das movimentações em (depois_de, ate]; usa o índice (produto_id, data_hora)
+    efeito = defaultdict(int)
+    for modelo in _modelos_movimentacoes(depois_de):
+        query = db.session.query(modelo.produto_id, _efeito_movimentacoes(modelo)).filter(
+            modelo.produto_id.in_(produto_ids), modelo.data_hora > depois_de
+        )
+        if ate is not None:
+            query = query.filter(modelo.data_hora <= ate)
+        for produto_id, valor in query.group_by(modelo.produto_id).all():
+            efeito[produto_id] += valor
+    return dict(efeito)
+
+def _efeito_posterior(desde):
+    # Subconsulta (produto_id, efeito) das movimentações depois de `desde`, com o arquivo quando alcançado
+    partes = [
+        select(modelo.produto_id.label('produto_id'), _efeito_movimentacoes(modelo).label('efeito'))
+        .where(modelo.data_hora > desde).group_by(modelo.produto_id)
+        for modelo in _modelos_movimentacoes(desde)
+    ]
+    if len(partes) == 1:
+        return partes[0].subquery()
+    uniao = union_all(*partes).subquery()
+    return select(uniao.c.produto_id, db.func.sum(uniao.c.efeito).label('efeito')).group_by(uniao.c.produto_id).subquery()
+
+def tirar_snapshot_estoque():
+    # Saldo no instante T = estoque (com as pendências) - efeito das movimentações depois de T, lidos na mesma
+    # transação. T fica um pouco no passado para que transações ainda abertas não caiam antes do checkpoint.
+    tirado_em = datetime.now() - timedelta(seconds=current_app.config['ESTOQUE_SNAPSHOT_MARGEM_SEGUNDOS'])
+    checkpoint = EstoqueCheckpoint(tirado_em=tirado_em)
+    db.session.add(checkpoint)
+    db.session.flush()
+
+    posteriores = _efeito_posterior(tirado_em)
+    pendente = estoque_pendente_subquery()
+    saldos = select(
+        db.literal(checkpoint.id), Produto.id,
+        Produto.estoque_atual + db.func.coalesce(pendente.c.variacao, 0) - db.func.coalesce(posteriores.c.efeito, 0)
+    ).outerjoin(posteriores, posteriores.c.produto_id == Produto.id).outerjoin(pendente, pendente.c.produto_id == Produto.id)
+    resultado = db.session.execute(
+        insert(EstoqueSnapshot).from_select(['checkpoint_id', 'produto_id', 'estoque'], saldos)
+    )
+    checkpoint.total_produtos = resultado.rowcount
+    db.session.commit()
+    return checkpoint
+
+def estoque_em(em, produto_ids):
+    # Parte do ponto conhecido mais próximo de `em` (checkpoint anterior, posterior ou o estoque atual)
+    # e aplica só as movimentações entre os dois instantes
+    agora = datetime.now()
+    anterior = EstoqueCheckpoint.query.filter(EstoqueCheckpoint.tirado_em <= em).order_by(EstoqueCheckpoint.tirado_em.desc()).first()
+    posterior = EstoqueCheckpoint.query.filter(EstoqueCheckpoint.tirado_em > em).order_by(EstoqueCheckpoint.tirado_em).first()
+    bases = [checkpoint for checkpoint in (anterior, posterior) if checkpoint is not None]
+    bases.sort(key=lambda checkpoint: abs((checkpoint.tirado_em - em).total_seconds()))
+
+    saldos = {}
+    pendentes = set(produto_ids)
+    for checkpoint in bases:
+        if abs((checkpoint.tirado_em - em).total_seconds()) >= abs((agora - em).total_seconds()):
+            break # O estoque atual está mais perto
+        snapshot = dict(db.session.query(EstoqueSnapshot.produto_id, EstoqueSnapshot.estoque).filter(
+            EstoqueSnapshot.checkpoint_id == checkpoint.id, EstoqueSnapshot.produto_id.in_(pendentes)
+        ).all())
+        if not snapshot:
+            continue
+        if checkpoint.tirado_em <= em:
+            efeito = _efeito_por_produto(list(snapshot), checkpoint.tirado_em, em)
+            saldos.update({produto_id: estoque + efeito.get(produto_id, 0) for produto_id, estoque in snapshot.items()})
+        else:
+            efeito = _efeito_por_produto(list(snapshot), em, checkpoint.tirado_em)
+            saldos.update({produto_id: estoque - efeito.get(produto_id, 0) for produto_id, estoque in snapshot.items()})
+        pendentes -= set(snapshot)
+
+    if pendentes:
+        # Produtos fora dos checkpoints (ou `em` recente): volta a partir do estoque atual
+        pendente = estoque_pendente_subquery()
+        atuais = dict(db.session.query(Produto.id, Produto.estoque_atual + db.func.coalesce(pendente.c.variacao, 0)).outerjoin(
+            pendente, pendente.c.produto_id == Produto.id
+        ).filter(Produto.id.in_(pendentes)).all())
+        efeito = _efeito_por_produto(list(atuais), em)
+        saldos.update({produto_id: estoque - efeito.get(produto_id, 0) for produto_id, estoque in atuais.items()})
+    return saldos
+
+def verificar_consistencia_estoque():
+    # Confere estoque_atual (com as pendências) == snapshot do último checkpoint + movimentações posteriores
+    checkpoint = EstoqueCheckpoint.query.order_by(EstoqueCheckpoint.tirado_em.desc()).first()
+    if checkpoint is None:
+        return None, []
+    posteriores = _efeito_posterior(checkpoint.tirado_em)
+    pendente = estoque_pendente_subquery()
+    atual = Produto.estoque_atual + db.func.coalesce(pendente.c.variacao, 0)
+    esperado = EstoqueSnapshot.estoque + db.func.coalesce(posteriores.c.efeito, 0)
+    divergencias = db.session.query(Produto.id, Produto.codigo, atual, esperado).join(
+        EstoqueSnapshot, and_(EstoqueSnapshot.produto_id == Produto.id, EstoqueSnapshot.checkpoint_id == checkpoint.id)
+    ).outerjoin(posteriores, posteriores.c.produto_id == Produto.id).outerjoin(
+        pendente, pendente.c.produto_id == Produto.id
+    ).filter(atual != esperado).all()
+    return checkpoint, [
+        {'produto_id': produto_id, 'codigo': codigo, 'estoque_atual': int(atual), 'estoque_esperado': int(valor)}
+        for produto_id, codigo, atual, valor in divergencias
+    ]
+
+def _loop_snapshot_estoque(flask_app):
+    while True:
+        time.sleep(min(flask_app.config['ESTOQUE_SNAPSHOT_SEGUNDOS'], 3600))
+        with flask_app.app_context():
+            try:
+                # Vários workers rodam este loop: só tira o snapshot se o último já venceu
+                ultimo = db.session.query(db.func.max(EstoqueCheckpoint.tirado_em)).scalar()
+                if ultimo is None or (datetime.now() - ultimo).total_seconds() >= flask_app.config['ESTOQUE_SNAPSHOT_SEGUNDOS']:
+                    tirar_snapshot_estoque()
+                else:
+                    db.session.rollback()
+            except Exception:
+                db.session.rollback()
+                logger.exception("Erro ao tirar snapshot de estoque")
+
+_snapshot_lock = threading.Lock()
+_snapshot_iniciado = False
+
+@api.before_app_request
+def _iniciar_snapshot_periodico():
+    global _snapshot_iniciado
+    if _snapshot_iniciado or current_app.config['ESTOQUE_SNAPSHOT_SEGUNDOS'] <= 0:
+        return
+    with _snapshot_lock:
+        if not _snapshot_iniciado:
+            threading.Thread(target=_loop_snapshot_estoque, args=(current_app._get_current_object(),), daemon=True, name='snapshot-estoque').start()
+            _snapshot_iniciado = True
+
+@api.cli.command('snapshot-estoque')
+def snapshot_estoque_command():
+    checkpoint = tirar_snapshot_estoque()
+    print(f"Snapshot de estoque registrado: {checkpoint.to_dict()}")
+
+@api.cli.command('verificar-estoque')
+def verificar_estoque_command():
+    checkpoint, divergencias = verificar_consistencia_estoque()
+    if checkpoint is None:
+        print("Nenhum snapshot de estoque registrado.")
+        return
+    for divergencia in divergencias:
+        print(f"Divergência no produto {divergencia['produto_id']} ({divergencia['codigo']}): estoque_atual={divergencia['estoque_atual']}, esperado={divergencia['estoque_esperado']}")
+    print(f"Checkpoint {checkpoint.id} de {checkpoint.tirado_em.isoformat()}: {len(divergencias)} divergência(s).")
+    if divergencias:
+        raise SystemExit(1)
+
+@api.route('/produtos/estoque', methods=['GET'])
+@jwt_required() # Protege a rota de estoque em data passada
+@rota_leitura
+def get_estoque_em_data():
+    em_filter = request.args.get('em', type=str)
+    if not em_filter:
+        return jsonify({"message": "Informe a data/hora no parâmetro 'em' (ISO 8601)."}), 400
+    try:
+        em = datetime.fromisoformat(em_filter)
+    except ValueError:
+        return jsonify({"message": "Formato de data inválido para 'em'. Use YYYY-MM-DDTHH:MM:SS."}), 400
+    if em.tzinfo is not None:
+        em = em.astimezone().replace(tzinfo=None) # data_hora é gravada no horário local, sem fuso
+
+    page = request.args.get('page', 1, type=int)
+    per_page = request.args.get('per_page', 10, type=int)
+
+    query = Produto.query.with_entities(Produto.id, Produto.codigo, Produto.nome).order_by(Produto.id)
+    produto_id_filter = request.args.get('produto_id', type=int)
+    if produto_id_filter:
+        query = query.filter(Produto.id == produto_id_filter)
+
+    paginated_products = query.paginate(page=page, per_page=per_page, error_out=False)
+    saldos = estoque_em(em, [linha.id for linha in paginated_products.items])
+
+    return jsonify({
+        'em': em.isoformat(),
+        'items': [{'id': linha.id, 'codigo': linha.codigo, 'nome': linha.nome, 'estoque': saldos.get(linha.id)} for linha in paginated_products.items],
+        'total_items': paginated_products.total,
+        'total_pages': paginated_products.pages,
+        'current_page': paginated_products.page,
+        'per_page': paginated_products.per_page,
+        'has_next': paginated_products.has_next,
+        'has_prev': paginated_products.has_prev
+    }), 200
+
+
+# --- Arquivamento de Movimentações (partições mensais) ---
+def _somar_meses(mes, meses):
+    indice = mes.year * 12 + mes.month - 1 + meses
+    return datetime(indice // 12, indice % 12 + 1, 1)
+
+def _limite_arquivo_no_banco():
+    ultimo = db.session.query(db.func.max(ResumoArquivoMes.mes)).scalar()
+    return _somar_meses(ultimo, 1) if ultimo is not None else None
+
+def limite_arquivo():
+    # Primeiro instante fora do arquivo (início do mês seguinte ao último mês arquivado), ou None sem arquivo.
+    # O arquivamento segue a ordem (data_hora, id): toda linha arquivada é anterior às que ficaram na tabela quente.
+    # Guardado no cache de entidades: arquivar_movimentacoes invalida a chave; em outros workers (cache em
+    # memória) o valor vale por até CACHE_TTL_SEGUNDOS
+    cache = obter_cache()
+    entrada = cache.obter('arquivo:limite')
+    if entrada is None:
+        limite = _limite_arquivo_no_banco()
+        entrada = {'limite': limite.isoformat() if limite else None}
+        cache.definir('arquivo:limite', entrada)
+    return datetime.fromisoformat(entrada['limite']) if entrada['limite'] else None
+
+def _garantir_particao_arquivo(mes):
+    # MySQL: uma partição por mês, separada da partição final; descartar um mês antigo vira DROP PARTITION.
+    # Outros bancos guardam o arquivo numa tabela comum.
+    if db.session.get_bind().dialect.name != 'mysql':
+        return
+    existentes = {nome for (nome,) in db.session.execute(text(
+        "SELECT partition_name FROM information_schema.partitions WHERE table_schema = DATABASE() "
+        "AND table_name = 'movimentacoes_arquivo' AND partition_name IS NOT NULL"
+    ))}
+    nome = f"p{mes:%Y%m}"
+    # Meses anteriores à última partição criada caem nela (VALUES LESS THAN)
+    if nome in existentes or any(existente != 'pmax' and existente > nome for existente in existentes):
+        return
+    db.session.execute(text(
+        f"ALTER TABLE movimentacoes_arquivo REORGANIZE PARTITION pmax INTO ("
+        f"PARTITION {nome} VALUES LESS THAN (TO_DAYS('{_somar_meses(mes, 1):%Y-%m-%d}')), "
+        f"PARTITION pmax VALUES LESS THAN MAXVALUE)"
+    ))
+    db.session.commit()
+
+def arquivar_movimentacoes(meses):
+    # Move para o arquivo os meses completos anteriores aos últimos `meses` meses, do mais antigo para o mais novo.
+    # Cada lote é copiado, somado no resumo do mês e apagado da tabela quente na mesma transação; os agregados
+    # (rollups), o estoque e os contadores do dashboard não mudam.
+    hoje = datetime.now()
+    limite = _somar_meses(datetime(hoje.year, hoje.month, 1), -meses)
+    tamanho_lote = current_app.config['ARQUIVO_MOVIMENTACOES_LOTE']
+    colunas = [coluna.key for coluna in MovimentacaoArquivada.__table__.columns]
+    arquivadas = 0
+
+    while True:
+        primeira = db.session.query(db.func.min(Movimentacao.data_hora)).filter(Movimentacao.data_hora < limite).scalar()
+        if primeira is None:
+            break
+        mes = datetime(primeira.year, primeira.month, 1)
+        fim = _somar_meses(mes, 1)
+        _garantir_particao_arquivo(mes)
+
+        while True:
+            ids = [movimentacao_id for (movimentacao_id,) in db.session.query(Movimentacao.id).filter(
+                Movimentacao.data_hora >= mes, Movimentacao.data_hora < fim
+            ).order_by(Movimentacao.data_hora, Movimentacao.id).limit(tamanho_lote).all()]
+            if not ids:
+                break
+
+            db.session.execute(insert(MovimentacaoArquivada).from_select(
+                colunas, select(*[getattr(Movimentacao, coluna) for coluna in colunas]).where(Movimentacao.id.in_(ids))
+            ))
+            quantidade_entrada, quantidade_saida, entradas, saidas = db.session.query(
+                db.func.sum(case((Movimentacao.tipo_movimentacao == 'entrada', Movimentacao.quantidade), else_=0)),
+                db.func.sum(case((Movimentacao.tipo_movimentacao == 'saida', Movimentacao.quantidade), else_=0)),
+                db.func.sum(case((Movimentacao.tipo_movimentacao == 'entrada', 1), else_=0)),
+                db.func.sum(case((Movimentacao.tipo_movimentacao == 'saida', 1), else_=0))
+            ).filter(Movimentacao.id.in_(ids)).one()
+
+            resumo = db.session.get(ResumoArquivoMes, mes.date())
+            if resumo is None:
+                resumo = ResumoArquivoMes(mes=mes.date(), total_linhas=0, quantidade_entrada=0, quantidade_saida=0, entradas=0, saidas=0)
+                db.session.add(resumo)
+            resumo.total_linhas += len(ids)
+            resumo.quantidade_entrada += quantidade_entrada or 0
+            resumo.quantidade_saida += quantidade_saida or 0
+            resumo.entradas += entradas or 0
+            resumo.saidas += saidas or 0
+            resumo.arquivado_em = datetime.now()
+
+            Movimentacao.query.filter(Movimentacao.id.in_(ids)).delete(synchronize_session=False)
+            db.session.commit()
+            obter_cache().remover('arquivo:limite')
+            arquivadas += len(ids)
+        logger.info("movimentacoes_arquivadas mes=%s total=%s", mes.strftime('%Y-%m'), arquivadas)
+    return arquivadas
+
+def _consulta_arquivo_movimentacoes(query=None):
+    # Consulta filtrada do arquivo quando o intervalo pedido começa antes do limite do arquivo; sem start_date o
+    # intervalo começa em -infinito e alcança o arquivo. ?incluir_arquivo=false responde só a tabela quente.
+    # None quando o arquivo fica de fora
+    if request.args.get('incluir_arquivo', 'true').lower() == 'false':
+        return None
+    limite = limite_arquivo()
+    if limite is None:
+        return None
+    start_date_filter = request.args.get('start_date', type=str)
+    if start_date_filter:
+        try:
+            if datetime.fromisoformat(start_date_filter) >= limite:
+                return None
+        except ValueError:
+            pass # _filtrar_movimentacoes reporta a data inválida
+    query = query if query is not None else MovimentacaoArquivada.query
+    return _filtrar_movimentacoes(
+        query.order_by(MovimentacaoArquivada.data_hora.desc(), MovimentacaoArquivada.id.desc()), MovimentacaoArquivada
+    )
+
+def _pagina_com_arquivo(query, arquivo, page, per_page, total_arquivo=None):
+    # Paginação por offset sobre a tabela quente seguida do arquivo; total_arquivo evita o COUNT no arquivo
+    page, per_page = max(page, 1), max(per_page, 1)
+    total_quente = query.order_by(None).count()
+    total = total_quente + (total_arquivo if total_arquivo is not None else arquivo.order_by(None).count())
+    inicio = (page - 1) * per_page
+    items = query.offset(inicio).limit(per_page).all() if inicio < total_quente else []
+    if len(items) < per_page:
+        items += arquivo.offset(max(inicio - total_quente, 0)).limit(per_page - len(items)).all()
+    total_pages = -(-total // per_page)
+    return items, {
+        'total_items': total,
+        'total_pages': total_pages,
+        'current_page': page,
+        'per_page': per_page,
+        'has_next': page < total_pages,
+        'has_prev': page > 1
+    }
+
+@api.cli.command('arquivar-movimentacoes')
+@click.option('--meses', default=None, type=int, help='Meses completos mantidos na tabela quente (padrão: ARQUIVO_MOVIMENTACOES_MESES).')
+def arquivar_movimentacoes_command(meses):
+    meses = current_app.config['ARQUIVO_MOVIMENTACOES_MESES'] if meses is None else meses
+    arquivadas = arquivar_movimentacoes(meses)
+    limite = _limite_arquivo_no_banco()
+    print(f"{arquivadas} movimentação(ões) arquivada(s). Arquivo até {limite.isoformat() if limite else '-'}.")
+
+@api.route('/movimentacoes/arquivo', methods=['GET'])
+@jwt_required() # Protege a rota de resumo do arquivo de movimentações
+@rota_leitura
+def get_arquivo_movimentacoes():
+    meses = ResumoArquivoMes.query.order_by(ResumoArquivoMes.mes.desc()).all()
+    limite = limite_arquivo()
+    return jsonify({
+        'limite': limite.isoformat() if limite else None,
+        'meses': [mes.to_dict() for mes in meses]
+    }), 200
+
+
 # --- Rotas da API para Movimentações ---
 
-@app.route('/movimentacoes', methods=['POST'])
+@api.route('/movimentacoes', methods=['POST'])
 @jwt_required() # Protege a rota de adicionar movimentação
+@idempotente
 def add_movimentacao():
     data = request.get_json()
 
@@ -536,14 +3745,40 @@ def add_movimentacao():
     else:
         cliente_id = None
 
+    deposito_id = data.get('deposito_id') or DEPOSITO_PADRAO_ID
+    if not deposito_ativo(deposito_id):
+        return jsonify({"message": "Depósito não encontrado ou inativo."}), 400
 
-    try:
-        if tipo_movimentacao == 'entrada':
-            produto.estoque_atual += quantidade
-        elif tipo_movimentacao == 'saida':
-            if produto.estoque_atual < quantidade:
-                return jsonify({"message": "Estoque insuficiente para esta saída."}), 400
-            produto.estoque_atual -= quantidade
+    journal = obter_journal_movimentacoes()
+    if journal is None and journal_em_outro_processo():
+        return _resposta_journal_em_outro_processo()
+    if journal is not None:
+        try:
+            registro = journal.registrar({
+                'produto_id': produto.id,
+                'tipo_movimentacao': tipo_movimentacao,
+                'quantidade': quantidade,
+                'observacao': data.get('observacao'),
+                'numero_nota_fiscal': data.get('numero_nota_fiscal'),
+                'cliente_id': cliente_id,
+                'deposito_id': deposito_id
+            })
+        except EstoqueInsuficiente:
+            db.session.rollback()
+            return jsonify({"message": "Estoque insuficiente para esta saída."}), 400
+        except Exception as e:
+            db.session.rollback()
+            return jsonify({"message": f"Erro ao registrar movimentação: {str(e)}"}), 500
+        # Durável no journal; o estoque no banco é atualizado em instantes pela aplicação em grupo
+        return jsonify({
+            "message": f"Movimentação de {tipo_movimentacao} recebida! O estoque será atualizado em instantes.",
+            "movimentacao": registro,
+            "situacao": f"/movimentacoes/journal/{registro['seq']}"
+        }), 202
+
+    def registrar():
+        delta = quantidade if tipo_movimentacao == 'entrada' else -quantidade
+        ajustar_estoque_deposito(produto_id, deposito_id, delta)
 
         nova_movimentacao = Movimentacao(
             produto_id=produto_id,
@@ -551,65 +3786,275 @@ def add_movimentacao():
             quantidade=quantidade,
             observacao=data.get('observacao'),
             numero_nota_fiscal=data.get('numero_nota_fiscal'),
-            cliente_id=cliente_id
+            cliente_id=cliente_id,
+            deposito_id=deposito_id
         )
 
         db.session.add(nova_movimentacao)
+        db.session.flush() # Preenche data_hora para o agregado
+        registrar_pendencias_estoque([pendencia_estoque(produto_id, delta, tipo_movimentacao, quantidade, cliente_id, nova_movimentacao.data_hora)])
         db.session.commit()
+        return nova_movimentacao
+
+    try:
+        nova_movimentacao = _com_retentativas(registrar)
+        invalidar_cache('produto', produto_id)
         return jsonify({"message": f"Movimentação de {tipo_movimentacao} registrada com sucesso! Estoque atualizado.", "movimentacao": nova_movimentacao.to_dict()}), 201
+    except EstoqueInsuficiente:
+        db.session.rollback()
+        return jsonify({"message": "Estoque insuficiente para esta saída."}), 400
     except Exception as e:
         db.session.rollback()
         return jsonify({"message": f"Erro ao registrar movimentação: {str(e)}"}), 500
 
-@app.route('/movimentacoes', methods=['GET'])
+# --- Lançamento de Movimentações em Lote ---
+def _ler_lote_movimentacoes():
+    # Aceita um array JSON (ou {"movimentacoes": [...]}) ou um stream NDJSON, uma movimentação por linha
+    if request.mimetype in ('application/x-ndjson', 'application/ndjson'):
+        linhas = []
+        for linha_bruta in request.get_data().splitlines(): # get_data: o corpo também entra na impressão da Idempotency-Key
+            linha_bruta = linha_bruta.strip()
+            if not linha_bruta:
+                continue
+            try:
+                linhas.append(json.loads(linha_bruta))
+            except ValueError:
+                linhas.append(None) # Linha inválida, reportada individualmente
+        return linhas
+
+    data = request.get_json(silent=True)
+    if isinstance(data, dict):
+        data = data.get('movimentacoes')
+    return data if isinstance(data, list) else None
+
+def _validar_item_lote(item):
+    # Retorna (movimentação normalizada, None) ou (None, mensagem de erro)
+    if not isinstance(item, dict):
+        return None, "Linha inválida. Esperado um objeto JSON."
+    if not all(k in item for k in ['produto_id', 'tipo_movimentacao', 'quantidade']):
+        return None, "Dados da movimentação incompletos."
+
+    produto_id = item['produto_id']
+    if not isinstance(produto_id, int) or isinstance(produto_id, bool):
+        return None, "Produto inválido."
+
+    quantidade = item['quantidade']
+    if not isinstance(quantidade, int) or isinstance(quantidade, bool) or quantidade <= 0:
+        return None, "Quantidade deve ser um inteiro maior que zero."
+
+    tipo_movimentacao = item['tipo_movimentacao']
+    if tipo_movimentacao not in ['entrada', 'saida']:
+        return None, "Tipo de movimentação inválido. Use 'entrada' ou 'saida'."
+
+    cliente_id = item.get('cliente_id')
+    if tipo_movimentacao != 'saida' or cliente_id in (None, ''):
+        cliente_id = None
+    elif not isinstance(cliente_id, int) or isinstance(cliente_id, bool):
+        return None, "Cliente inválido."
+
+    deposito_id = item.get('deposito_id') or DEPOSITO_PADRAO_ID
+    if not isinstance(deposito_id, int) or isinstance(deposito_id, bool):
+        return None, "Depósito inválido."
+
+    return {
+        'produto_id': produto_id,
+        'tipo_movimentacao': tipo_movimentacao,
+        'quantidade': quantidade,
+        'observacao': item.get('observacao'),
+        'numero_nota_fiscal': item.get('numero_nota_fiscal'),
+        'cliente_id': cliente_id,
+        'deposito_id': deposito_id
+    }, None
+
+def _planejar_chunk_lote(chunk, estoques, clientes_existentes, resultados):
+    novas_movimentacoes = []
+    deltas = defaultdict(int) # Variação de estoque agrupada por (produto_id, deposito_id)
+    aceitas = []
+
+    for indice, mov in chunk:
+        chave = (mov['produto_id'], mov['deposito_id'])
+        if chave not in estoques:
+            resultados[indice] = {'linha': indice + 1, 'status': 'erro', 'message': "Produto não encontrado."}
+            continue
+        if mov['cliente_id'] is not None and mov['cliente_id'] not in clientes_existentes:
+            resultados[indice] = {'linha': indice + 1, 'status': 'erro', 'message': "Cliente não encontrado com o ID fornecido para esta saída."}
+            continue
+
+        if mov['tipo_movimentacao'] == 'saida':
+            if estoques[chave] + deltas[chave] < mov['quantidade']:
+                resultados[indice] = {'linha': indice + 1, 'status': 'erro', 'message': "Estoque insuficiente para esta saída."}
+                continue
+            deltas[chave] -= mov['quantidade']
+        else:
+            deltas[chave] += mov['quantidade']
+
+        novas_movimentacoes.append(dict(mov, data_hora=datetime.now()))
+        aceitas.append(indice)
+
+    return novas_movimentacoes, deltas, aceitas
+
+def _aplicar_chunk_lote(novas_movimentacoes, deltas):
+    # deltas: {(produto_id, deposito_id): variação}. Saldos dos depósitos em ordem de chave (sem deadlock entre chunks
+    # concorrentes); o agregado de cada produto fica para a consolidação, como nas movimentações individuais
+    for (produto_id, deposito_id), delta in sorted(deltas.items()):
+        if delta:
+            ajustar_estoque_deposito(produto_id, deposito_id, delta)
+
+    db.session.execute(insert(Movimentacao), novas_movimentacoes)
+    registrar_pendencias_estoque([pendencia_movimentacao(mov) for mov in novas_movimentacoes])
+
+def _saldos_depositos(chaves):
+    # {(produto_id, deposito_id): estoque} das linhas existentes entre as chaves pedidas
+    chaves = set(chaves)
+    if not chaves:
+        return {}
+    linhas = db.session.query(EstoqueDeposito.produto_id, EstoqueDeposito.deposito_id, EstoqueDeposito.estoque).filter(
+        EstoqueDeposito.produto_id.in_({produto_id for produto_id, _ in chaves}),
+        EstoqueDeposito.deposito_id.in_({deposito_id for _, deposito_id in chaves})
+    ).all()
+    return {(produto_id, deposito_id): estoque for produto_id, deposito_id, estoque in linhas if (produto_id, deposito_id) in chaves}
+
+def _gravar_chunk_lote(novas_movimentacoes, deltas):
+    travar_saldos_journal(deltas)
+    _aplicar_chunk_lote(novas_movimentacoes, deltas)
+    db.session.commit()
+
+@api.route('/movimentacoes/lote', methods=['POST'])
+@jwt_required() # Protege a rota de lançamento em lote
+@idempotente
+def add_movimentacoes_lote():
+    linhas = _ler_lote_movimentacoes()
+    if linhas is None:
+        return jsonify({"message": "Envie um array JSON de movimentações ou um stream NDJSON."}), 400
+    if not linhas:
+        return jsonify({"message": "Nenhuma movimentação enviada."}), 400
+    if len(linhas) > current_app.config['MOVIMENTACOES_LOTE_MAX_LINHAS']:
+        return jsonify({"message": f"Lote excede o limite de {current_app.config['MOVIMENTACOES_LOTE_MAX_LINHAS']} movimentações."}), 413
+    if journal_em_outro_processo():
+        return _resposta_journal_em_outro_processo()
+
+    tamanho_chunk = request.args.get('chunk', current_app.config['MOVIMENTACOES_LOTE_CHUNK'], type=int)
+    if tamanho_chunk <= 0:
+        return jsonify({"message": "Tamanho de chunk deve ser maior que zero."}), 400
+
+    resultados = [None] * len(linhas)
+    validas = []
+    for indice, item in enumerate(linhas):
+        movimentacao, erro = _validar_item_lote(item)
+        if erro:
+            resultados[indice] = {'linha': indice + 1, 'status': 'erro', 'message': erro}
+        else:
+            validas.append((indice, movimentacao))
+
+    # Uma única consulta por tabela para validar todos os produtos, depósitos e clientes do lote
+    deposito_ids = {mov['deposito_id'] for _, mov in validas}
+    depositos_ativos = {
+        deposito_id for (deposito_id,) in db.session.query(Deposito.id).filter(Deposito.id.in_(deposito_ids), Deposito.ativo == True).all()
+    } if deposito_ids else set()
+    for indice, mov in validas:
+        if mov['deposito_id'] not in depositos_ativos:
+            resultados[indice] = {'linha': indice + 1, 'status': 'erro', 'message': "Depósito não encontrado ou inativo."}
+    validas = [(indice, mov) for indice, mov in validas if mov['deposito_id'] in depositos_ativos]
+
+    produto_ids = {mov['produto_id'] for _, mov in validas}
+    cliente_ids = {mov['cliente_id'] for _, mov in validas if mov['cliente_id'] is not None}
+    produtos_existentes = {
+        produto_id for (produto_id,) in db.session.query(Produto.id).filter(Produto.id.in_(produto_ids)).all()
+    } if produto_ids else set()
+    # Saldo por (produto, depósito); sem linha ainda = 0
+    estoques = {(mov['produto_id'], mov['deposito_id']): 0 for _, mov in validas if mov['produto_id'] in produtos_existentes}
+    estoques.update(_saldos_depositos(estoques))
+    clientes_existentes = {
+        cliente_id for (cliente_id,) in db.session.query(Cliente.id).filter(Cliente.id.in_(cliente_ids)).all()
+    } if cliente_ids else set()
+
+    for inicio in range(0, len(validas), tamanho_chunk):
+        chunk = validas[inicio:inicio + tamanho_chunk]
+
+        for tentativa in range(1, current_app.config['ESTOQUE_MAX_TENTATIVAS'] + 1):
+            novas_movimentacoes, deltas, aceitas = _planejar_chunk_lote(chunk, estoques, clientes_existentes, resultados)
+            if not novas_movimentacoes:
+                break
+
+            try:
+                _com_retentativas(lambda: _gravar_chunk_lote(novas_movimentacoes, deltas))
+            except EstoqueInsuficiente:
+                db.session.rollback()
+                # Outra transação consumiu o estoque entre a leitura e a escrita: recarrega e replaneja o chunk
+                estoques.update(_saldos_depositos(deltas))
+                if tentativa < current_app.config['ESTOQUE_MAX_TENTATIVAS']:
+                    continue
+                for indice in aceitas:
+                    resultados[indice] = {'linha': indice + 1, 'status': 'erro', 'message': "Estoque insuficiente para esta saída."}
+                break
+            except Exception as e:
+                db.session.rollback()
+                for indice in aceitas:
+                    resultados[indice] = {'linha': indice + 1, 'status': 'erro', 'message': f"Erro ao registrar movimentação: {str(e)}"}
+                break
+
+            for chave, delta in deltas.items():
+                estoques[chave] += delta
+            invalidar_cache('produto', *{produto_id for produto_id, _ in deltas})
+            for indice in aceitas:
+                resultados[indice] = {'linha': indice + 1, 'status': 'ok'}
+            break
+
+    total_sucesso = sum(1 for r in resultados if r['status'] == 'ok')
+    return jsonify({
+        "message": f"{total_sucesso} de {len(linhas)} movimentações registradas com sucesso.",
+        "total": len(linhas),
+        "sucesso": total_sucesso,
+        "erros": len(linhas) - total_sucesso,
+        "resultados": resultados
+    }), 200
+
+@api.cli.command('medir-lote')
+@click.option('--linhas', default=2000, show_default=True, help='Movimentações lançadas em cada modo.')
+@click.option('--produtos', default=50, show_default=True, help='Produtos entre os quais as linhas se repartem.')
+@click.option('--banco', default=None, help='URL de um banco descartável (padrão: SQLite temporário).')
+def medir_lote_command(linhas, produtos, banco):
+    # N POSTs individuais contra um POST /movimentacoes/lote com as mesmas N linhas, num processo novo
+    import benchmarks
+    medicao = benchmarks.executar('lote', linhas, produtos, banco=banco)
+    print(f"individual: {medicao['individual_por_segundo']:.0f} movimentações/s (erros={medicao['erros_individuais']})")
+    print(f"lote: {medicao['lote_por_segundo']:.0f} movimentações/s (erros={medicao['erros_lote']})")
+    print(f"ganho: {medicao['lote_por_segundo'] / medicao['individual_por_segundo']:.1f}x "
+          f"estoque_total={medicao['estoque_total']} (esperado {2 * linhas})")
+
+@api.route('/movimentacoes', methods=['GET'])
 @jwt_required() # Protege a rota de listar movimentações
+@rota_leitura
 def get_movimentacoes():
-    produto_id_filter = request.args.get('produto_id', type=int)
-    tipo_movimentacao_filter = request.args.get('tipo', type=str)
-    start_date_filter = request.args.get('start_date', type=str)
-    end_date_filter = request.args.get('end_date', type=str)
-
     page = request.args.get('page', 1, type=int)
     per_page = request.args.get('per_page', 10, type=int)
 
-    query = Movimentacao.query.order_by(Movimentacao.data_hora.desc())
-
-    if produto_id_filter:
-        query = query.filter_by(produto_id=produto_id_filter)
-    if tipo_movimentacao_filter:
-        query = query.filter_by(tipo_movimentacao=tipo_movimentacao_filter)
-    
-    if start_date_filter:
-        try:
-            start_dt = datetime.fromisoformat(start_date_filter)
-            query = query.filter(Movimentacao.data_hora >= start_dt)
-        except ValueError:
-            return jsonify({"message": "Formato de data de início inválido. UseYYYY-MM-DD."}), 400
-    
-    if end_date_filter:
-        try:
-            end_dt = datetime.fromisoformat(end_date_filter)
-            end_dt = end_dt.replace(hour=23, minute=59, second=59, microsecond=999999)
-            query = query.filter(Movimentacao.data_hora <= end_dt)
-        except ValueError:
-            return jsonify({"message": "Formato de data de fim inválido. UseYYYY-MM-DD."}), 400
-
-    if request.args.get('cliente_id', type=int):
-        query = query.filter_by(cliente_id=request.args.get('cliente_id', type=int))
+    # Produto e cliente vêm por LEFT JOIN na mesma consulta (sem N+1 por linha da página)
+    try:
+        query = _filtrar_movimentacoes(Movimentacao.query.order_by(Movimentacao.data_hora.desc(), Movimentacao.id.desc()))
+        query, codificar = SERIALIZADORES['movimentacoes'].aplicar(query, campos_solicitados())
+        arquivo = _consulta_arquivo_movimentacoes()
+        if arquivo is not None:
+            arquivo, _ = SERIALIZADORES['movimentacoes_arquivadas'].aplicar(arquivo, campos_solicitados())
+    except ValueError as e:
+        return jsonify({"message": str(e)}), 400
+
+    if 'cursor' in request.args:
+        continuacao = (arquivo, [MovimentacaoArquivada.data_hora, MovimentacaoArquivada.id]) if arquivo is not None else None
+        return _resposta_por_cursor(query, [Movimentacao.data_hora, Movimentacao.id], codificar, descendente=True, continuacao=continuacao)
+
+    if arquivo is not None:
+        # Sem filtros, o total do arquivo vem do resumo mensal
+        filtros = ['produto_id', 'tipo', 'start_date', 'end_date', 'cliente_id', 'deposito_id']
+        total_arquivo = None
+        if not any(request.args.get(filtro) for filtro in filtros):
+            total_arquivo = db.session.query(db.func.coalesce(db.func.sum(ResumoArquivoMes.total_linhas), 0)).scalar()
+        items, paginacao = _pagina_com_arquivo(query, arquivo, page, per_page, total_arquivo)
+        return jsonify({'items': [codificar(linha) for linha in items], **paginacao}), 200
 
     paginated_movs = query.paginate(page=page, per_page=per_page, error_out=False)
 
-    movimentacoes_json = []
-    for mov in paginated_movs.items:
-        mov_dict = mov.to_dict()
-        produto = Produto.query.get(mov.produto_id)
-        if produto:
-            mov_dict['produto_nome'] = produto.nome
-            mov_dict['produto_codigo'] = produto.codigo
-        cliente = Cliente.query.get(mov.cliente_id)
-        if cliente:
-            mov_dict['cliente_nome'] = cliente.nome
-        movimentacoes_json.append(mov_dict)
+    movimentacoes_json = [codificar(linha) for linha in paginated_movs.items]
     
     return jsonify({
         'items': movimentacoes_json,
@@ -621,78 +4066,685 @@ def get_movimentacoes():
         'has_prev': paginated_movs.has_prev
     }), 200
 
-@app.route('/produtos/<int:produto_id>/movimentacoes', methods=['GET'])
+@api.route('/produtos/<int:produto_id>/movimentacoes', methods=['GET'])
 @jwt_required() # Protege a rota de listar movimentações por produto
+@rota_leitura
 def get_movimentacoes_por_produto(produto_id):
     produto = Produto.query.get(produto_id)
     if not produto:
         return jsonify({"message": "Produto não encontrado."}), 404
 
-    tipo_movimentacao_filter = request.args.get('tipo', type=str)
-    start_date_filter = request.args.get('start_date', type=str)
-    end_date_filter = request.args.get('end_date', type=str)
+    page = request.args.get('page', 1, type=int)
+    per_page = request.args.get('per_page', 10, type=int)
 
-    query = Movimentacao.query.filter_by(produto_id=produto_id).order_by(Movimentacao.data_hora.desc())
+    # Mesmos filtros da listagem geral, sempre paginado (como GET /movimentacoes)
+    try:
+        query = _filtrar_movimentacoes(
+            Movimentacao.query.filter_by(produto_id=produto_id).order_by(Movimentacao.data_hora.desc(), Movimentacao.id.desc())
+        )
+        query, codificar = SERIALIZADORES['movimentacoes'].aplicar(query, campos_solicitados())
+        arquivo = _consulta_arquivo_movimentacoes(MovimentacaoArquivada.query.filter_by(produto_id=produto_id))
+        if arquivo is not None:
+            arquivo, _ = SERIALIZADORES['movimentacoes_arquivadas'].aplicar(arquivo, campos_solicitados())
+    except ValueError as e:
+        return jsonify({"message": str(e)}), 400
 
-    if tipo_movimentacao_filter:
-        query = query.filter_by(tipo_movimentacao=tipo_movimentacao_filter)
-    
-    if start_date_filter:
+    if 'cursor' in request.args:
+        continuacao = (arquivo, [MovimentacaoArquivada.data_hora, MovimentacaoArquivada.id]) if arquivo is not None else None
+        return _resposta_por_cursor(query, [Movimentacao.data_hora, Movimentacao.id], codificar, descendente=True, continuacao=continuacao)
+
+    if arquivo is not None:
+        items, paginacao = _pagina_com_arquivo(query, arquivo, page, per_page)
+        return jsonify({'items': [codificar(linha) for linha in items], **paginacao}), 200
+
+    paginated_movs = query.paginate(page=page, per_page=per_page, error_out=False)
+    return jsonify({
+        'items': [codificar(linha) for linha in paginated_movs.items],
+        'total_items': paginated_movs.total,
+        'total_pages': paginated_movs.pages,
+        'current_page': paginated_movs.page,
+        'per_page': paginated_movs.per_page,
+        'has_next': paginated_movs.has_next,
+        'has_prev': paginated_movs.has_prev
+    }), 200
+
+
+# --- Journal de Movimentações (write-behind com group commit) ---
+class JournalMovimentacoes:
+    # A movimentação é validada contra o saldo do depósito no banco mais as reservas ainda não aplicadas, gravada num
+    # arquivo append-only (um fsync por grupo de requisições concorrentes) e só então confirmada. Uma thread
+    # aplica os registros em lotes, numa transação por lote que também grava a última sequência aplicada em
+    # journal_checkpoints; ao abrir o journal, os registros depois do checkpoint voltam para a fila.
+    def __init__(self, flask_app, caminho):
+        import fcntl # Só Unix; o arquivo fica travado para um único processo
+        self._app = flask_app
+        self._nome = os.path.basename(caminho)
+        self._arquivo = open(caminho, 'a+b')
         try:
-            start_dt = datetime.fromisoformat(start_date_filter)
-            query = query.filter(Movimentacao.data_hora >= start_dt)
-        except ValueError:
-            return jsonify({"message": "Formato de data de início inválido. UseYYYY-MM-DD."}), 400
-    
-    if end_date_filter:
+            fcntl.flock(self._arquivo, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            self._arquivo.close()
+            raise
+        self._cond = threading.Condition()
+        self._escrita_lock = threading.Lock()
+        self._travas = [threading.Lock() for _ in range(64)] # Verificação + reserva serializadas por saldo
+        self._buffer = [] # Registros aguardando o próximo fsync
+        self._fila = deque() # Registros duráveis aguardando aplicação no banco
+        self._reservas = defaultdict(list) # (produto_id, deposito_id) -> [(seq, delta)] ainda não aplicados
+        self._erro = None
+        self._recuperar()
+        threading.Thread(target=self._gravar, daemon=True, name='journal-gravacao').start()
+        threading.Thread(target=self._aplicar, daemon=True, name='journal-aplicacao').start()
+
+    def _recuperar(self):
+        checkpoint = db.session.get(JournalCheckpoint, self._nome)
+        if checkpoint is None:
+            checkpoint = JournalCheckpoint(nome=self._nome, ultima_sequencia=0)
+            db.session.add(checkpoint)
+        self._aplicada = checkpoint.ultima_sequencia
+        db.session.commit()
+
+        self._ultima = self._aplicada
+        self._arquivo.seek(0)
+        valido = 0
+        for linha in self._arquivo:
+            try:
+                registro = json.loads(linha)
+            except ValueError:
+                break # Última linha incompleta (queda no meio da escrita): nunca foi confirmada
+            valido += len(linha)
+            registro.setdefault('deposito_id', DEPOSITO_PADRAO_ID) # Registros gravados antes dos depósitos
+            if registro['seq'] > self._aplicada:
+                self._fila.append(registro)
+                self._reservas[self._chave(registro)].append((registro['seq'], self._delta(registro)))
+            self._ultima = max(self._ultima, registro['seq'])
+        self._arquivo.truncate(valido)
+        self._gravada = self._ultima
+        if self._fila:
+            logger.info("journal_recuperado arquivo=%s pendentes=%s", self._nome, len(self._fila))
+
+    @staticmethod
+    def _delta(registro):
+        return registro['quantidade'] if registro['tipo_movimentacao'] == 'entrada' else -registro['quantidade']
+
+    @staticmethod
+    def _chave(registro):
+        return registro['produto_id'], registro['deposito_id']
+
+    def _trava(self, chave):
+        return self._travas[hash(chave) % len(self._travas)]
+
+    def travar_saldos(self, chaves):
+        # Escritas síncronas de estoque neste processo (lote, transferências, ajuste e exclusão de produto): seguram
+        # as travas dos saldos até o fim da transação, para nenhuma reserva nova ser aceita contra um saldo que
+        # ainda vai mudar. Uma chamada por transação, com todas as chaves, na ordem das travas (sem deadlock).
+        travadas = db.session.info.setdefault('travas_journal', [])
+        for trava in sorted({self._trava(chave) for chave in chaves}, key=self._travas.index):
+            if trava not in travadas:
+                trava.acquire()
+                travadas.append(trava)
+
+    def conferir_reservas(self, produto_id, deposito_id):
+        # Chamado depois de um débito síncrono, com a linha do saldo já travada pelo UPDATE: as reservas
+        # pendentes, aplicadas em ordem de sequência, ainda têm que caber no saldo. O checkpoint é lido com
+        # FOR SHARE (última aplicação confirmada), coerente com o saldo travado.
+        estoque = db.session.query(EstoqueDeposito.estoque).filter(
+            EstoqueDeposito.deposito_id == deposito_id, EstoqueDeposito.produto_id == produto_id
+        ).scalar()
+        aplicada = db.session.query(JournalCheckpoint.ultima_sequencia).filter(
+            JournalCheckpoint.nome == self._nome
+        ).with_for_update(read=True).scalar() or 0
+        with self._cond:
+            reservas = sorted(self._reservas.get((produto_id, deposito_id), ()))
+        acumulado = minimo = 0
+        for seq, variacao in reservas:
+            if seq > aplicada:
+                acumulado += variacao
+                minimo = min(minimo, acumulado)
+        if (estoque or 0) + minimo < 0:
+            raise EstoqueInsuficiente(produto_id)
+
+    def tem_pendentes(self, produto_id):
+        with self._cond:
+            return any(chave[0] == produto_id and reservas for chave, reservas in self._reservas.items())
+
+    def registrar(self, movimentacao):
+        produto_id, deposito_id = chave = self._chave(movimentacao)
+        delta = self._delta(movimentacao)
+        with self._trava(chave):
+            # As reservas são copiadas antes de ler o banco: uma reserva aplicada depois da cópia já está no
+            # estoque lido e é descartada pela sequência do checkpoint, lida na mesma consulta
+            with self._cond:
+                if self._erro is not None:
+                    raise RuntimeError(f"Journal de movimentações indisponível: {self._erro}")
+                reservas = list(self._reservas.get(chave, ()))
+            estoque, aplicada = db.session.query(
+                select(EstoqueDeposito.estoque).where(
+                    EstoqueDeposito.deposito_id == deposito_id, EstoqueDeposito.produto_id == produto_id
+                ).scalar_subquery(),
+                select(JournalCheckpoint.ultima_sequencia).where(JournalCheckpoint.nome == self._nome).scalar_subquery()
+            ).one()
+            disponivel = (estoque or 0) + sum(variacao for seq, variacao in reservas if seq > aplicada)
+            if disponivel + delta < 0:
+                raise EstoqueInsuficiente(produto_id)
+
+            with self._cond:
+                self._ultima += 1
+                registro = dict(movimentacao, seq=self._ultima, data_hora=datetime.now().isoformat())
+                self._buffer.append(registro)
+                self._reservas[chave].append((registro['seq'], delta))
+                self._cond.notify_all()
+
+        with self._cond:
+            while self._gravada < registro['seq'] and self._erro is None:
+                self._cond.wait()
+            if self._gravada < registro['seq']:
+                raise RuntimeError(f"Falha ao gravar o journal de movimentações: {self._erro}")
+        return registro
+
+    def _gravar(self):
+        while True:
+            with self._cond:
+                while not self._buffer:
+                    self._cond.wait()
+                grupo, self._buffer = self._buffer, []
+            dados = b''.join(json.dumps(registro, ensure_ascii=False).encode('utf-8') + b'\n' for registro in grupo)
+            try:
+                with self._escrita_lock:
+                    self._arquivo.write(dados)
+                    self._arquivo.flush()
+                    os.fsync(self._arquivo.fileno())
+            except OSError as e:
+                logger.exception("Erro ao gravar o journal de movimentações")
+                with self._cond:
+                    self._erro = e
+                    for registro in grupo:
+                        self._reservas[self._chave(registro)].remove((registro['seq'], self._delta(registro)))
+                    self._cond.notify_all()
+                return
+            with self._cond:
+                self._gravada = grupo[-1]['seq']
+                self._fila.extend(grupo)
+                self._cond.notify_all()
+
+    def _aplicar(self):
+        maximo = self._app.config['MOVIMENTACOES_JOURNAL_GRUPO_MAX']
+        espera = self._app.config['MOVIMENTACOES_JOURNAL_ESPERA_MS'] / 1000
+        with self._app.app_context():
+            while True:
+                with self._cond:
+                    while not self._fila:
+                        self._cond.wait()
+                    pequeno = len(self._fila) < maximo
+                if pequeno:
+                    time.sleep(espera) # Junta mais movimentações na mesma transação
+                with self._cond:
+                    grupo = [self._fila[indice] for indice in range(min(maximo, len(self._fila)))]
+                try:
+                    self._aplicar_grupo(grupo)
+                except Exception:
+                    db.session.rollback()
+                    logger.exception("Erro ao aplicar o journal de movimentações; nova tentativa em 1s")
+                    time.sleep(1)
+                finally:
+                    db.session.remove()
+
+    def _aplicar_grupo(self, grupo):
         try:
-            end_dt = datetime.fromisoformat(end_date_filter)
-            end_dt = end_dt.replace(hour=23, minute=59, second=59, microsecond=999999)
-            query = query.filter(Movimentacao.data_hora <= end_dt)
-        except ValueError:
-            return jsonify({"message": "Formato de data de fim inválido. UseYYYY-MM-DD."}), 400
+            _com_retentativas(lambda: self._gravar_no_banco(grupo))
+            self._confirmar(grupo)
+            return
+        except (EstoqueInsuficiente, IntegrityError):
+            db.session.rollback()
+        # Algum registro do grupo não pode ser aplicado. As escritas síncronas deste processo respeitam as reservas,
+        # então só sobra o que mudou o banco por fora (SQL manual, outro processo sem o journal): aplica um a um e
+        # grava a rejeição em journal_rejeicoes, consultável pelo cliente, para a fila não travar
+        for registro in grupo:
+            try:
+                _com_retentativas(lambda: self._gravar_no_banco([registro]))
+            except (EstoqueInsuficiente, IntegrityError) as e:
+                db.session.rollback()
+                motivo = ("Estoque insuficiente para esta saída." if isinstance(e, EstoqueInsuficiente)
+                          else "Produto, cliente ou depósito não existe mais.")
+                logger.error("journal_movimentacao_rejeitada seq=%s produto_id=%s tipo=%s quantidade=%s motivo=%s",
+                             registro['seq'], registro['produto_id'], registro['tipo_movimentacao'], registro['quantidade'], motivo)
+                _com_retentativas(lambda: self._gravar_no_banco([registro], rejeicao=motivo))
+            self._confirmar([registro])
+
+    def _gravar_no_banco(self, grupo, rejeicao=None):
+        db.session.info['aplicando_journal'] = True # As reservas sendo aplicadas não se conferem contra si mesmas
+        if rejeicao is not None:
+            registro = grupo[0]
+            db.session.add(JournalRejeicao(
+                nome=self._nome, sequencia=registro['seq'], produto_id=registro['produto_id'],
+                deposito_id=registro['deposito_id'], tipo_movimentacao=registro['tipo_movimentacao'],
+                quantidade=registro['quantidade'], motivo=rejeicao, registro=json.dumps(registro, ensure_ascii=False)
+            ))
+        else:
+            novas_movimentacoes = []
+            deltas = defaultdict(int)
+            for registro in grupo:
+                mov = {campo: registro[campo] for campo in ['produto_id', 'tipo_movimentacao', 'quantidade', 'observacao', 'numero_nota_fiscal', 'cliente_id', 'deposito_id']}
+                novas_movimentacoes.append(dict(mov, data_hora=datetime.fromisoformat(registro['data_hora'])))
+                deltas[self._chave(registro)] += self._delta(registro)
+            _aplicar_chunk_lote(novas_movimentacoes, deltas)
+        db.session.execute(
+            update(JournalCheckpoint).where(JournalCheckpoint.nome == self._nome)
+            .values(ultima_sequencia=grupo[-1]['seq'], atualizado_em=datetime.now())
+        )
+        db.session.commit()
 
+    def _confirmar(self, grupo):
+        chaves = {self._chave(registro) for registro in grupo}
+        with self._cond:
+            for _ in grupo:
+                self._fila.popleft()
+            self._aplicada = grupo[-1]['seq']
+            for chave in chaves:
+                restantes = [(seq, delta) for seq, delta in self._reservas[chave] if seq > self._aplicada]
+                if restantes:
+                    self._reservas[chave] = restantes
+                else:
+                    del self._reservas[chave]
+            if self._aplicada == self._ultima:
+                # Tudo aplicado: o arquivo pode recomeçar vazio (o checkpoint no banco guarda a sequência)
+                with self._escrita_lock:
+                    self._arquivo.truncate(0)
+            self._cond.notify_all()
+        invalidar_cache('produto', *{produto_id for produto_id, _ in chaves})
+
+    def aguardar_aplicacao(self, timeout=None):
+        # Espera até tudo o que foi confirmado estar no banco; False se o tempo acabar antes
+        limite = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while self._aplicada < self._ultima:
+                restante = None if limite is None else limite - time.monotonic()
+                if restante is not None and restante <= 0:
+                    return False
+                self._cond.wait(restante)
+        return True
+
+    def estado(self):
+        with self._cond:
+            return {
+                'arquivo': self._nome,
+                'ultima_sequencia': self._ultima,
+                'sequencia_gravada': self._gravada,
+                'sequencia_aplicada': self._aplicada,
+                'pendentes': self._ultima - self._aplicada,
+                'saldos_com_reserva': len(self._reservas),
+                'erro': str(self._erro) if self._erro is not None else None
+            }
+
+_journal_movimentacoes = None
+_journal_lock = threading.Lock()
+_journal_em_uso = False # Arquivo travado por outro processo: este não grava estoque (ver journal_em_outro_processo)
+
+@event.listens_for(SessionORM, 'after_transaction_end')
+def _liberar_travas_journal(session, transacao):
+    if transacao.parent is None:
+        session.info.pop('aplicando_journal', None)
+        for trava in session.info.pop('travas_journal', []):
+            trava.release()
+
+def travar_saldos_journal(chaves):
+    # Sem journal neste processo, nada a travar
+    if _journal_movimentacoes is not None:
+        _journal_movimentacoes.travar_saldos(chaves)
+
+def journal_em_outro_processo():
+    # Com o journal aberto por outro processo, as reservas pendentes (202 já respondidos) estão na memória dele:
+    # uma escrita de estoque aqui poderia consumir saldo prometido. As rotas respondem 503 e o cliente tenta de
+    # novo (o gunicorn.conf.py recomenda um único worker com o journal).
+    obter_journal_movimentacoes()
+    return _journal_em_uso
+
+def _resposta_journal_em_outro_processo():
+    return jsonify({"message": "Journal de movimentações em uso por outro processo. Tente novamente em instantes."}), 503, {'Retry-After': '1'}
+
+def obter_journal_movimentacoes():
+    # None com o modo desativado. Um journal por arquivo e por processo: com vários workers, só o primeiro
+    # que abrir o arquivo usa o modo; as reservas ficam em memória, e os demais recusam escritas de estoque.
+    global _journal_movimentacoes, _journal_em_uso
+    if not current_app.config['MOVIMENTACOES_JOURNAL_ARQUIVO'] or _journal_em_uso:
+        return None
+    if _journal_movimentacoes is None:
+        with _journal_lock:
+            if _journal_movimentacoes is None and not _journal_em_uso:
+                try:
+                    _journal_movimentacoes = JournalMovimentacoes(current_app._get_current_object(), current_app.config['MOVIMENTACOES_JOURNAL_ARQUIVO'])
+                except BlockingIOError:
+                    logger.warning("journal_em_uso arquivo=%s pid=%s: escritas de estoque recusadas neste processo",
+                                   current_app.config['MOVIMENTACOES_JOURNAL_ARQUIVO'], os.getpid())
+                    _journal_em_uso = True
+    return _journal_movimentacoes
+
+@api.before_app_request
+def _iniciar_journal_movimentacoes():
+    # Abre o journal (e reaplica o que ficou pendente) logo na primeira requisição do processo
+    if current_app.config['MOVIMENTACOES_JOURNAL_ARQUIVO'] and _journal_movimentacoes is None and not _journal_em_uso:
+        obter_journal_movimentacoes()
+
+@api.cli.command('aplicar-journal')
+@click.option('--timeout', default=300, show_default=True, help='Segundos máximos de espera.')
+def aplicar_journal_command(timeout):
+    # Recuperação sem servir requisições: reaplica o journal até o checkpoint alcançar o fim do arquivo
+    journal = obter_journal_movimentacoes()
+    if journal is None:
+        print("Journal de movimentações desativado ou em uso por outro processo.")
+        raise SystemExit(1)
+    if not journal.aguardar_aplicacao(timeout):
+        print(f"Tempo esgotado: {journal.estado()}")
+        raise SystemExit(1)
+    print(f"Journal aplicado: {journal.estado()}")
+
+@api.route('/movimentacoes/journal/<int:sequencia>', methods=['GET'])
+@jwt_required() # Protege a rota de situação de uma movimentação do journal
+def get_situacao_journal(sequencia):
+    # Situação de uma movimentação respondida com 202: pendente, aplicada ou rejeitada (com o motivo)
+    caminho = current_app.config['MOVIMENTACOES_JOURNAL_ARQUIVO']
+    if not caminho:
+        return jsonify({"message": "Journal de movimentações desativado."}), 404
+    nome = os.path.basename(caminho)
+    rejeicao = db.session.get(JournalRejeicao, (nome, sequencia))
+    if rejeicao is not None:
+        return jsonify(rejeicao.to_dict()), 200
+    aplicada = db.session.query(JournalCheckpoint.ultima_sequencia).filter(JournalCheckpoint.nome == nome).scalar() or 0
+    if sequencia <= aplicada:
+        return jsonify({'sequencia': sequencia, 'status': 'aplicada'}), 200
+    if _journal_movimentacoes is not None and sequencia > _journal_movimentacoes.estado()['ultima_sequencia']:
+        return jsonify({"message": "Movimentação não encontrada no journal."}), 404
+    return jsonify({'sequencia': sequencia, 'status': 'pendente'}), 200
+
+@api.cli.command('medir-movimentacoes')
+@click.option('--quantidade', default=2000, show_default=True, help='Saídas lançadas por modo.')
+@click.option('--threads', default=16, show_default=True, help='Requisições concorrentes.')
+@click.option('--banco', default=None, help='URL de um banco descartável (padrão: SQLite temporário por modo).')
+def medir_movimentacoes_command(quantidade, threads, banco):
+    # Compara o commit por requisição com o journal, cada modo num processo novo com o próprio banco
+    import benchmarks
+    for modo in ['sincrono', 'journal']:
+        with tempfile.TemporaryDirectory() as temporario:
+            journal = os.path.join(temporario, 'movimentacoes.journal') if modo == 'journal' else ''
+            medicao = benchmarks.executar('movimentacoes', quantidade, threads, 1, 0, banco=banco, MOVIMENTACOES_JOURNAL_ARQUIVO=journal)
+        print(f"{modo}: confirmadas/s={medicao['confirmadas_por_segundo']:.0f} aplicadas/s={medicao['aplicadas_por_segundo']:.0f} "
+              f"p50={medicao['latencia_p50_ms']:.1f}ms p99={medicao['latencia_p99_ms']:.1f}ms "
+              f"erros={medicao['erros']} estoque_final={medicao['estoque_final']}")
+
+# --- Depósitos (saldos por depósito e transferências) ---
+def sincronizar_deposito_padrao(produto_ids=None):
+    # estoque_atual alterado fora das movimentações (importação de catálogo, SQL manual): a diferença entre o
+    # agregado (com as pendências) e a soma dos depósitos vai para o depósito padrão
+    soma = select(
+        EstoqueDeposito.produto_id, db.func.sum(EstoqueDeposito.estoque).label('estoque')
+    ).group_by(EstoqueDeposito.produto_id).subquery()
+    pendente = estoque_pendente_subquery()
+    diferenca = Produto.estoque_atual + db.func.coalesce(pendente.c.variacao, 0) - db.func.coalesce(soma.c.estoque, 0)
+    query = db.session.query(Produto.id, diferenca).outerjoin(soma, soma.c.produto_id == Produto.id).outerjoin(
+        pendente, pendente.c.produto_id == Produto.id
+    ).filter(diferenca != 0)
+    if produto_ids is not None:
+        query = query.filter(Produto.id.in_(produto_ids))
+
+    corrigidos = 0
+    for produto_id, valor in query.all():
+        try:
+            with db.session.begin_nested():
+                ajustar_estoque_deposito(produto_id, DEPOSITO_PADRAO_ID, int(valor))
+            corrigidos += 1
+        except EstoqueInsuficiente:
+            logger.warning("Produto %s: estoque_atual menor que a soma dos outros depósitos; ajuste o estoque por depósito", produto_id)
+    db.session.commit()
+    return corrigidos
+
+@api.cli.command('sincronizar-depositos')
+def sincronizar_depositos_command():
+    corrigidos = sincronizar_deposito_padrao()
+    print(f"{corrigidos} produto(s) com o saldo do depósito padrão corrigido.")
+
+@api.route('/depositos', methods=['POST'])
+@jwt_required() # Protege a rota de adicionar depósito
+def add_deposito():
+    data = request.get_json()
+    if not data or not data.get('nome'):
+        return jsonify({"message": "Nome do depósito é obrigatório."}), 400
 
-    movimentacoes = query.all()
-    movimentacoes_json = []
-    for mov in movimentacoes:
-        mov_dict = mov.to_dict()
-        cliente = Cliente.query.get(mov.cliente_id)
-        if cliente:
-            mov_dict['cliente_nome'] = cliente.nome
-        movimentacoes_json.append(mov_dict)
-    return jsonify(movimentacoes_json), 200
+    valores_unicos = {'nome': data['nome']}
+    try:
+        novo_deposito = Deposito(nome=data['nome'], localizacao=data.get('localizacao'))
+        db.session.add(novo_deposito)
+        db.session.commit()
+        return jsonify({"message": "Depósito adicionado com sucesso!", "deposito": novo_deposito.to_dict()}), 201
+    except IntegrityError as e:
+        db.session.rollback()
+        if campo_duplicado(Deposito, valores_unicos) == 'nome':
+            return jsonify({"message": "Erro: Nome de depósito já existe. Por favor, use um nome único."}), 409
+        return jsonify({"message": f"Erro ao adicionar depósito: {str(e)}"}), 500
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({"message": f"Erro ao adicionar depósito: {str(e)}"}), 500
+
+@api.route('/depositos', methods=['GET'])
+@jwt_required() # Protege a rota de listar depósitos
+@rota_leitura
+def get_depositos():
+    query = Deposito.query.order_by(Deposito.id)
+    ativo_filter = request.args.get('ativo', type=str)
+    if ativo_filter is not None:
+        query = query.filter(Deposito.ativo == (ativo_filter.lower() == 'true'))
+    return jsonify([deposito.to_dict() for deposito in query.all()]), 200
+
+@api.route('/depositos/<int:deposito_id>', methods=['PUT'])
+@jwt_required() # Protege a rota de atualizar depósito
+def update_deposito(deposito_id):
+    deposito = db.session.get(Deposito, deposito_id)
+    if not deposito:
+        return jsonify({"message": "Depósito não encontrado."}), 404
+
+    data = request.get_json()
+    if not data:
+        return jsonify({"message": "Nenhum dado fornecido para atualização."}), 400
+    if deposito_id == DEPOSITO_PADRAO_ID and data.get('ativo') is False:
+        return jsonify({"message": "O depósito padrão não pode ser desativado."}), 400
 
+    valores_unicos = {'nome': data.get('nome', deposito.nome)}
+    try:
+        deposito.nome = data.get('nome', deposito.nome)
+        deposito.localizacao = data.get('localizacao', deposito.localizacao)
+        deposito.ativo = data.get('ativo', deposito.ativo)
+        db.session.commit()
+        return jsonify({"message": "Depósito atualizado com sucesso!", "deposito": deposito.to_dict()}), 200
+    except IntegrityError as e:
+        db.session.rollback()
+        if campo_duplicado(Deposito, valores_unicos, ignorar_id=deposito_id) == 'nome':
+            return jsonify({"message": "Erro: Nome de depósito já existe. Por favor, use um nome único."}), 409
+        return jsonify({"message": f"Erro ao atualizar depósito: {str(e)}"}), 500
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({"message": f"Erro ao atualizar depósito: {str(e)}"}), 500
+
+@api.route('/depositos/<int:deposito_id>/estoque', methods=['GET'])
+@jwt_required() # Protege a rota de estoque do depósito
+@rota_leitura
+def get_estoque_deposito(deposito_id):
+    # Só as linhas do depósito: intervalo da chave primária (deposito_id, produto_id)
+    if not db.session.get(Deposito, deposito_id):
+        return jsonify({"message": "Depósito não encontrado."}), 404
+
+    page = request.args.get('page', 1, type=int)
+    per_page = request.args.get('per_page', 10, type=int)
+
+    query = db.session.query(EstoqueDeposito.produto_id, Produto.codigo, Produto.nome, EstoqueDeposito.estoque).join(
+        Produto, Produto.id == EstoqueDeposito.produto_id
+    ).filter(EstoqueDeposito.deposito_id == deposito_id).order_by(EstoqueDeposito.produto_id)
+    if request.args.get('com_saldo', 'false').lower() == 'true':
+        query = query.filter(EstoqueDeposito.estoque > 0)
+
+    paginated_saldos = query.paginate(page=page, per_page=per_page, error_out=False)
+
+    return jsonify({
+        'deposito_id': deposito_id,
+        'items': [
+            {'produto_id': produto_id, 'codigo': codigo, 'nome': nome, 'estoque': estoque}
+            for produto_id, codigo, nome, estoque in paginated_saldos.items
+        ],
+        'total_items': paginated_saldos.total,
+        'total_pages': paginated_saldos.pages,
+        'current_page': paginated_saldos.page,
+        'per_page': paginated_saldos.per_page,
+        'has_next': paginated_saldos.has_next,
+        'has_prev': paginated_saldos.has_prev
+    }), 200
+
+@api.route('/produtos/<int:produto_id>/depositos', methods=['GET'])
+@jwt_required() # Protege a rota de saldos do produto por depósito
+@rota_leitura
+def get_depositos_do_produto(produto_id):
+    produto = db.session.get(Produto, produto_id)
+    if not produto:
+        return jsonify({"message": "Produto não encontrado."}), 404
+
+    saldos = db.session.query(EstoqueDeposito.deposito_id, Deposito.nome, EstoqueDeposito.estoque).join(
+        Deposito, Deposito.id == EstoqueDeposito.deposito_id
+    ).filter(EstoqueDeposito.produto_id == produto_id).order_by(EstoqueDeposito.deposito_id).all()
+
+    return jsonify({
+        'produto_id': produto_id,
+        'estoque_atual': sum(estoque for _, _, estoque in saldos), # Soma dos depósitos, já com o que falta consolidar
+        'depositos': [
+            {'deposito_id': deposito_id, 'deposito_nome': nome, 'estoque': estoque}
+            for deposito_id, nome, estoque in saldos
+        ]
+    }), 200
+
+@api.route('/transferencias', methods=['POST'])
+@jwt_required() # Protege a rota de transferência entre depósitos
+@idempotente
+def add_transferencia():
+    data = request.get_json()
+    if not data or not all(k in data for k in ['produto_id', 'deposito_origem_id', 'deposito_destino_id', 'quantidade']):
+        return jsonify({"message": "Dados da transferência incompletos."}), 400
+
+    produto_id = data['produto_id']
+    origem_id = data['deposito_origem_id']
+    destino_id = data['deposito_destino_id']
+    quantidade = data['quantidade']
+
+    if not isinstance(quantidade, int) or isinstance(quantidade, bool) or quantidade <= 0:
+        return jsonify({"message": "Quantidade deve ser um inteiro maior que zero."}), 400
+    if origem_id == destino_id:
+        return jsonify({"message": "Depósitos de origem e destino devem ser diferentes."}), 400
+    if not db.session.get(Produto, produto_id):
+        return jsonify({"message": "Produto não encontrado."}), 404
+    if not deposito_ativo(origem_id) or not deposito_ativo(destino_id):
+        return jsonify({"message": "Depósito não encontrado ou inativo."}), 400
+    if journal_em_outro_processo():
+        return _resposta_journal_em_outro_processo()
+
+    def transferir():
+        # O agregado do produto não muda; as duas linhas são travadas em ordem de depósito (sem deadlock
+        # entre transferências opostas)
+        travar_saldos_journal([(produto_id, origem_id), (produto_id, destino_id)])
+        for deposito_id, delta in sorted([(origem_id, -quantidade), (destino_id, quantidade)]):
+            ajustar_estoque_deposito(produto_id, deposito_id, delta)
+        nova_transferencia = Transferencia(
+            produto_id=produto_id,
+            deposito_origem_id=origem_id,
+            deposito_destino_id=destino_id,
+            quantidade=quantidade,
+            observacao=data.get('observacao')
+        )
+        db.session.add(nova_transferencia)
+        db.session.commit()
+        return nova_transferencia
+
+    try:
+        nova_transferencia = _com_retentativas(transferir)
+        return jsonify({"message": "Transferência registrada com sucesso!", "transferencia": nova_transferencia.to_dict()}), 201
+    except EstoqueInsuficiente:
+        db.session.rollback()
+        return jsonify({"message": "Estoque insuficiente no depósito de origem."}), 400
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({"message": f"Erro ao registrar transferência: {str(e)}"}), 500
+
+@api.route('/transferencias', methods=['GET'])
+@jwt_required() # Protege a rota de listar transferências
+@rota_leitura
+def get_transferencias():
+    page = request.args.get('page', 1, type=int)
+    per_page = request.args.get('per_page', 10, type=int)
+
+    query = Transferencia.query.order_by(Transferencia.data_hora.desc(), Transferencia.id.desc())
+    produto_id_filter = request.args.get('produto_id', type=int)
+    deposito_id_filter = request.args.get('deposito_id', type=int)
+    if produto_id_filter:
+        query = query.filter(Transferencia.produto_id == produto_id_filter)
+    if deposito_id_filter:
+        query = query.filter(or_(
+            Transferencia.deposito_origem_id == deposito_id_filter, Transferencia.deposito_destino_id == deposito_id_filter
+        ))
+
+    paginated_transferencias = query.paginate(page=page, per_page=per_page, error_out=False)
+
+    return jsonify({
+        'items': [transferencia.to_dict() for transferencia in paginated_transferencias.items],
+        'total_items': paginated_transferencias.total,
+        'total_pages': paginated_transferencias.pages,
+        'current_page': paginated_transferencias.page,
+        'per_page': paginated_transferencias.per_page,
+        'has_next': paginated_transferencias.has_next,
+        'has_prev': paginated_transferencias.has_prev
+    }), 200
+
+@api.cli.command('medir-depositos')
+@click.option('--quantidade', default=2000, show_default=True, help='Saídas lançadas por cenário.')
+@click.option('--threads', default=16, show_default=True, help='Requisições concorrentes.')
+@click.option('--depositos', default='1,4,16', show_default=True, help='Quantidades de depósitos a comparar.')
+@click.option('--banco', default=None, help='URL de um banco descartável (padrão: SQLite temporário por cenário).')
+@click.option('--latencia-ms', default=0.0, show_default=True, help='Latência simulada por comando SQL (rede até o banco).')
+def medir_depositos_command(quantidade, threads, depositos, banco, latencia_ms):
+    # Mesmas saídas concorrentes de um produto, repartidas entre N depósitos (sem journal). No SQLite todos os
+    # escritores disputam o mesmo arquivo; a diferença entre cenários só aparece num banco com travas por linha
+    # (PostgreSQL, MySQL), e fica mais visível com --latencia-ms, que prende cada trava pelo tempo de rede.
+    import benchmarks
+    for total in [int(valor) for valor in depositos.split(',')]:
+        medicao = benchmarks.executar('movimentacoes', quantidade, threads, total, latencia_ms, banco=banco)
+        print(f"{total} depósito(s): confirmadas/s={medicao['confirmadas_por_segundo']:.0f} aplicadas/s={medicao['aplicadas_por_segundo']:.0f} "
+              f"p50={medicao['latencia_p50_ms']:.1f}ms p99={medicao['latencia_p99_ms']:.1f}ms "
+              f"erros={medicao['erros']} estoque_final={medicao['estoque_final']}")
 
 # --- Rota para Relatórios de Estoque Crítico ---
-@app.route('/relatorios/estoque_critico', methods=['GET'])
+@api.route('/relatorios/estoque_critico', methods=['GET'])
 @jwt_required() # Protege a rota de relatório de estoque crítico
+@rota_leitura
 def get_estoque_critico_report():
     report_type = request.args.get('tipo', 'baixo') # 'baixo' (default) ou 'em_falta'
 
-    query = Produto.query
-
-    if report_type == 'baixo':
-        query = query.filter(Produto.estoque_atual <= Produto.estoque_minimo)
-    elif report_type == 'em_falta':
-        query = query.filter(Produto.estoque_atual == 0)
-    else:
+    if report_type not in ('baixo', 'em_falta'):
         return jsonify({"message": "Tipo de relatório inválido. Use 'baixo' ou 'em_falta'."}), 400
+    query = Produto.query.filter(filtro_situacao_estoque(report_type))
+
+    try:
+        query, codificar = SERIALIZADORES['produtos'].aplicar(query.order_by(Produto.nome), campos_solicitados())
+    except ValueError as e:
+        return jsonify({"message": str(e)}), 400
 
-    produtos_criticos = query.order_by(Produto.nome).all()
-    produtos_criticos_json = [p.to_dict() for p in produtos_criticos]
+    produtos_criticos_json = [codificar(linha) for linha in query.all()]
 
     return jsonify(produtos_criticos_json), 200
 
 
 # --- Rota para Dashboard (Dados de Resumo) ---
-@app.route('/dashboard/resumo', methods=['GET'])
+@api.route('/dashboard/resumo', methods=['GET'])
 @jwt_required() # Protege a rota do dashboard
+@rota_leitura
 def get_dashboard_summary():
-    total_produtos = Produto.query.count()
-    produtos_estoque_baixo = Produto.query.filter(Produto.estoque_atual <= Produto.estoque_minimo).count()
-    produtos_em_falta = Produto.query.filter(Produto.estoque_atual == 0).count()
-    
+    # Contadores pré-calculados: leitura de uma única linha, independente do tamanho das tabelas
+    resumo = ResumoDashboard.query.get(1)
+    if resumo is None:
+        resumo = reconciliar_resumo_dashboard()
+
     ultimas_movimentacoes = Movimentacao.query.options(
         joinedload(Movimentacao.produto),
         joinedload(Movimentacao.cliente)
@@ -707,27 +4759,31 @@ def get_dashboard_summary():
         mov_dict['cliente_nome'] = mov.cliente.nome if mov.cliente else None
         ultimas_movimentacoes_json.append(mov_dict)
 
-    total_entradas = db.session.query(db.func.sum(Movimentacao.quantidade)).filter_by(tipo_movimentacao='entrada').scalar() or 0
-    total_saidas = db.session.query(db.func.sum(Movimentacao.quantidade)).filter_by(tipo_movimentacao='saida').scalar() or 0
+    # Contagens de produtos vindas do razão em memória quando já carregado; senão, dos contadores no banco
+    razao = obter_razao_estoque()
+    contagens = razao.contagens() if razao is not None else {
+        'total_produtos': resumo.total_produtos,
+        'produtos_estoque_baixo': resumo.produtos_estoque_baixo,
+        'produtos_em_falta': resumo.produtos_em_falta
+    }
 
     return jsonify({
-        'total_produtos': total_produtos,
-        'produtos_estoque_baixo': produtos_estoque_baixo,
-        'produtos_em_falta': produtos_em_falta,
+        **contagens,
         'ultimas_movimentacoes': ultimas_movimentacoes_json,
-        'total_entradas': total_entradas,
-        'total_saidas': total_saidas
+        'total_entradas': resumo.total_entradas,
+        'total_saidas': resumo.total_saidas
     }), 200
 
 # --- Rotas da API para Fornecedores ---
 
-@app.route('/fornecedores', methods=['POST'])
+@api.route('/fornecedores', methods=['POST'])
 @jwt_required() # Protege a rota de adicionar fornecedor
 def add_fornecedor():
     data = request.get_json()
     if not data or not data.get('nome'):
         return jsonify({"message": "Nome do fornecedor é obrigatório."}), 400
     
+    valores_unicos = {'nome': data['nome'], 'cnpj': data.get('cnpj')}
     try:
         novo_fornecedor = Fornecedor(
             nome=data['nome'],
@@ -739,33 +4795,38 @@ def add_fornecedor():
         db.session.add(novo_fornecedor)
         db.session.commit()
         return jsonify({"message": "Fornecedor adicionado com sucesso!", "fornecedor": novo_fornecedor.to_dict()}), 201
-    except Exception as e:
+    except IntegrityError as e:
         db.session.rollback()
-        if "Duplicate entry" in str(e) and "for key 'fornecedores.nome'" in str(e):
+        campo = campo_duplicado(Fornecedor, valores_unicos)
+        if campo == 'nome':
             return jsonify({"message": "Erro: Nome de fornecedor já existe. Por favor, use um nome único."}), 409
-        if "Duplicate entry" in str(e) and "for key 'fornecedores.cnpj'" in str(e):
+        if campo == 'cnpj':
             return jsonify({"message": "Erro: CNPJ de fornecedor já existe. Por favor, use um CNPJ único."}), 409
         return jsonify({"message": f"Erro ao adicionar fornecedor: {str(e)}"}), 500
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({"message": f"Erro ao adicionar fornecedor: {str(e)}"}), 500
 
-@app.route('/fornecedores', methods=['GET'])
+@api.route('/fornecedores', methods=['GET'])
 @jwt_required() # Protege a rota de listar fornecedores
+@rota_leitura
 def get_fornecedores():
-    query = Fornecedor.query
+    query = _filtrar_fornecedores(Fornecedor.query)
 
-    search_term = request.args.get('search', type=str)
-    
     page = request.args.get('page', 1, type=int)
     per_page = request.args.get('per_page', 10, type=int)
 
-    if search_term:
-        query = query.filter(
-            (Fornecedor.nome.ilike(f'%{search_term}%')) |
-            (Fornecedor.cnpj.ilike(f'%{search_term}%'))
-        )
-    
-    paginated_fornecedores = query.paginate(page=page, per_page=per_page, error_out=False)
+    try:
+        query, codificar = SERIALIZADORES['fornecedores'].aplicar(query, campos_solicitados())
+    except ValueError as e:
+        return jsonify({"message": str(e)}), 400
+
+    if 'cursor' in request.args:
+        return _resposta_por_cursor(query, [Fornecedor.id], codificar)
 
-    fornecedores_json = [f.to_dict() for f in paginated_fornecedores.items]
+    paginated_fornecedores = paginar(query, page, per_page)
+
+    fornecedores_json = [codificar(linha) for linha in paginated_fornecedores.items]
 
     return jsonify({
         'items': fornecedores_json,
@@ -777,15 +4838,19 @@ def get_fornecedores():
         'has_prev': paginated_fornecedores.has_prev
     }), 200
 
-@app.route('/fornecedores/<int:fornecedor_id>', methods=['GET'])
+@api.route('/fornecedores/<int:fornecedor_id>', methods=['GET'])
 @jwt_required() # Protege a rota de obter fornecedor por ID
 def get_fornecedor(fornecedor_id):
-    fornecedor = Fornecedor.query.get(fornecedor_id)
-    if fornecedor:
-        return jsonify(fornecedor.to_dict()), 200
+    def carregar():
+        fornecedor = Fornecedor.query.get(fornecedor_id)
+        return fornecedor.to_dict() if fornecedor else None
+
+    response = responder_com_cache(f'fornecedor:{fornecedor_id}', carregar)
+    if response is not None:
+        return response
     return jsonify({"message": "Fornecedor não encontrado."}), 404
 
-@app.route('/fornecedores/<int:fornecedor_id>', methods=['PUT'])
+@api.route('/fornecedores/<int:fornecedor_id>', methods=['PUT'])
 @jwt_required() # Protege a rota de atualizar fornecedor
 def update_fornecedor(fornecedor_id):
     fornecedor = Fornecedor.query.get(fornecedor_id)
@@ -796,24 +4861,33 @@ def update_fornecedor(fornecedor_id):
     if not data:
         return jsonify({"message": "Nenhum dado fornecido para atualização."}), 400
     
+    nome_anterior = fornecedor.nome
     fornecedor.nome = data.get('nome', fornecedor.nome)
     fornecedor.cnpj = data.get('cnpj', fornecedor.cnpj)
     fornecedor.email = data.get('email', fornecedor.email)
     fornecedor.telefone = data.get('telefone', fornecedor.telefone)
     fornecedor.endereco = data.get('endereco', fornecedor.endereco)
 
+    valores_unicos = {'nome': fornecedor.nome, 'cnpj': fornecedor.cnpj}
     try:
         db.session.commit()
+        invalidar_cache('fornecedor', fornecedor_id)
+        if fornecedor.nome != nome_anterior:
+            obter_cache().limpar_prefixo('produto:') # fornecedor_nome é desnormalizado no produto
         return jsonify({"message": "Fornecedor atualizado com sucesso!", "fornecedor": fornecedor.to_dict()}), 200
-    except Exception as e:
+    except IntegrityError as e:
         db.session.rollback()
-        if "Duplicate entry" in str(e) and "for key 'fornecedores.nome'" in str(e):
+        campo = campo_duplicado(Fornecedor, valores_unicos, ignorar_id=fornecedor_id)
+        if campo == 'nome':
             return jsonify({"message": "Erro: Nome de fornecedor já existe. Por favor, use um nome único."}), 409
-        if "Duplicate entry" in str(e) and "for key 'fornecedores.cnpj'" in str(e):
+        if campo == 'cnpj':
             return jsonify({"message": "Erro: CNPJ de fornecedor já existe. Por favor, use um CNPJ único."}), 409
         return jsonify({"message": f"Erro ao atualizar fornecedor: {str(e)}"}), 500
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({"message": f"Erro ao atualizar fornecedor: {str(e)}"}), 500
 
-@app.route('/fornecedores/<int:fornecedor_id>', methods=['DELETE'])
+@api.route('/fornecedores/<int:fornecedor_id>', methods=['DELETE'])
 @jwt_required() # Protege a rota de deletar fornecedor
 def delete_fornecedor(fornecedor_id):
     fornecedor = Fornecedor.query.get(fornecedor_id)
@@ -827,19 +4901,21 @@ def delete_fornecedor(fornecedor_id):
     try:
         db.session.delete(fornecedor)
         db.session.commit()
+        invalidar_cache('fornecedor', fornecedor_id)
         return jsonify({"message": "Fornecedor excluído com sucesso!"}), 200
     except Exception as e:
         db.session.rollback()
         return jsonify({"message": f"Erro ao excluir fornecedor: {str(e)}"}), 500
 
 # --- Rotas da API para Clientes ---
-@app.route('/clientes', methods=['POST'])
+@api.route('/clientes', methods=['POST'])
 @jwt_required() # Protege a rota de adicionar cliente
 def add_cliente():
     data = request.get_json()
     if not data or not data.get('nome'):
         return jsonify({"message": "Nome do cliente é obrigatório."}), 400
 
+    valores_unicos = {'cpf': data.get('cpf')}
     try:
         novo_cliente = Cliente(
             nome=data['nome'],
@@ -851,30 +4927,35 @@ def add_cliente():
         db.session.add(novo_cliente)
         db.session.commit()
         return jsonify({"message": "Cliente adicionado com sucesso!", "cliente": novo_cliente.to_dict()}), 201
-    except Exception as e:
+    except IntegrityError as e:
         db.session.rollback()
-        if "Duplicate entry" in str(e) and "for key 'clientes.cpf'" in str(e):
+        if campo_duplicado(Cliente, valores_unicos):
             return jsonify({"message": "Erro: CPF de cliente já existe. Por favor, use um CPF único."}), 409
         return jsonify({"message": f"Erro ao adicionar cliente: {str(e)}"}), 500
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({"message": f"Erro ao adicionar cliente: {str(e)}"}), 500
 
-@app.route('/clientes', methods=['GET'])
+@api.route('/clientes', methods=['GET'])
 @jwt_required() # Protege a rota de listar clientes
+@rota_leitura
 def get_clientes():
-    query = Cliente.query
-    search_term = request.args.get('search', type=str)
-    
+    query = _filtrar_clientes(Cliente.query)
+
     page = request.args.get('page', 1, type=int)
     per_page = request.args.get('per_page', 10, type=int)
 
-    if search_term:
-        query = query.filter(
-            (Cliente.nome.ilike(f'%{search_term}%')) |
-            (Cliente.cpf.ilike(f'%{search_term}%'))
-        )
-    
-    paginated_clientes = query.paginate(page=page, per_page=per_page, error_out=False)
+    try:
+        query, codificar = SERIALIZADORES['clientes'].aplicar(query, campos_solicitados())
+    except ValueError as e:
+        return jsonify({"message": str(e)}), 400
+
+    if 'cursor' in request.args:
+        return _resposta_por_cursor(query, [Cliente.id], codificar)
 
-    clientes_json = [c.to_dict() for c in paginated_clientes.items]
+    paginated_clientes = paginar(query, page, per_page)
+
+    clientes_json = [codificar(linha) for linha in paginated_clientes.items]
 
     return jsonify({
         'items': clientes_json,
@@ -886,15 +4967,19 @@ def get_clientes():
         'has_prev': paginated_clientes.has_prev
     }), 200
 
-@app.route('/clientes/<int:cliente_id>', methods=['GET'])
+@api.route('/clientes/<int:cliente_id>', methods=['GET'])
 @jwt_required() # Protege a rota de obter cliente por ID
 def get_cliente(cliente_id):
-    cliente = Cliente.query.get(cliente_id)
-    if cliente:
-        return jsonify(cliente.to_dict()), 200
+    def carregar():
+        cliente = Cliente.query.get(cliente_id)
+        return cliente.to_dict() if cliente else None
+
+    response = responder_com_cache(f'cliente:{cliente_id}', carregar)
+    if response is not None:
+        return response
     return jsonify({"message": "Cliente não encontrado."}), 404
 
-@app.route('/clientes/<int:cliente_id>', methods=['PUT'])
+@api.route('/clientes/<int:cliente_id>', methods=['PUT'])
 @jwt_required() # Protege a rota de atualizar cliente
 def update_cliente(cliente_id):
     cliente = Cliente.query.get(cliente_id)
@@ -911,36 +4996,463 @@ def update_cliente(cliente_id):
     cliente.telefone = data.get('telefone', cliente.telefone)
     cliente.endereco = data.get('endereco', cliente.endereco)
 
+    valores_unicos = {'cpf': cliente.cpf}
     try:
         db.session.commit()
+        invalidar_cache('cliente', cliente_id)
         return jsonify({"message": "Cliente atualizado com sucesso!", "cliente": cliente.to_dict()}), 200
-    except Exception as e:
+    except IntegrityError as e:
         db.session.rollback()
-        if "Duplicate entry" in str(e) and "for key 'clientes.cpf'" in str(e):
+        if campo_duplicado(Cliente, valores_unicos, ignorar_id=cliente_id):
             return jsonify({"message": "Erro: CPF de cliente já existe. Por favor, use um CPF único."}), 409
         return jsonify({"message": f"Erro ao atualizar cliente: {str(e)}"}), 500
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({"message": f"Erro ao atualizar cliente: {str(e)}"}), 500
 
-@app.route('/clientes/<int:cliente_id>', methods=['DELETE'])
+@api.route('/clientes/<int:cliente_id>', methods=['DELETE'])
 @jwt_required() # Protege a rota de deletar cliente
 def delete_cliente(cliente_id):
     cliente = Cliente.query.get(cliente_id)
     if not cliente:
         return jsonify({"message": "Cliente não encontrado."}), 404
     
-    movimentacoes_vinculadas = Movimentacao.query.filter_by(cliente_id=cliente_id).first()
+    movimentacoes_vinculadas = Movimentacao.query.filter_by(cliente_id=cliente_id).first() or \
+        MovimentacaoArquivada.query.filter_by(cliente_id=cliente_id).first()
     if movimentacoes_vinculadas:
         return jsonify({"message": "Não é possível excluir o cliente. Existem movimentações de saída vinculadas a ele."}), 400
 
     try:
         db.session.delete(cliente)
         db.session.commit()
+        invalidar_cache('cliente', cliente_id)
         return jsonify({"message": "Cliente excluído com sucesso!"}), 200
     except Exception as e:
         db.session.rollback()
         return jsonify({"message": f"Erro ao excluir cliente: {str(e)}"}), 500
 
+# --- Rotas de Exportação (streaming NDJSON/CSV) ---
+def _exportacao_produtos():
+    return _filtrar_produtos(Produto.query.order_by(Produto.id))
+
+def _exportacao_movimentacoes():
+    return _filtrar_movimentacoes(Movimentacao.query.order_by(Movimentacao.data_hora.desc(), Movimentacao.id.desc()))
+
+def _exportacao_fornecedores():
+    return _filtrar_fornecedores(Fornecedor.query.order_by(Fornecedor.id))
+
+def _exportacao_clientes():
+    return _filtrar_clientes(Cliente.query.order_by(Cliente.id))
+
+EXPORTACOES = {
+    'produtos': _exportacao_produtos,
+    'movimentacoes': _exportacao_movimentacoes,
+    'fornecedores': _exportacao_fornecedores,
+    'clientes': _exportacao_clientes,
+}
+
+def _gerar_ndjson(linhas):
+    bloco = []
+    for linha in linhas:
+        bloco.append(json.dumps(linha, ensure_ascii=False))
+        if len(bloco) >= current_app.config['EXPORTACAO_LINHAS_POR_BLOCO']:
+            yield '\n'.join(bloco) + '\n'
+            bloco = []
+    if bloco:
+        yield '\n'.join(bloco) + '\n'
+
+def _gerar_csv(linhas):
+    buffer = io.StringIO()
+    writer = None
+    contador = 0
+    for linha in linhas:
+        if writer is None:
+            writer = csv.DictWriter(buffer, fieldnames=list(linha.keys()), extrasaction='ignore')
+            writer.writeheader()
+        writer.writerow(linha)
+        contador += 1
+        if contador >= current_app.config['EXPORTACAO_LINHAS_POR_BLOCO']:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate(0)
+            contador = 0
+    if buffer.getvalue():
+        yield buffer.getvalue()
+
+@api.route('/export/<entidade>', methods=['GET'])
+@jwt_required() # Protege a rota de exportação
+@rota_leitura
+def exportar_entidade(entidade):
+    if entidade not in EXPORTACOES:
+        return jsonify({"message": "Entidade inválida. Use produtos, movimentacoes, fornecedores ou clientes."}), 404
+
+    formato = request.args.get('format', 'ndjson')
+    if formato not in ['ndjson', 'csv']:
+        return jsonify({"message": "Formato inválido. Use 'ndjson' ou 'csv'."}), 400
+
+    try:
+        query, codificar = SERIALIZADORES[entidade].aplicar(EXPORTACOES[entidade](), campos_solicitados())
+    except ValueError as e:
+        return jsonify({"message": str(e)}), 400
+
+    partes = [query]
+    if entidade == 'movimentacoes':
+        arquivo = _consulta_arquivo_movimentacoes()
+        if arquivo is not None:
+            partes.append(SERIALIZADORES['movimentacoes_arquivadas'].aplicar(arquivo, campos_solicitados())[0])
+
+    # Cursor do lado do servidor + yield_per: a memória não cresce com o número de linhas
+    linhas = (
+        codificar(linha)
+        for parte in partes
+        for linha in parte.execution_options(stream_results=True).yield_per(current_app.config['EXPORTACAO_YIELD_PER'])
+    )
+
+    if formato == 'csv':
+        corpo, mimetype = _gerar_csv(linhas), 'text/csv'
+    else:
+        corpo, mimetype = _gerar_ndjson(linhas), 'application/x-ndjson'
+
+    return Response(
+        stream_with_context(corpo),
+        mimetype=mimetype,
+        headers={'Content-Disposition': f'attachment; filename={entidade}.{formato}'}
+    )
+
+@api.cli.command('medir-exportacao')
+@click.option('--linhas', default=1000000, show_default=True, help='Movimentações sintéticas exportadas.')
+@click.option('--formato', default='ndjson', show_default=True, type=click.Choice(['ndjson', 'csv']))
+@click.option('--max-crescimento-mb', default=64, show_default=True, help='Crescimento máximo aceito do pico de memória.')
+def medir_exportacao_command(linhas, formato, max_crescimento_mb):
+    # Popula um SQLite temporário num processo e exporta tudo em outro, para o pico de memória (ru_maxrss)
+    # refletir só a exportação. Falha se o pico crescer além do limite: a memória não pode seguir o volume.
+    import benchmarks
+    with tempfile.TemporaryDirectory() as temporario:
+        banco = f"sqlite:///{os.path.join(temporario, 'benchmark.db')}"
+        for fase in ['popular', 'exportar']:
+            medicao = benchmarks.executar('exportacao', fase, linhas, formato, banco=banco, log_level='ERROR')
+    crescimento = medicao['memoria_pico_mb'] - medicao['memoria_inicial_mb']
+    print(f"linhas={medicao['linhas']} tamanho={medicao['megabytes']:.0f}MB tempo={medicao['segundos']:.1f}s "
+          f"({medicao['linhas'] / medicao['segundos']:.0f} linhas/s)")
+    print(f"memoria: inicial={medicao['memoria_inicial_mb']:.0f}MB pico={medicao['memoria_pico_mb']:.0f}MB crescimento={crescimento:.0f}MB")
+    if medicao['linhas'] != linhas or crescimento > max_crescimento_mb:
+        print(f"FALHOU: esperado {linhas} linhas e crescimento de até {max_crescimento_mb}MB.")
+        raise SystemExit(1)
+
+# --- Importação de Catálogo de Produtos (CSV/XLSX em segundo plano) ---
+_importacao_executor = None
+_importacao_lock = threading.Lock()
+
+def _executor_importacao():
+    global _importacao_executor
+    with _importacao_lock:
+        if _importacao_executor is None:
+            _importacao_executor = ThreadPoolExecutor(max_workers=current_app.config['IMPORTACAO_MAX_WORKERS'], thread_name_prefix='importacao')
+    return _importacao_executor
+
+def _ler_planilha(caminho):
+    # Gera (número da linha, dict coluna -> valor) sem carregar o arquivo inteiro em memória
+    if caminho.lower().endswith('.xlsx'):
+        import openpyxl # Dependência opcional, só necessária para planilhas XLSX
+        workbook = openpyxl.load_workbook(caminho, read_only=True, data_only=True)
+        try:
+            linhas = workbook.active.iter_rows(values_only=True)
+            cabecalho = [str(coluna).strip() if coluna is not None else '' for coluna in next(linhas, [])]
+            for numero, valores in enumerate(linhas, start=2):
+                if any(valor is not None for valor in valores):
+                    yield numero, dict(zip(cabecalho, valores))
+        finally:
+            workbook.close()
+        return
+
+    with open(caminho, newline='', encoding='utf-8-sig') as arquivo:
+        amostra = arquivo.read(4096)
+        arquivo.seek(0)
+        try:
+            dialeto = csv.Sniffer().sniff(amostra, delimiters=',;\t')
+        except csv.Error:
+            dialeto = csv.excel
+        for numero, linha in enumerate(csv.DictReader(arquivo, dialect=dialeto), start=2):
+            yield numero, {(coluna or '').strip(): valor for coluna, valor in linha.items()}
+
+def _decimal_planilha(valor, padrao=None):
+    if valor is None or str(valor).strip() == '':
+        return padrao
+    texto = str(valor).strip()
+    if ',' in texto and '.' not in texto:
+        texto = texto.replace(',', '.') # Aceita vírgula decimal ("10,50")
+    return Decimal(texto)
+
+def _normalizar_linha_importacao(linha, fornecedores):
+    # Retorna o dict de colunas do produto ou lança ValueError com a mensagem da linha
+    faltando = [campo for campo in ['nome', 'codigo', 'unidade_medida', 'preco_compra', 'preco_venda'] if not str(linha.get(campo) or '').strip()]
+    if faltando:
+        raise ValueError(f"Campos obrigatórios ausentes: {', '.join(faltando)}.")
+
+    try:
+        produto = {
+            'nome': str(linha['nome']).strip(),
+            'codigo': str(linha['codigo']).strip(),
+            'unidade_medida': str(linha['unidade_medida']).strip(),
+            'preco_compra': _decimal_planilha(linha['preco_compra']),
+            'preco_venda': _decimal_planilha(linha['preco_venda']),
+        }
+        for imposto in IMPOSTOS:
+            produto[f'{imposto}_aliquota'] = _decimal_planilha(linha.get(f'{imposto}_aliquota'), Decimal(0))
+        for campo in ['estoque_atual', 'estoque_minimo']:
+            if str(linha.get(campo) or '').strip():
+                produto[campo] = int(_decimal_planilha(linha[campo]))
+    except (InvalidOperation, ValueError):
+        raise ValueError("Preço, alíquota ou estoque inválido.")
+
+    for campo in ['descricao', 'localizacao', 'ncm', 'cst_csosn', 'cfop', 'origem_mercadoria', 'info_adicionais_nf']:
+        if str(linha.get(campo) or '').strip():
+            produto[campo] = str(linha[campo]).strip()
+
+    # Fornecedor pelo id, CNPJ ou nome, resolvido no mapa pré-carregado (sem consulta por linha)
+    for coluna in ['fornecedor_id', 'fornecedor_cnpj', 'fornecedor']:
+        chave = str(linha.get(coluna) or '').strip()
+        if chave:
+            fornecedor_id = fornecedores.get((coluna, chave.lower()))
+            if fornecedor_id is None:
+                raise ValueError(f"Fornecedor não encontrado: {chave}.")
+            produto['fornecedor_id'] = fornecedor_id
+            break
+
+    return produto
+
+def _importar_lote_produtos(lote, importacao, erros, retentativa=False):
+    # lote: [(número da linha, dict do produto)]; upsert por código com um SELECT, um INSERT e um UPDATE em lote
+    por_codigo = {}
+    for numero, produto in lote:
+        por_codigo[produto['codigo']] = (numero, produto) # Código repetido no arquivo: vale a última linha
+
+    linhas_impostos = [
+        (codigo, produto['preco_venda'], *[produto[f'{imposto}_aliquota'] for imposto in IMPOSTOS])
+        for codigo, (_, produto) in por_codigo.items()
+    ]
+    for valores in calcular_impostos_lote(linhas_impostos, {}):
+        codigo = valores.pop('id')
+        por_codigo[codigo][1].update(valores)
+
+    existentes = dict(
+        db.session.query(Produto.codigo, Produto.id).filter(Produto.codigo.in_(list(por_codigo))).all()
+    )
+    novos = [produto for codigo, (_, produto) in por_codigo.items() if codigo not in existentes]
+    alterados = []
+    for codigo, (_, produto) in por_codigo.items():
+        if codigo in existentes:
+            alterados.append(dict(_campos_atualizaveis_importacao(produto), id=existentes[codigo]))
+
+    # O rollback descarta o progresso da importação ainda não gravado (contadores do lote atual)
+    progresso = {campo: getattr(importacao, campo) for campo in ['processadas', 'com_erro', 'inseridos', 'atualizados']}
+    try:
+        if novos:
+            db.session.execute(insert(Produto), novos)
+        if alterados:
+            db.session.execute(update(Produto), alterados)
+        db.session.commit()
+    except (IntegrityError, DataError):
+        db.session.rollback()
+        for campo, valor in progresso.items():
+            setattr(importacao, campo, valor)
+        codigos_novos = [produto['codigo'] for produto in novos]
+        if not retentativa and codigos_novos and db.session.query(
+            db.session.query(Produto.id).filter(Produto.codigo.in_(codigos_novos)).exists()
+        ).scalar():
+            # Código inserido por outra transação entre o SELECT e o INSERT: o lote é reprocessado uma vez
+            return _importar_lote_produtos(lote, importacao, erros, retentativa=True)
+        # Outra causa (fornecedor excluído, valor fora do tamanho da coluna...): grava linha a linha
+        # e registra as que falharem como erro da importação
+        return _importar_linhas_produtos(por_codigo, importacao, erros)
+
+    importacao.inseridos += len(novos)
+    importacao.atualizados += len(alterados)
+    _atualizar_importados(por_codigo, existentes.values())
+
+def _campos_atualizaveis_importacao(produto):
+    # O estoque de produtos existentes só muda por movimentação
+    return {k: v for k, v in produto.items() if k != 'estoque_atual'}
+
+def _importar_linhas_produtos(por_codigo, importacao, erros):
+    existentes = dict(
+        db.session.query(Produto.codigo, Produto.id).filter(Produto.codigo.in_(list(por_codigo))).all()
+    )
+    for codigo, (numero, produto) in por_codigo.items():
+        try:
+            with db.session.begin_nested():
+                if codigo in existentes:
+                    db.session.execute(update(Produto), [dict(_campos_atualizaveis_importacao(produto), id=existentes[codigo])])
+                else:
+                    db.session.execute(insert(Produto), [produto])
+        except (IntegrityError, DataError) as e:
+            _registrar_erro_importacao(importacao, erros, numero, f"Erro ao gravar o produto {codigo}: {e.orig}")
+            continue
+        if codigo in existentes:
+            importacao.atualizados += 1
+        else:
+            importacao.inseridos += 1
+    db.session.commit()
+    _atualizar_importados(por_codigo, existentes.values())
+
+def _atualizar_importados(por_codigo, ids_existentes):
+    invalidar_cache('produto', *ids_existentes)
+    indice = _indices_busca.get('produtos')
+    if indice is not None:
+        for produto_id, nome, codigo in db.session.query(Produto.id, Produto.nome, Produto.codigo).filter(Produto.codigo.in_(list(por_codigo))):
+            indice.atualizar(produto_id, [nome, codigo])
+
+def _registrar_erro_importacao(importacao, erros, numero, mensagem):
+    importacao.com_erro += 1
+    if len(erros) < current_app.config['IMPORTACAO_MAX_ERROS']:
+        erros.append({'linha': numero, 'message': mensagem})
+
+def _processar_importacao(flask_app, importacao_id, caminho):
+    with flask_app.app_context():
+        importacao = Importacao.query.get(importacao_id)
+        importacao.status = 'processando'
+        db.session.commit()
+
+        erros = []
+        try:
+            fornecedores = {}
+            for fornecedor_id, nome, cnpj in db.session.query(Fornecedor.id, Fornecedor.nome, Fornecedor.cnpj):
+                fornecedores[('fornecedor_id', str(fornecedor_id))] = fornecedor_id
+                fornecedores[('fornecedor', nome.lower())] = fornecedor_id
+                if cnpj:
+                    fornecedores[('fornecedor_cnpj', cnpj.lower())] = fornecedor_id
+
+            lote = []
+            for numero, linha in _ler_planilha(caminho):
+                importacao.processadas += 1
+                try:
+                    lote.append((numero, _normalizar_linha_importacao(linha, fornecedores)))
+                except ValueError as e:
+                    _registrar_erro_importacao(importacao, erros, numero, str(e))
+
+                if len(lote) >= current_app.config['IMPORTACAO_LOTE']:
+                    _importar_lote_produtos(lote, importacao, erros)
+                    lote = []
+                    importacao.erros = json.dumps(erros, ensure_ascii=False)
+                    db.session.commit() # Progresso visível em GET /imports/<id>
+            if lote:
+                _importar_lote_produtos(lote, importacao, erros)
+
+            importacao.status = 'concluida'
+            importacao.mensagem = f"{importacao.inseridos} produtos inseridos, {importacao.atualizados} atualizados, {importacao.com_erro} linhas com erro."
+        except Exception as e:
+            db.session.rollback()
+            importacao = Importacao.query.get(importacao_id)
+            importacao.status = 'falhou'
+            importacao.mensagem = f"Erro ao processar importação: {str(e)}"
+        finally:
+            importacao.erros = json.dumps(erros, ensure_ascii=False)
+            importacao.finalizado_em = datetime.now()
+            db.session.commit()
+            try:
+                os.remove(caminho)
+            except OSError:
+                pass
+
+        # Inserções em lote não passam pelos contadores incrementais nem pelos eventos de estoque
+        try:
+            reconciliar_resumo_dashboard()
+            sincronizar_deposito_padrao()
+            agendar_verificacao_razao()
+            publicar_evento_resync()
+        except Exception:
+            db.session.rollback()
+            logger.exception("Erro ao reconciliar o resumo após importação")
+
+@api.route('/imports', methods=['POST'])
+@jwt_required() # Protege a rota de importação de catálogo
+def criar_importacao():
+    arquivo = request.files.get('arquivo')
+    if arquivo is None or not arquivo.filename:
+        return jsonify({"message": "Envie o arquivo no campo 'arquivo' (multipart/form-data)."}), 400
+
+    nome_arquivo = secure_filename(arquivo.filename)
+    if not nome_arquivo.lower().endswith(('.csv', '.xlsx')):
+        return jsonify({"message": "Formato de arquivo inválido. Use CSV ou XLSX."}), 400
+
+    importacao = Importacao(arquivo_nome=nome_arquivo, usuario_id=usuario_atual()['id'])
+    try:
+        db.session.add(importacao)
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({"message": f"Erro ao criar importação: {str(e)}"}), 500
+
+    os.makedirs(current_app.config['IMPORTACAO_DIR'], exist_ok=True)
+    caminho = os.path.join(current_app.config['IMPORTACAO_DIR'], f'{importacao.id}_{nome_arquivo}')
+    arquivo.save(caminho)
+
+    _executor_importacao().submit(_processar_importacao, current_app._get_current_object(), importacao.id, caminho)
+    return jsonify({"message": "Importação recebida e em processamento.", "importacao": importacao.to_dict()}), 202
+
+@api.route('/imports/<int:importacao_id>', methods=['GET'])
+@jwt_required() # Protege a rota de acompanhamento da importação
+def get_importacao(importacao_id):
+    importacao = Importacao.query.get(importacao_id)
+    if importacao:
+        return jsonify(importacao.to_dict()), 200
+    return jsonify({"message": "Importação não encontrada."}), 404
+
+# --- Saúde do Serviço (liveness/readiness) ---
+@api.route('/saude/vivo', methods=['GET'])
+def saude_vivo():
+    # Liveness: o processo responde; não toca no banco para não reiniciar workers por causa dele
+    return jsonify({"status": "ok"}), 200
+
+@api.route('/saude/pronto', methods=['GET'])
+def saude_pronto():
+    # Readiness: banco acessível e esquema na última migração
+    try:
+        versao = db.session.query(db.func.max(SchemaMigracao.versao)).scalar()
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({"status": "indisponivel", "message": f"Banco de dados inacessível: {str(e)}"}), 503
+    versao_esperada = max(versao for versao, _, _ in MIGRACOES)
+    if versao != versao_esperada:
+        return jsonify({"status": "indisponivel", "message": f"Esquema na versão {versao}; esperada {versao_esperada}. Rode `flask migrar`."}), 503
+    return jsonify({"status": "pronto", "versao_esquema": versao}), 200
+
+# --- Medição de Inicialização ---
+@api.cli.command('medir-inicializacao')
+@click.option('--execucoes', default=5, show_default=True, help='Processos novos a medir.')
+def medir_inicializacao_command(execucoes):
+    # Cada execução é um processo novo (partida a frio), como um worker do gunicorn
+    import benchmarks
+    medicoes = [benchmarks.executar('inicializacao') for _ in range(execucoes)]
+    for chave in ['importacao_ms', 'create_app_ms', 'primeira_requisicao_ms', 'memoria_mb']:
+        valores = sorted(medicao[chave] for medicao in medicoes)
+        print(f"{chave}: mediana={valores[len(valores) // 2]:.1f} min={valores[0]:.1f} max={valores[-1]:.1f}")
+
+# --- Fábrica da Aplicação ---
+def create_app(config=None):
+    # Sem DDL e sem conexões aqui: o esquema é responsabilidade de `flask migrar`
+    app = Flask(__name__)
+    app.json = ProvedorJSON(app)
+    configurar(app)
+    app.config.update(config or {})
+
+    if not logging.getLogger().handlers:
+        logging.basicConfig(format='%(asctime)s %(levelname)s %(name)s %(message)s')
+    logger.setLevel(app.config['LOG_LEVEL'])
+
+    db.init_app(app)
+    CORS(app)
+    bcrypt.init_app(app)
+    jwt.init_app(app)
+    app.register_blueprint(api)
+    return app
+
 # --- Execução do Aplicativo Flask ---
+# Produção: `gunicorn -c gunicorn.conf.py wsgi:app`. Este bloco é só para desenvolvimento.
 if __name__ == '__main__':
-    app.run(debug=True, port=5000)
+    app = create_app()
+    with app.app_context():
+        aplicar_migracoes()
+    app.run(debug=os.environ.get('FLASK_DEBUG', 'true').lower() == 'true', port=int(os.environ.get('PORT', 5000)))
 
 # ---
\ No newline at end of file
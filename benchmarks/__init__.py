@@ -0,0 +1,29 @@
+# Benchmarks dos comandos `flask medir-*`. Cada um roda num processo novo (python -m benchmarks.<script>), com um
+# banco descartável, e imprime a medição como JSON na última linha da saída. Só biblioteca padrão aqui: o
+# benchmark de inicialização mede a importação do app sem nada carregado antes.
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def executar(script, *argumentos, banco=None, log_level='WARNING', **variaveis):
+    # banco: URL de um banco descartável (padrão: SQLite temporário desta execução). variaveis: ambiente extra
+    # do processo (ex.: MOVIMENTACOES_JOURNAL_ARQUIVO), por cima do padrão sem réplicas e sem journal
+    with tempfile.TemporaryDirectory() as temporario:
+        ambiente = dict(os.environ)
+        ambiente.update(
+            DB_CONNECTION_STRING=banco or f"sqlite:///{os.path.join(temporario, 'benchmark.db')}",
+            DB_REPLICA_URLS='',
+            MOVIMENTACOES_JOURNAL_ARQUIVO='',
+            LOG_LEVEL=log_level
+        )
+        ambiente.update(variaveis)
+        saida = subprocess.run([sys.executable, '-m', f'benchmarks.{script}', *[str(argumento) for argumento in argumentos]],
+                               cwd=RAIZ, env=ambiente, capture_output=True, text=True)
+    if saida.returncode != 0:
+        import click
+        raise click.ClickException(f"benchmarks.{script} terminou com código {saida.returncode}:\n{saida.stderr.strip()}")
+    return json.loads(saida.stdout.strip().splitlines()[-1])
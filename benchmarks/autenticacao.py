@@ -0,0 +1,67 @@
+# flask medir-autenticacao: latência das movimentações em repouso e durante uma tempestade de logins
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+import app as modulo
+from benchmarks import comum
+
+def medir(threads, movimentacoes):
+    aplicacao = comum.aplicacao_migrada()
+    cliente = aplicacao.test_client()
+    contas = [f'bench-{uuid.uuid4().hex}@local' for _ in range(threads)]
+    cliente.post('/register', json={'username': contas[0], 'email': contas[0], 'password': 'bench'})
+    with aplicacao.app_context():
+        # Mesma senha em todas as contas: um bcrypt só na preparação
+        senha = modulo.User.query.filter_by(email=contas[0]).one().password_hash
+        modulo.db.session.execute(modulo.insert(modulo.User), [
+            {'username': email, 'email': email, 'password_hash': senha} for email in contas[1:]
+        ])
+        modulo.db.session.commit()
+    token = cliente.post('/login', json={'email': contas[0], 'password': 'bench'}).get_json()['token']
+    cabecalhos = {'Authorization': f'Bearer {token}'}
+    produto_id = comum.criar_produto(cliente, cabecalhos)['id']
+
+    def medir_movimentacoes():
+        duracoes = []
+        for _ in range(movimentacoes):
+            inicio = time.perf_counter()
+            resposta = cliente.post('/movimentacoes', headers=cabecalhos, json={'produto_id': produto_id, 'tipo_movimentacao': 'entrada', 'quantidade': 1})
+            duracoes.append(time.perf_counter() - inicio)
+            assert resposta.status_code == 201
+        return comum.percentis_ms(duracoes)
+
+    # Tempestade: logins válidos de contas e IPs distintos (o limite por IP não corta o bcrypt). Recusados
+    # esperam o Retry-After: o gerador de carga roda no mesmo processo e não pode disputar a CPU em laço
+    parar = threading.Event()
+    logins = Counter()
+    def tempestade(numero):
+        cliente_login = aplicacao.test_client()
+        while not parar.is_set():
+            resposta = cliente_login.post('/login', json={'email': contas[numero], 'password': 'bench'},
+                                          environ_base={'REMOTE_ADDR': f'10.0.{numero // 250}.{numero % 250 + 1}'})
+            logins[resposta.status_code] += 1
+            if 'Retry-After' in resposta.headers:
+                parar.wait(float(resposta.headers['Retry-After']))
+
+    repouso = medir_movimentacoes()
+    inicio = time.perf_counter()
+    with ThreadPoolExecutor(threads) as executor:
+        for numero in range(threads):
+            executor.submit(tempestade, numero)
+        time.sleep(1) # A fila do pool de autenticação enche antes da medição
+        durante = medir_movimentacoes()
+        parar.set()
+    duracao = time.perf_counter() - inicio
+    return {
+        'repouso_p50_ms': repouso[0], 'repouso_p99_ms': repouso[1],
+        'tempestade_p50_ms': durante[0], 'tempestade_p99_ms': durante[1],
+        'logins_por_segundo': logins[200] / duracao,
+        'logins': {str(status): total for status, total in logins.items()}
+    }
+
+if __name__ == '__main__':
+    comum.emitir(medir(int(sys.argv[1]), int(sys.argv[2])))
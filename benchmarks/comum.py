@@ -0,0 +1,42 @@
+# Preparação repetida pelos scripts: app com o esquema migrado, usuário autenticado e produto de teste
+import contextlib
+import json
+import statistics
+import time
+import uuid
+
+import app as modulo
+
+def aplicacao_migrada():
+    aplicacao = modulo.create_app()
+    with aplicacao.app_context():
+        modulo.aplicar_migracoes()
+    return aplicacao
+
+def autenticar(cliente):
+    email = f'bench-{uuid.uuid4().hex}@local'
+    cliente.post('/register', json={'username': email, 'email': email, 'password': 'bench'})
+    token = cliente.post('/login', json={'email': email, 'password': 'bench'}).get_json()['token']
+    return {'Authorization': f'Bearer {token}'}
+
+def criar_produto(cliente, cabecalhos, **campos):
+    return cliente.post('/produtos', headers=cabecalhos, json=dict({
+        'nome': 'Benchmark', 'codigo': uuid.uuid4().hex[:20], 'unidade_medida': 'UN', 'preco_compra': 1, 'preco_venda': 1
+    }, **campos)).get_json()['produto']
+
+def mediana_ms(funcao, execucoes=5, contexto=contextlib.nullcontext):
+    duracoes = []
+    for _ in range(execucoes):
+        with contexto():
+            inicio = time.perf_counter()
+            funcao()
+            duracoes.append(time.perf_counter() - inicio)
+    return statistics.median(duracoes) * 1000
+
+def percentis_ms(duracoes):
+    # (p50, p99) em milissegundos
+    duracoes = sorted(duracoes)
+    return duracoes[len(duracoes) // 2] * 1000, duracoes[min(len(duracoes) - 1, int(len(duracoes) * 0.99))] * 1000
+
+def emitir(medicao):
+    print(json.dumps(medicao))
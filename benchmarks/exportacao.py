@@ -0,0 +1,52 @@
+# flask medir-exportacao: fase 'popular' grava as movimentações; fase 'exportar' (outro processo) exporta tudo,
+# para o pico de memória (ru_maxrss) refletir só a exportação
+import resource
+import sys
+import time
+import uuid
+from datetime import datetime, timedelta
+
+import app as modulo
+from benchmarks import comum
+
+def popular(linhas):
+    aplicacao = comum.aplicacao_migrada()
+    with aplicacao.app_context():
+        modulo.db.session.execute(modulo.insert(modulo.Produto), [{
+            'nome': 'Benchmark', 'codigo': uuid.uuid4().hex[:20], 'unidade_medida': 'UN', 'preco_compra': 1, 'preco_venda': 1
+        }])
+        produto_id = modulo.db.session.query(modulo.db.func.max(modulo.Produto.id)).scalar()
+        inicio_dados = datetime.now() - timedelta(seconds=linhas)
+        for inicio in range(0, linhas, 20000):
+            modulo.db.session.execute(modulo.insert(modulo.Movimentacao), [
+                {'produto_id': produto_id, 'tipo_movimentacao': 'entrada', 'quantidade': 1, 'observacao': f'linha {numero}',
+                 'data_hora': inicio_dados + timedelta(seconds=numero), 'deposito_id': modulo.DEPOSITO_PADRAO_ID}
+                for numero in range(inicio, min(inicio + 20000, linhas))
+            ])
+        modulo.db.session.commit()
+    aplicacao.test_client().post('/register', json={'username': 'bench', 'email': 'bench@local', 'password': 'bench'})
+    return {}
+
+def exportar(formato):
+    cliente = modulo.create_app().test_client()
+    token = cliente.post('/login', json={'email': 'bench@local', 'password': 'bench'}).get_json()['token']
+    divisor = 1024 * 1024 if sys.platform == 'darwin' else 1024
+    memoria_inicial = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / divisor
+    inicio = time.perf_counter()
+    resposta = cliente.get(f'/export/movimentacoes?format={formato}', headers={'Authorization': f'Bearer {token}'}, buffered=False)
+    exportadas = tamanho = 0
+    for bloco in resposta.response:
+        exportadas += bloco.count(b'\n')
+        tamanho += len(bloco)
+    resposta.close()
+    return {
+        'linhas': exportadas - (1 if formato == 'csv' else 0), # Cabeçalho do CSV
+        'megabytes': tamanho / (1024 * 1024),
+        'segundos': time.perf_counter() - inicio,
+        'memoria_inicial_mb': memoria_inicial,
+        'memoria_pico_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / divisor
+    }
+
+if __name__ == '__main__':
+    fase, linhas, formato = sys.argv[1], int(sys.argv[2]), sys.argv[3]
+    comum.emitir(popular(linhas) if fase == 'popular' else exportar(formato))
@@ -0,0 +1,21 @@
+# flask medir-inicializacao: importação do app, create_app e primeira requisição num processo novo (partida a frio)
+import json
+import resource
+import sys
+import time
+
+inicio = time.perf_counter()
+import app as modulo
+importado = time.perf_counter()
+aplicacao = modulo.create_app()
+criado = time.perf_counter()
+resposta = aplicacao.test_client().get('/saude/vivo')
+pronto = time.perf_counter()
+maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+print(json.dumps({
+    'importacao_ms': (importado - inicio) * 1000,
+    'create_app_ms': (criado - importado) * 1000,
+    'primeira_requisicao_ms': (pronto - criado) * 1000,
+    'memoria_mb': maxrss / (1024 * 1024 if sys.platform == 'darwin' else 1024),
+    'status': resposta.status_code
+}))
@@ -0,0 +1,43 @@
+# flask medir-lote: N POSTs individuais contra um POST /movimentacoes/lote com as mesmas N linhas
+import sys
+import time
+
+import app as modulo
+from benchmarks import comum
+
+def medir(linhas, produtos):
+    aplicacao = comum.aplicacao_migrada()
+    cliente = aplicacao.test_client()
+    cabecalhos = comum.autenticar(cliente)
+    produto_ids = [comum.criar_produto(cliente, cabecalhos)['id'] for _ in range(produtos)]
+    movimentacoes = [
+        {'produto_id': produto_ids[numero % produtos], 'tipo_movimentacao': 'entrada', 'quantidade': 1}
+        for numero in range(linhas)
+    ]
+
+    inicio = time.perf_counter()
+    erros_individuais = sum(
+        1 for movimentacao in movimentacoes
+        if cliente.post('/movimentacoes', headers=cabecalhos, json=movimentacao).status_code != 201
+    )
+    individual = time.perf_counter() - inicio
+
+    inicio = time.perf_counter()
+    resposta = cliente.post('/movimentacoes/lote', headers=cabecalhos, json={'movimentacoes': movimentacoes}).get_json()
+    lote = time.perf_counter() - inicio
+
+    with aplicacao.app_context():
+        modulo.consolidar_estoque()
+        estoque_total = modulo.db.session.query(modulo.db.func.sum(modulo.Produto.estoque_atual)).filter(
+            modulo.Produto.id.in_(produto_ids)
+        ).scalar()
+    return {
+        'individual_por_segundo': linhas / individual,
+        'lote_por_segundo': linhas / lote,
+        'erros_individuais': erros_individuais,
+        'erros_lote': resposta['erros'],
+        'estoque_total': estoque_total
+    }
+
+if __name__ == '__main__':
+    comum.emitir(medir(int(sys.argv[1]), int(sys.argv[2])))
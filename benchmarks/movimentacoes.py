@@ -0,0 +1,60 @@
+# flask medir-movimentacoes e medir-depositos: saídas concorrentes de um produto, repartidas entre N depósitos
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+import app as modulo
+from benchmarks import comum
+
+def medir(quantidade, threads, depositos=1, latencia_ms=0.0):
+    if latencia_ms:
+        # Ida e volta até o banco em cada comando, como num servidor em outra máquina: as travas ficam presas por mais tempo
+        event.listen(Engine, 'before_cursor_execute', lambda *args: time.sleep(latencia_ms / 1000))
+    aplicacao = comum.aplicacao_migrada()
+    cliente = aplicacao.test_client()
+    cabecalhos = comum.autenticar(cliente)
+    produto = comum.criar_produto(cliente, cabecalhos, estoque_atual=quantidade)
+    # Com N depósitos o estoque é repartido por transferências e as saídas se alternam entre eles
+    deposito_ids = [modulo.DEPOSITO_PADRAO_ID]
+    for numero in range(1, depositos):
+        deposito = cliente.post('/depositos', headers=cabecalhos, json={'nome': f"Benchmark {produto['codigo']} {numero}"}).get_json()['deposito']
+        cliente.post('/transferencias', headers=cabecalhos, json={
+            'produto_id': produto['id'], 'deposito_origem_id': modulo.DEPOSITO_PADRAO_ID,
+            'deposito_destino_id': deposito['id'], 'quantidade': len(range(numero, quantidade, depositos))
+        })
+        deposito_ids.append(deposito['id'])
+
+    def lancar(numero):
+        inicio = time.perf_counter()
+        resposta = aplicacao.test_client().post('/movimentacoes', headers=cabecalhos, json={
+            'produto_id': produto['id'], 'tipo_movimentacao': 'saida', 'quantidade': 1,
+            'deposito_id': deposito_ids[numero % depositos]
+        })
+        return resposta.status_code, time.perf_counter() - inicio
+
+    inicio = time.perf_counter()
+    with ThreadPoolExecutor(threads) as executor:
+        resultados = list(executor.map(lancar, range(quantidade)))
+    confirmado = time.perf_counter()
+    if modulo._journal_movimentacoes is not None:
+        modulo._journal_movimentacoes.aguardar_aplicacao(600)
+    with aplicacao.app_context():
+        modulo.consolidar_estoque() # O que a thread de consolidação ainda não aplicou ao agregado
+    aplicado = time.perf_counter()
+    with aplicacao.app_context():
+        estoque_final = modulo.db.session.get(modulo.Produto, produto['id']).estoque_atual
+    p50, p99 = comum.percentis_ms([duracao for _, duracao in resultados])
+    return {
+        'confirmadas_por_segundo': quantidade / (confirmado - inicio),
+        'aplicadas_por_segundo': quantidade / (aplicado - inicio),
+        'latencia_p50_ms': p50,
+        'latencia_p99_ms': p99,
+        'erros': sum(1 for status, _ in resultados if status >= 300),
+        'estoque_final': estoque_final
+    }
+
+if __name__ == '__main__':
+    comum.emitir(medir(int(sys.argv[1]), int(sys.argv[2]), int(sys.argv[3]), float(sys.argv[4])))
@@ -0,0 +1,44 @@
+# flask medir-paginacao: página 1 e página N de GET /movimentacoes, por offset e por cursor (mediana de 5)
+import sys
+from datetime import datetime, timedelta
+
+import app as modulo
+from benchmarks import comum
+
+def medir(linhas, por_pagina, pagina):
+    aplicacao = comum.aplicacao_migrada()
+    cliente = aplicacao.test_client()
+    cabecalhos = comum.autenticar(cliente)
+    produto_id = comum.criar_produto(cliente, cabecalhos)['id']
+
+    # Só leitura: as linhas entram direto na tabela, sem passar pelo estoque
+    inicio_dados = datetime.now() - timedelta(seconds=linhas)
+    with aplicacao.app_context():
+        for inicio in range(0, linhas, 10000):
+            modulo.db.session.execute(modulo.insert(modulo.Movimentacao), [
+                {'produto_id': produto_id, 'tipo_movimentacao': 'entrada', 'quantidade': 1,
+                 'data_hora': inicio_dados + timedelta(seconds=numero), 'deposito_id': modulo.DEPOSITO_PADRAO_ID}
+                for numero in range(inicio, min(inicio + 10000, linhas))
+            ])
+        modulo.db.session.commit()
+        # Cursor equivalente à página pedida: chave da última linha da página anterior
+        ultima = modulo.Movimentacao.query.order_by(
+            modulo.Movimentacao.data_hora.desc(), modulo.Movimentacao.id.desc()
+        ).offset((pagina - 1) * por_pagina - 1).first()
+        cursor = modulo._serializador_cursor().dumps([ultima.data_hora.isoformat(), ultima.id])
+
+    def listar(url):
+        def pedir():
+            resposta = cliente.get(url, headers=cabecalhos)
+            assert resposta.status_code == 200 and len(resposta.get_json()['items']) == por_pagina
+        return comum.mediana_ms(pedir)
+
+    return {
+        'offset_pagina_1_ms': listar(f'/movimentacoes?page=1&per_page={por_pagina}'),
+        'offset_pagina_n_ms': listar(f'/movimentacoes?page={pagina}&per_page={por_pagina}'),
+        'cursor_pagina_1_ms': listar(f'/movimentacoes?cursor=&limit={por_pagina}'),
+        'cursor_pagina_n_ms': listar(f'/movimentacoes?cursor={cursor}&limit={por_pagina}'),
+    }
+
+if __name__ == '__main__':
+    comum.emitir(medir(int(sys.argv[1]), int(sys.argv[2]), int(sys.argv[3])))
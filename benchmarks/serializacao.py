@@ -0,0 +1,41 @@
+# flask medir-serializacao: to_dict + JSON padrão contra o serializador compilado, mediana de 5 execuções
+import sys
+import uuid
+
+from flask.json.provider import DefaultJSONProvider
+
+import app as modulo
+from benchmarks import comum
+
+def medir(linhas):
+    aplicacao = comum.aplicacao_migrada()
+    with aplicacao.app_context():
+        modulo.db.session.execute(modulo.insert(modulo.Fornecedor), [{'nome': f'Fornecedor {numero}'} for numero in range(20)])
+        fornecedor_ids = [fornecedor_id for (fornecedor_id,) in modulo.db.session.query(modulo.Fornecedor.id)]
+        for inicio in range(0, linhas, 10000):
+            modulo.db.session.execute(modulo.insert(modulo.Produto), [{
+                'nome': f'Produto {numero}', 'codigo': uuid.uuid4().hex[:20], 'unidade_medida': 'UN', 'descricao': 'Benchmark',
+                'preco_compra': 10.5, 'preco_venda': 19.9, 'estoque_atual': numero % 100, 'estoque_minimo': 10,
+                'ncm': '12345678', 'icms_aliquota': 18, 'icms_valor': 3.58, 'ipi_aliquota': 5, 'ipi_valor': 1,
+                'pis_aliquota': 1.65, 'pis_valor': 0.33, 'cofins_aliquota': 7.6, 'cofins_valor': 1.51,
+                'fornecedor_id': fornecedor_ids[numero % len(fornecedor_ids)]
+            } for numero in range(inicio, min(inicio + 10000, linhas))])
+        modulo.db.session.commit()
+
+    def to_dict():
+        # Caminho anterior: objetos ORM, to_dict por linha e o JSON padrão do Flask
+        DefaultJSONProvider(aplicacao).response([produto.to_dict() for produto in modulo.Produto.query.all()])
+
+    def serializador(campos=None):
+        query, codificar = modulo.SERIALIZADORES['produtos'].aplicar(modulo.Produto.query, campos)
+        aplicacao.json.response([codificar(linha) for linha in query.all()])
+
+    return {
+        'to_dict_ms': comum.mediana_ms(to_dict, contexto=aplicacao.app_context),
+        'serializador_ms': comum.mediana_ms(serializador, contexto=aplicacao.app_context),
+        'serializador_campos_ms': comum.mediana_ms(lambda: serializador(['id', 'nome', 'estoque_atual']), contexto=aplicacao.app_context),
+        'orjson': modulo.orjson is not None
+    }
+
+if __name__ == '__main__':
+    comum.emitir(medir(int(sys.argv[1])))
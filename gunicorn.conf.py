@@ -0,0 +1,47 @@
+# Configuração do gunicorn lida do ambiente: gunicorn -c gunicorn.conf.py wsgi:app
+import multiprocessing
+import os
+import re
+
+from gunicorn.glogging import Logger
+
+bind = os.environ.get('WEB_BIND', '0.0.0.0:5000')
+# Com MOVIMENTACOES_JOURNAL_ARQUIVO só um worker usa o journal (reservas em memória); os outros respondem 503 às escritas de estoque: use WEB_WORKERS=1 e mais WEB_THREADS
+workers = int(os.environ.get('WEB_WORKERS', min(multiprocessing.cpu_count() * 2 + 1, 8)))
+# gthread: uma conexão de /eventos/estoque (SSE) ocupa uma thread, não o worker inteiro
+worker_class = os.environ.get('WEB_WORKER_CLASS', 'gthread')
+threads = int(os.environ.get('WEB_THREADS', 8))
+timeout = int(os.environ.get('WEB_TIMEOUT', 60))
+graceful_timeout = int(os.environ.get('WEB_GRACEFUL_TIMEOUT', 30))
+keepalive = int(os.environ.get('WEB_KEEPALIVE', 5))
+# Recicla workers periodicamente para conter crescimento de memória
+max_requests = int(os.environ.get('WEB_MAX_REQUESTS', 5000))
+max_requests_jitter = int(os.environ.get('WEB_MAX_REQUESTS_JITTER', 500))
+# Carrega o app uma vez no master e compartilha a memória com os workers (copy-on-write)
+preload_app = os.environ.get('WEB_PRELOAD', 'true').lower() == 'true'
+accesslog = os.environ.get('WEB_ACCESS_LOG', '-')
+
+# Credenciais na query string (?ticket= do stream de eventos, ?jwt= de clientes antigos) não vão para o access log
+_CREDENCIAIS_NA_URL = re.compile(r'(?<![^?&\s])(jwt|ticket)=[^&\s"]*')
+
+
+class LoggerSemCredenciais(Logger):
+    def atoms(self, resp, req, environ, request_time):
+        atomos = super().atoms(resp, req, environ, request_time)
+        for chave, valor in atomos.items():
+            if isinstance(valor, str):
+                atomos[chave] = _CREDENCIAIS_NA_URL.sub(r'\1=[removido]', valor)
+        return atomos
+
+
+logger_class = LoggerSemCredenciais
+
+
+def post_fork(server, worker):
+    # Conexões abertas no master não podem ser compartilhadas entre processos
+    if preload_app:
+        from app import db
+        from wsgi import app
+        with app.app_context():
+            for engine in db.engines.values():
+                engine.dispose(close=False)
@@ -1,5 +1,5 @@
 // src/components/MovimentacaoForm.js
-import React, { useState, useEffect } from 'react';
+import React, { useState, useEffect, useRef } from 'react';
 import styles from '../CSSs/MovimentacaoForm.module.css';
 import { toast } from 'react-toastify';
 
@@ -16,6 +16,8 @@ function MovimentacaoForm({ onSaveSuccess, onCancel, getAuthHeaders }) { // RECE
   });
   const [errors, setErrors] = useState({});
   const [clientes, setClientes] = useState([]);
+  // Mesma chave em todas as tentativas do mesmo lançamento: o backend registra a movimentação uma única vez
+  const idempotencyKey = useRef(crypto.randomUUID());
 
   // Função para buscar clientes (AGORA USA getAuthHeaders)
   useEffect(() => {
@@ -46,6 +48,7 @@ function MovimentacaoForm({ onSaveSuccess, onCancel, getAuthHeaders }) { // RECE
       newValue = type === 'number' ? parseInt(value) || 0 : value;
     }
 
+    idempotencyKey.current = crypto.randomUUID(); // Dados alterados: não é mais uma repetição
     setFormData({
       ...formData,
       [name]: newValue,
@@ -87,7 +90,7 @@ function MovimentacaoForm({ onSaveSuccess, onCancel, getAuthHeaders }) { // RECE
     try {
       const response = await fetch(`${API_BASE_URL}/movimentacoes`, {
         method: 'POST',
-        headers: getAuthHeaders(), // <--- CORRIGIDO
+        headers: { ...getAuthHeaders(), 'Idempotency-Key': idempotencyKey.current },
         body: JSON.stringify(formData),
       });
 
@@ -99,6 +102,7 @@ function MovimentacaoForm({ onSaveSuccess, onCancel, getAuthHeaders }) { // RECE
       }
 
       toast.success(result.message);
+      idempotencyKey.current = crypto.randomUUID(); // Próximo lançamento é uma nova operação
       setFormData({
         produto_id: '',
         tipo_movimentacao: 'entrada',
@@ -34,6 +34,61 @@ function RelatorioEstoqueCritico({ onProdutoClick, onCancel, getAuthHeaders }) {
     fetchEstoqueCritico();
   }, [fetchEstoqueCritico]);
 
+  // Atualizações em tempo real: o relatório é baixado uma vez e depois mantido pelos eventos do servidor.
+  // O EventSource não envia cabeçalhos: o stream abre com um ticket curto, pedido com o token no cabeçalho
+  // (o token não vai na URL, que aparece em logs e no histórico)
+  useEffect(() => {
+    let eventos = null;
+    let ultimoId = null;
+    let reconexao = null;
+    let encerrado = false;
+    const pertenceAoRelatorio = (status) => (
+      reportType === 'em_falta' ? status === 'em_falta' : status === 'baixo' || status === 'em_falta'
+    );
+
+    const conectar = async () => {
+      try {
+        const response = await fetch(`${API_BASE_URL}/eventos/estoque/ticket`, { method: 'POST', headers: getAuthHeaders() });
+        if (!response.ok || encerrado) return; // Sem sessão válida: fica só com o relatório baixado
+        const { ticket } = await response.json();
+        const parametros = new URLSearchParams({ ticket });
+        if (ultimoId !== null) parametros.set('ultimo_id', ultimoId);
+        eventos = new EventSource(`${API_BASE_URL}/eventos/estoque?${parametros}`);
+      } catch (err) {
+        console.error("Erro ao abrir os eventos de estoque:", err);
+        return;
+      }
+
+      eventos.addEventListener('estoque', (e) => {
+        ultimoId = e.lastEventId || ultimoId;
+        const { status, produto } = JSON.parse(e.data);
+        setProdutosCriticos((atuais) => {
+          const outros = atuais.filter(p => p.id !== produto.id);
+          if (!pertenceAoRelatorio(status)) return outros;
+          return [...outros, produto].sort((a, b) => a.nome.localeCompare(b.nome));
+        });
+      });
+      // Eventos perdidos (importação em massa ou conexão lenta): recarrega o relatório completo
+      eventos.addEventListener('resync', () => fetchEstoqueCritico());
+      // Ticket vencido na reconexão automática, ou token expirado/revogado durante o stream: novo ticket
+      const renovar = () => {
+        eventos.close();
+        if (!encerrado) reconexao = setTimeout(conectar, 3000);
+      };
+      eventos.addEventListener('expirado', renovar);
+      eventos.onerror = () => {
+        if (eventos.readyState === EventSource.CLOSED) renovar();
+      };
+    };
+
+    conectar();
+    return () => {
+      encerrado = true;
+      clearTimeout(reconexao);
+      if (eventos) eventos.close();
+    };
+  }, [reportType, fetchEstoqueCritico, getAuthHeaders]);
+
   return (
     <div className={styles.container}>
       <h2 className={styles.heading}>Relatório de Estoque Crítico</h2>
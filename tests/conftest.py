@@ -0,0 +1,59 @@
+import os
+import sys
+import uuid
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture(scope='session')
+def modulo(tmp_path_factory):
+    # Banco SQLite descartável, configurado antes de importar o app (o .env aponta para o banco de desenvolvimento)
+    temporario = tmp_path_factory.mktemp('banco')
+    os.environ.update(
+        DB_CONNECTION_STRING=f"sqlite:///{temporario / 'testes.db'}",
+        DB_REPLICA_URLS='',
+        MOVIMENTACOES_JOURNAL_ARQUIVO='',
+        ESTOQUE_CONSOLIDACAO_SEGUNDOS='0', # Sem a thread: os testes consolidam o estoque quando precisam
+        JWT_SECRET_KEY='chave-dos-testes-' + 'x' * 32,
+        LOG_LEVEL='WARNING',
+    )
+    import app
+    return app
+
+
+@pytest.fixture(scope='session')
+def aplicacao(modulo):
+    aplicacao = modulo.create_app({'TESTING': True})
+    with aplicacao.app_context():
+        modulo.aplicar_migracoes()
+    return aplicacao
+
+
+@pytest.fixture(scope='session')
+def cabecalhos(aplicacao):
+    cliente = aplicacao.test_client()
+    email = f'testes-{uuid.uuid4().hex}@local'
+    cliente.post('/register', json={'username': email, 'email': email, 'password': 'testes'})
+    token = cliente.post('/login', json={'email': email, 'password': 'testes'}).get_json()['token']
+    return {'Authorization': f'Bearer {token}'}
+
+
+@pytest.fixture
+def cliente(aplicacao):
+    return aplicacao.test_client()
+
+
+@pytest.fixture
+def criar_produto(cliente, cabecalhos):
+    # Cada teste cria os próprios produtos (código único): o banco é compartilhado pela sessão
+    def criar(**campos):
+        dados = dict({
+            'nome': 'Produto de teste', 'codigo': uuid.uuid4().hex[:20], 'unidade_medida': 'UN',
+            'preco_compra': 1, 'preco_venda': 2
+        }, **campos)
+        resposta = cliente.post('/produtos', headers=cabecalhos, json=dados)
+        assert resposta.status_code == 201, resposta.get_json()
+        return resposta.get_json()['produto']
+    return criar
@@ -0,0 +1,37 @@
+# Escritor dos testes de recuperação do journal (processo separado, morto com SIGKILL):
+#   python journal_escritor.py <arquivo do journal> '<movimentações em JSON>'
+# Confirma as movimentações no journal (uma sequência por linha na saída), espera uma linha na entrada (o teste
+# pode mexer no banco nesse intervalo), deixa um registro cortado no fim do arquivo e libera a aplicação. O
+# processo morre logo depois de o primeiro grupo ser gravado no banco, antes de o journal marcá-lo como aplicado.
+import json
+import os
+import signal
+import sys
+import threading
+
+import app as modulo
+
+caminho, movimentacoes = sys.argv[1], json.loads(sys.argv[2])
+
+liberar = threading.Event()
+aplicar_grupo = modulo.JournalMovimentacoes._aplicar_grupo
+
+def aplicar_depois_de_liberar(journal, grupo):
+    liberar.wait()
+    aplicar_grupo(journal, grupo)
+
+modulo.JournalMovimentacoes._aplicar_grupo = aplicar_depois_de_liberar
+modulo.JournalMovimentacoes._confirmar = lambda journal, grupo: os.kill(os.getpid(), signal.SIGKILL)
+
+aplicacao = modulo.create_app({'MOVIMENTACOES_JOURNAL_ARQUIVO': caminho, 'MOVIMENTACOES_JOURNAL_GRUPO_MAX': 2})
+with aplicacao.app_context():
+    journal = modulo.obter_journal_movimentacoes()
+    for movimentacao in movimentacoes:
+        print(journal.registrar(dict({'observacao': None, 'numero_nota_fiscal': None, 'cliente_id': None}, **movimentacao))['seq'], flush=True)
+
+sys.stdin.readline()
+with open(caminho, 'ab') as arquivo:
+    arquivo.write(b'{"produto_id": 1, "seq": ') # Queda no meio da escrita: nunca confirmado
+liberar.set()
+threading.Event().wait(60)
+sys.exit('O processo deveria ter morrido depois do primeiro grupo.')
@@ -0,0 +1,72 @@
+import json
+from datetime import datetime
+
+
+def _lancar(cliente, cabecalhos, produto_id, tipo):
+    assert cliente.post('/movimentacoes', headers=cabecalhos, json={
+        'produto_id': produto_id, 'tipo_movimentacao': tipo, 'quantidade': 1
+    }).status_code == 201
+
+
+def _lancar_e_arquivar(modulo, aplicacao, cliente, cabecalhos, produto_id, quantidade):
+    # `quantidade` saídas de janeiro/2024 (bem antes dos meses mantidos na tabela quente) e uma entrada atual,
+    # que fica na tabela quente
+    for _ in range(quantidade):
+        _lancar(cliente, cabecalhos, produto_id, 'saida')
+    with aplicacao.app_context():
+        modulo.db.session.execute(
+            modulo.update(modulo.Movimentacao).where(modulo.Movimentacao.produto_id == produto_id)
+            .values(data_hora=datetime(2024, 1, 15, 10))
+        )
+        modulo.db.session.commit()
+    _lancar(cliente, cabecalhos, produto_id, 'entrada')
+    with aplicacao.app_context():
+        modulo.arquivar_movimentacoes(12)
+        assert modulo.Movimentacao.query.filter_by(produto_id=produto_id).count() == 1
+
+
+def test_listagem_so_com_end_date_alcanca_o_arquivo(modulo, aplicacao, cliente, cabecalhos, criar_produto):
+    produto = criar_produto(estoque_atual=10)
+    _lancar_e_arquivar(modulo, aplicacao, cliente, cabecalhos, produto['id'], 3)
+
+    pagina = cliente.get(f"/movimentacoes?produto_id={produto['id']}&end_date=2024-12-31", headers=cabecalhos).get_json()
+    assert pagina['total_items'] == 3
+    assert len(pagina['items']) == 3
+
+    quente = cliente.get(f"/movimentacoes?produto_id={produto['id']}&incluir_arquivo=false", headers=cabecalhos).get_json()
+    assert quente['total_items'] == 1
+
+
+def test_exportacao_sem_intervalo_inclui_o_arquivo(modulo, aplicacao, cliente, cabecalhos, criar_produto):
+    produto = criar_produto(estoque_atual=10)
+    _lancar_e_arquivar(modulo, aplicacao, cliente, cabecalhos, produto['id'], 2)
+
+    resposta = cliente.get(f"/export/movimentacoes?produto_id={produto['id']}", headers=cabecalhos)
+    assert resposta.status_code == 200
+    linhas = [json.loads(linha) for linha in resposta.data.splitlines()]
+    assert sorted(linha['tipo_movimentacao'] for linha in linhas) == ['entrada', 'saida', 'saida']
+
+
+def test_arquivar_e_listar_paginas_atravessam_o_limite(modulo, aplicacao, cliente, cabecalhos, criar_produto):
+    produto = criar_produto(estoque_atual=10)
+    with aplicacao.app_context():
+        modulo.consolidar_estoque()
+    estoque_antes = cliente.get(f"/produtos/{produto['id']}", headers=cabecalhos).get_json()['estoque_atual']
+    _lancar_e_arquivar(modulo, aplicacao, cliente, cabecalhos, produto['id'], 3)
+    with aplicacao.app_context():
+        modulo.consolidar_estoque()
+        modulo.invalidar_cache('produto', produto['id'])
+
+    url = f"/movimentacoes?produto_id={produto['id']}&per_page=2"
+    paginas = [cliente.get(f'{url}&page={pagina}', headers=cabecalhos).get_json() for pagina in (1, 2)]
+
+    assert [pagina['total_items'] for pagina in paginas] == [4, 4]
+    itens = paginas[0]['items'] + paginas[1]['items']
+    assert len({item['id'] for item in itens}) == 4 # Nenhuma linha repetida nem perdida na fronteira
+    assert [item['tipo_movimentacao'] for item in itens] == ['entrada', 'saida', 'saida', 'saida']
+    assert [item['data_hora'] for item in itens] == sorted((item['data_hora'] for item in itens), reverse=True)
+    # Intervalo que começa depois do arquivo: só a tabela quente
+    recente = cliente.get(f"{url}&start_date={datetime.now().year}-01-01", headers=cabecalhos).get_json()
+    assert recente['total_items'] == 1
+    # Arquivar não muda o estoque (3 saídas e 1 entrada depois da leitura)
+    assert cliente.get(f"/produtos/{produto['id']}", headers=cabecalhos).get_json()['estoque_atual'] == estoque_antes - 2
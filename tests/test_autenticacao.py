@@ -0,0 +1,28 @@
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+
+def test_fila_do_bcrypt_esgotada_responde_503(modulo, aplicacao, cliente, monkeypatch):
+    email = f'fila-{uuid.uuid4().hex}@local'
+    assert cliente.post('/register', json={'username': email, 'email': email, 'password': 'testes'}).status_code == 201
+
+    # Pool de um worker, ocupado até o fim do teste: os pedidos ficam na fila além de AUTH_TIMEOUT_SEGUNDOS
+    executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='auth-teste')
+    liberar = threading.Event()
+    monkeypatch.setattr(modulo, '_auth_executor', executor)
+    monkeypatch.setattr(modulo, '_auth_vagas', threading.BoundedSemaphore(8))
+    monkeypatch.setitem(aplicacao.config, 'AUTH_TIMEOUT_SEGUNDOS', 0.2)
+    executor.submit(liberar.wait, 10)
+    try:
+        login = cliente.post('/login', json={'email': email, 'password': 'testes'})
+        registro = cliente.post('/register', json={'username': f'outro-{email}', 'email': f'outro-{email}', 'password': 'testes'})
+    finally:
+        liberar.set()
+        executor.shutdown(wait=True)
+        monkeypatch.undo()
+
+    for resposta in (login, registro):
+        assert resposta.status_code == 503
+        assert resposta.headers['Retry-After'] == '1'
+    assert cliente.post('/login', json={'email': email, 'password': 'testes'}).status_code == 200
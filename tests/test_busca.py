@@ -0,0 +1,16 @@
+import uuid
+
+
+def test_busca_limita_aos_resultados_mais_relevantes(aplicacao, cliente, cabecalhos, criar_produto, monkeypatch):
+    palavra = 'busca' + uuid.uuid4().hex[:8]
+    exato = criar_produto(nome=palavra)
+    for numero in range(6):
+        criar_produto(nome=f'{palavra} variante {numero}')
+    monkeypatch.setitem(aplicacao.config, 'BUSCA_MAX_RESULTADOS', 3)
+
+    pagina = cliente.get(f'/produtos?search={palavra}&per_page=10', headers=cabecalhos).get_json()
+    cursor = cliente.get(f'/produtos?search={palavra}&cursor=&per_page=10', headers=cabecalhos).get_json()
+
+    assert pagina['total_items'] == 3
+    assert pagina['items'][0]['id'] == exato['id'] # Nome idêntico ao termo vem primeiro
+    assert len(cursor['items']) == 3
@@ -0,0 +1,47 @@
+import uuid
+
+
+def _sessao_propria(cliente):
+    # Usuário só do teste: logout-todos não revoga o token compartilhado da sessão de testes
+    email = f'eventos-{uuid.uuid4().hex}@local'
+    cliente.post('/register', json={'username': email, 'email': email, 'password': 'testes'})
+    token = cliente.post('/login', json={'email': email, 'password': 'testes'}).get_json()['token']
+    return token, {'Authorization': f'Bearer {token}'}
+
+
+def _abrir_stream(cliente, url):
+    resposta = cliente.get(url, buffered=False)
+    primeiro = next(iter(resposta.response)) if resposta.status_code == 200 else None
+    resposta.close()
+    return resposta.status_code, primeiro
+
+
+def test_stream_abre_com_ticket_e_nao_com_token_na_url(cliente):
+    token, cabecalhos = _sessao_propria(cliente)
+    ticket = cliente.post('/eventos/estoque/ticket', headers=cabecalhos).get_json()['ticket']
+
+    assert _abrir_stream(cliente, f'/eventos/estoque?ticket={ticket}') == (200, b'retry: 3000\n\n')
+    assert _abrir_stream(cliente, f'/eventos/estoque?jwt={token}')[0] == 401
+    assert _abrir_stream(cliente, f'/eventos/estoque?ticket={token}')[0] == 401
+    # O ticket só vale para o stream
+    assert cliente.get('/produtos', headers={'Authorization': f'Bearer {ticket}'}).status_code in (401, 422)
+
+
+def test_ticket_de_token_revogado_e_recusado(cliente):
+    _, cabecalhos = _sessao_propria(cliente)
+    ticket = cliente.post('/eventos/estoque/ticket', headers=cabecalhos).get_json()['ticket']
+    assert cliente.post('/logout-todos', headers=cabecalhos).status_code == 200
+
+    assert _abrir_stream(cliente, f'/eventos/estoque?ticket={ticket}')[0] == 401
+
+
+def test_stream_encerra_quando_a_sessao_deixa_de_valer(modulo, aplicacao):
+    with aplicacao.app_context():
+        broker = modulo.obter_broker_eventos()
+    verificacoes = iter([True, False])
+    stream = modulo._stream_eventos_estoque(broker, broker.assinar(), None, 0, lambda: next(verificacoes))
+
+    mensagens = list(stream)
+
+    assert mensagens[0] == 'retry: 3000\n\n'
+    assert mensagens[-1].startswith('event: expirado')
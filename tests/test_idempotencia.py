@@ -0,0 +1,43 @@
+import uuid
+
+
+def _saldo_total(cliente, cabecalhos, produto_id):
+    saldos = cliente.get(f'/produtos/{produto_id}/depositos', headers=cabecalhos).get_json()
+    return sum(saldo['estoque'] for saldo in saldos['depositos'])
+
+
+def test_repeticao_com_a_mesma_chave_devolve_a_resposta_original(cliente, cabecalhos, criar_produto):
+    produto = criar_produto(estoque_atual=10)
+    chave = dict(cabecalhos, **{'Idempotency-Key': uuid.uuid4().hex})
+    saida = {'produto_id': produto['id'], 'tipo_movimentacao': 'saida', 'quantidade': 3}
+
+    primeira = cliente.post('/movimentacoes', headers=chave, json=saida)
+    repetida = cliente.post('/movimentacoes', headers=chave, json=saida)
+
+    assert primeira.status_code == repetida.status_code == 201
+    assert repetida.get_json() == primeira.get_json()
+    assert repetida.headers['Idempotent-Replayed'] == 'true'
+    assert 'Idempotent-Replayed' not in primeira.headers
+    assert _saldo_total(cliente, cabecalhos, produto['id']) == 7 # Debitado uma vez só
+
+
+def test_mesma_chave_com_outro_corpo_e_recusada(cliente, cabecalhos, criar_produto):
+    produto = criar_produto(estoque_atual=10)
+    chave = dict(cabecalhos, **{'Idempotency-Key': uuid.uuid4().hex})
+
+    primeira = cliente.post('/movimentacoes', headers=chave, json={'produto_id': produto['id'], 'tipo_movimentacao': 'saida', 'quantidade': 1})
+    outra = cliente.post('/movimentacoes', headers=chave, json={'produto_id': produto['id'], 'tipo_movimentacao': 'saida', 'quantidade': 5})
+
+    assert primeira.status_code == 201
+    assert outra.status_code == 422
+    assert _saldo_total(cliente, cabecalhos, produto['id']) == 9
+
+
+def test_codigo_duplicado_responde_409_sem_depender_da_mensagem_do_banco(cliente, cabecalhos, criar_produto):
+    produto = criar_produto()
+
+    resposta = cliente.post('/produtos', headers=cabecalhos, json={
+        'nome': 'Outro', 'codigo': produto['codigo'], 'unidade_medida': 'UN', 'preco_compra': 1, 'preco_venda': 2
+    })
+
+    assert resposta.status_code == 409
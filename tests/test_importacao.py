@@ -0,0 +1,69 @@
+import io
+import time
+import uuid
+
+from sqlalchemy import text
+
+
+def _importar(cliente, cabecalhos, linhas):
+    corpo = 'nome,codigo,unidade_medida,preco_compra,preco_venda\n' + ''.join(f'{nome},{codigo},UN,1,2\n' for nome, codigo in linhas)
+    resposta = cliente.post('/imports', headers=cabecalhos, content_type='multipart/form-data',
+                            data={'arquivo': (io.BytesIO(corpo.encode('utf-8')), 'catalogo.csv')})
+    assert resposta.status_code == 202, resposta.get_json()
+    importacao_id = resposta.get_json()['importacao']['id']
+    for _ in range(200):
+        importacao = cliente.get(f'/imports/{importacao_id}', headers=cabecalhos).get_json()
+        if importacao['status'] in ('concluida', 'falhou'):
+            return importacao
+        time.sleep(0.05)
+    raise AssertionError(f'Importação {importacao_id} não terminou: {importacao}')
+
+
+def _nomes(modulo, aplicacao, codigos):
+    with aplicacao.app_context():
+        return dict(modulo.db.session.query(modulo.Produto.codigo, modulo.Produto.nome).filter(modulo.Produto.codigo.in_(codigos)))
+
+
+def test_codigo_inserido_por_outra_transacao_e_reprocessado(modulo, aplicacao, cliente, cabecalhos, monkeypatch):
+    concorrente, novo = uuid.uuid4().hex[:20], uuid.uuid4().hex[:20]
+    insert_original = modulo.insert
+
+    def insert_depois_de_outra_transacao(tabela):
+        # Entre o SELECT dos códigos existentes e o INSERT em lote, outra requisição cadastra um dos códigos
+        if tabela is modulo.Produto and not _nomes(modulo, aplicacao, [concorrente]):
+            modulo.db.session.execute(insert_original(modulo.Produto).values(
+                nome='Cadastro concorrente', codigo=concorrente, unidade_medida='UN', preco_compra=1, preco_venda=1
+            ))
+            modulo.db.session.commit()
+        return insert_original(tabela)
+    monkeypatch.setattr(modulo, 'insert', insert_depois_de_outra_transacao)
+
+    importacao = _importar(cliente, cabecalhos, [('Da planilha', concorrente), ('Novo', novo)])
+
+    assert importacao['status'] == 'concluida', importacao
+    assert (importacao['inseridos'], importacao['atualizados'], importacao['com_erro']) == (1, 1, 0)
+    assert _nomes(modulo, aplicacao, [concorrente, novo]) == {concorrente: 'Da planilha', novo: 'Novo'}
+
+
+def test_linha_recusada_pelo_banco_nao_derruba_o_lote(modulo, aplicacao, cliente, cabecalhos):
+    aceitos = [uuid.uuid4().hex[:20] for _ in range(2)]
+    recusado = 'recusar-' + uuid.uuid4().hex[:12]
+    with aplicacao.app_context():
+        # Restrição que só o banco conhece (como um fornecedor excluído depois de o mapa ser carregado)
+        modulo.db.session.execute(text(
+            "CREATE TRIGGER recusar_produto_teste BEFORE INSERT ON produtos WHEN NEW.codigo LIKE 'recusar-%' "
+            "BEGIN SELECT RAISE(ABORT, 'produto recusado'); END"
+        ))
+        modulo.db.session.commit()
+    try:
+        importacao = _importar(cliente, cabecalhos, [('Primeiro', aceitos[0]), ('Recusado', recusado), ('Segundo', aceitos[1])])
+    finally:
+        with aplicacao.app_context():
+            modulo.db.session.execute(text('DROP TRIGGER recusar_produto_teste'))
+            modulo.db.session.commit()
+
+    assert importacao['status'] == 'concluida', importacao
+    assert (importacao['inseridos'], importacao['com_erro']) == (2, 1)
+    assert [erro['linha'] for erro in importacao['erros']] == [3]
+    assert recusado in importacao['erros'][0]['message']
+    assert set(_nomes(modulo, aplicacao, aceitos + [recusado])) == set(aceitos)
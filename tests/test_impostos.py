@@ -0,0 +1,63 @@
+import random
+from decimal import Decimal
+
+
+def _ncm():
+    return str(random.randrange(10 ** 7, 10 ** 8)) # NCM só do teste: as regras não alcançam produtos de outros testes
+
+
+def _produto(cliente, cabecalhos, produto_id):
+    return cliente.get(f'/produtos/{produto_id}', headers=cabecalhos).get_json()
+
+
+def test_regras_aplicam_em_sequencia_com_o_arredondamento_por_produto(modulo, cliente, cabecalhos, criar_produto):
+    ncm = _ncm()
+    primeiro = criar_produto(ncm=ncm, cfop='5102', preco_venda=19.99, icms_aliquota=12, ipi_aliquota=5)
+    segundo = criar_produto(ncm=ncm, cfop='6102', preco_venda=7.35, icms_aliquota=12, ipi_aliquota=5)
+
+    resposta = cliente.post('/produtos/recalcular-impostos', headers=cabecalhos, json={'regras': [
+        {'ncm': ncm, 'icms_aliquota': 18},
+        {'ncm': ncm, 'cfop': '6102', 'icms_aliquota': 7, 'ipi_aliquota': '3.25'},
+    ]})
+
+    assert resposta.status_code == 200, resposta.get_json()
+    assert [regra['produtos_atualizados'] for regra in resposta.get_json()['regras']] == [2, 1]
+    esperado = {
+        primeiro['id']: {'icms': (18, '19.99'), 'ipi': (5, '19.99')},
+        segundo['id']: {'icms': (7, '7.35'), 'ipi': ('3.25', '7.35')},
+    }
+    for produto_id, impostos in esperado.items():
+        produto = _produto(cliente, cabecalhos, produto_id)
+        for imposto, (aliquota, preco) in impostos.items():
+            valor = modulo.calculate_tax_value(Decimal(preco), Decimal(str(aliquota)))
+            assert produto[f'{imposto}_aliquota'] == float(aliquota)
+            assert produto[f'{imposto}_valor'] == float(valor)
+
+
+def test_falha_numa_regra_nao_deixa_o_catalogo_pela_metade(modulo, aplicacao, cliente, cabecalhos, criar_produto, monkeypatch):
+    ncm = _ncm()
+    produto = criar_produto(ncm=ncm, cfop='5102', preco_venda=10, icms_aliquota=12, pis_aliquota=1)
+    def impostos_no_banco():
+        # Direto do banco: o GET /produtos/<id> pode vir do cache
+        with aplicacao.app_context():
+            return modulo.db.session.get(modulo.Produto, produto['id']).to_dict()
+    antes = impostos_no_banco()
+
+    calcular = modulo.calcular_impostos_lote
+    chamadas = []
+    def falhar_na_segunda_regra(linhas, novas_aliquotas):
+        chamadas.append(novas_aliquotas)
+        if len(chamadas) == 2:
+            raise RuntimeError('falha simulada')
+        return calcular(linhas, novas_aliquotas)
+    monkeypatch.setattr(modulo, 'calcular_impostos_lote', falhar_na_segunda_regra)
+
+    resposta = cliente.post('/produtos/recalcular-impostos', headers=cabecalhos, json={'regras': [
+        {'ncm': ncm, 'icms_aliquota': 18},
+        {'cfop': '5102', 'ncm': ncm, 'pis_aliquota': 2},
+    ]})
+
+    assert resposta.status_code == 500
+    assert resposta.get_json()['produtos_atualizados'] == 0
+    assert len(chamadas) == 2
+    assert impostos_no_banco() == antes # A primeira regra também foi desfeita
@@ -0,0 +1,14 @@
+from sqlalchemy import select
+
+
+def test_consultas_quentes_nao_varrem_tabelas(modulo, aplicacao):
+    with aplicacao.app_context():
+        assert modulo._consultas_quentes()
+        assert modulo.verificar_planos_consultas() == {}
+
+
+def test_verificacao_aponta_varredura_completa(modulo, aplicacao):
+    # Sem índice em descricao: o verificador tem que reprovar a consulta
+    with aplicacao.app_context(), modulo.db.engine.connect() as conexao:
+        consulta = select(modulo.Produto).where(modulo.Produto.descricao == 'x').order_by(modulo.Produto.id).limit(20)
+        assert modulo._problemas_plano(conexao, consulta)
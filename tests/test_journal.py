@@ -0,0 +1,101 @@
+import json
+import os
+import signal
+import subprocess
+import sys
+
+ESCRITOR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'journal_escritor.py')
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _escrever_e_matar(caminho, movimentacoes, durante=None):
+    # Sequências confirmadas pelo escritor, que morre com SIGKILL no meio da aplicação
+    escritor = subprocess.Popen(
+        [sys.executable, ESCRITOR, str(caminho), json.dumps(movimentacoes)],
+        cwd=RAIZ, env=dict(os.environ, PYTHONPATH=RAIZ), stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True
+    )
+    confirmadas = [int(escritor.stdout.readline()) for _ in movimentacoes]
+    if durante is not None:
+        durante()
+    escritor.stdin.write('\n')
+    escritor.stdin.flush()
+    assert escritor.wait(60) == -signal.SIGKILL
+    return confirmadas
+
+
+def _reaplicar(modulo, aplicacao, caminho):
+    journal = modulo.JournalMovimentacoes(aplicacao, str(caminho))
+    assert journal.aguardar_aplicacao(30)
+    journal._arquivo.close() # Libera o flock do arquivo
+    return journal
+
+
+def _movimentacoes(modulo, produto_id):
+    return sorted(
+        (observacao, tipo, quantidade) for observacao, tipo, quantidade in modulo.db.session.query(
+            modulo.Movimentacao.observacao, modulo.Movimentacao.tipo_movimentacao, modulo.Movimentacao.quantidade
+        ).filter(modulo.Movimentacao.produto_id == produto_id, modulo.Movimentacao.observacao.like('journal-%'))
+    )
+
+
+def _saldo(modulo, produto_id):
+    return modulo.db.session.query(modulo.EstoqueDeposito.estoque).filter_by(
+        produto_id=produto_id, deposito_id=modulo.DEPOSITO_PADRAO_ID
+    ).scalar()
+
+
+def test_queda_do_escritor_nao_perde_nem_duplica(modulo, aplicacao, criar_produto, tmp_path):
+    produto = criar_produto(estoque_atual=100)
+    caminho = tmp_path / 'queda.journal'
+    movimentacoes = [
+        {'produto_id': produto['id'], 'deposito_id': modulo.DEPOSITO_PADRAO_ID, 'tipo_movimentacao': 'saida',
+         'quantidade': 1, 'observacao': f'journal-{numero}'}
+        for numero in range(10)
+    ]
+
+    confirmadas = _escrever_e_matar(caminho, movimentacoes)
+
+    assert confirmadas == sorted(set(confirmadas))
+    with aplicacao.app_context():
+        aplicadas_na_queda = len(_movimentacoes(modulo, produto['id']))
+        assert 1 <= aplicadas_na_queda < len(movimentacoes)
+
+        _reaplicar(modulo, aplicacao, caminho)
+
+        assert _movimentacoes(modulo, produto['id']) == sorted(('journal-%d' % numero, 'saida', 1) for numero in range(10))
+        assert _saldo(modulo, produto['id']) == 90
+        assert modulo.db.session.get(modulo.JournalCheckpoint, caminho.name).ultima_sequencia == confirmadas[-1]
+    assert caminho.read_bytes() == b'' # Tudo aplicado; o registro cortado foi descartado
+
+
+def test_queda_depois_de_rejeitar_nao_reaplica(modulo, aplicacao, criar_produto, tmp_path):
+    produto = criar_produto(estoque_atual=2)
+    caminho = tmp_path / 'rejeicao.journal'
+    movimentacoes = [
+        {'produto_id': produto['id'], 'deposito_id': modulo.DEPOSITO_PADRAO_ID, 'tipo_movimentacao': tipo,
+         'quantidade': quantidade, 'observacao': f'journal-{numero}'}
+        for numero, (tipo, quantidade) in enumerate([('saida', 1), ('saida', 1), ('entrada', 3)])
+    ]
+
+    def zerar_por_fora():
+        # Mudança fora do journal (SQL manual) depois do 202: a primeira saída deixa de caber
+        with aplicacao.app_context():
+            modulo.db.session.execute(
+                modulo.update(modulo.EstoqueDeposito).where(modulo.EstoqueDeposito.produto_id == produto['id']).values(estoque=0)
+            )
+            modulo.db.session.commit()
+
+    confirmadas = _escrever_e_matar(caminho, movimentacoes, durante=zerar_por_fora)
+
+    with aplicacao.app_context():
+        # O grupo (as duas saídas) falhou junto; a primeira foi rejeitada sozinha e o processo caiu em seguida
+        rejeicoes = modulo.JournalRejeicao.query.filter_by(nome=caminho.name).all()
+        assert [rejeicao.sequencia for rejeicao in rejeicoes] == [confirmadas[0]]
+        assert _movimentacoes(modulo, produto['id']) == []
+
+        _reaplicar(modulo, aplicacao, caminho)
+
+        assert modulo.JournalRejeicao.query.filter_by(nome=caminho.name).count() == 1
+        assert _movimentacoes(modulo, produto['id']) == [('journal-1', 'saida', 1), ('journal-2', 'entrada', 3)]
+        assert _saldo(modulo, produto['id']) == 2
+    assert caminho.read_bytes() == b''
@@ -0,0 +1,66 @@
+import sqlite3
+
+from sqlalchemy import inspect
+
+# Esquema criado pelo db.create_all() da versão anterior às migrações (tabelas sem índices nem colunas novas)
+ESQUEMA_ANTERIOR = """
+CREATE TABLE fornecedores (
+    id INTEGER NOT NULL, nome VARCHAR(255) NOT NULL, cnpj VARCHAR(18), email VARCHAR(255), telefone VARCHAR(20),
+    endereco TEXT, PRIMARY KEY (id), UNIQUE (nome), UNIQUE (cnpj)
+);
+CREATE TABLE clientes (
+    id INTEGER NOT NULL, nome VARCHAR(255) NOT NULL, cpf VARCHAR(14), email VARCHAR(255), telefone VARCHAR(20),
+    endereco TEXT, PRIMARY KEY (id), UNIQUE (cpf)
+);
+CREATE TABLE users (
+    id INTEGER NOT NULL, username VARCHAR(80) NOT NULL, email VARCHAR(120) NOT NULL, password_hash VARCHAR(128) NOT NULL,
+    PRIMARY KEY (id), UNIQUE (username), UNIQUE (email)
+);
+CREATE TABLE produtos (
+    id INTEGER NOT NULL, nome VARCHAR(255) NOT NULL, codigo VARCHAR(100) NOT NULL, descricao TEXT,
+    unidade_medida VARCHAR(50) NOT NULL, estoque_atual INTEGER NOT NULL, estoque_minimo INTEGER NOT NULL,
+    localizacao VARCHAR(255), preco_compra NUMERIC(10, 2) NOT NULL, preco_venda NUMERIC(10, 2) NOT NULL,
+    ncm VARCHAR(8), cst_csosn VARCHAR(4), cfop VARCHAR(4), origem_mercadoria VARCHAR(1),
+    icms_aliquota NUMERIC(5, 2), icms_valor NUMERIC(10, 2), ipi_aliquota NUMERIC(5, 2), ipi_valor NUMERIC(10, 2),
+    pis_aliquota NUMERIC(5, 2), pis_valor NUMERIC(10, 2), cofins_aliquota NUMERIC(5, 2), cofins_valor NUMERIC(10, 2),
+    info_adicionais_nf TEXT, fornecedor_id INTEGER, PRIMARY KEY (id), UNIQUE (codigo),
+    FOREIGN KEY(fornecedor_id) REFERENCES fornecedores (id)
+);
+CREATE TABLE movimentacoes (
+    id INTEGER NOT NULL, produto_id INTEGER NOT NULL, tipo_movimentacao VARCHAR(10) NOT NULL, quantidade INTEGER NOT NULL,
+    data_hora DATETIME NOT NULL, observacao TEXT, numero_nota_fiscal VARCHAR(100), cliente_id INTEGER, PRIMARY KEY (id),
+    FOREIGN KEY(produto_id) REFERENCES produtos (id), FOREIGN KEY(cliente_id) REFERENCES clientes (id)
+);
+INSERT INTO produtos (id, nome, codigo, unidade_medida, estoque_atual, estoque_minimo, preco_compra, preco_venda)
+VALUES (1, 'Antigo', 'ANTIGO-1', 'UN', 7, 2, 1, 2);
+INSERT INTO movimentacoes (id, produto_id, tipo_movimentacao, quantidade, data_hora)
+VALUES (1, 1, 'entrada', 7, '2024-01-02 10:00:00');
+"""
+
+
+def _esquema(engine):
+    inspetor = inspect(engine)
+    return {
+        tabela: (
+            {coluna['name'] for coluna in inspetor.get_columns(tabela)},
+            {indice['name'] for indice in inspetor.get_indexes(tabela)}
+        )
+        for tabela in inspetor.get_table_names()
+    }
+
+
+def test_migracoes_atualizam_banco_do_esquema_anterior(modulo, aplicacao, tmp_path):
+    arquivo = tmp_path / 'anterior.db'
+    with sqlite3.connect(arquivo) as conexao:
+        conexao.executescript(ESQUEMA_ANTERIOR)
+
+    anterior = modulo.create_app({'TESTING': True, 'SQLALCHEMY_DATABASE_URI': f'sqlite:///{arquivo}'})
+    with anterior.app_context():
+        modulo.aplicar_migracoes()
+        atualizado = _esquema(modulo.db.engine)
+        saldos = modulo.db.session.query(modulo.EstoqueDeposito.deposito_id, modulo.EstoqueDeposito.estoque).filter_by(produto_id=1).all()
+    with aplicacao.app_context():
+        novo = _esquema(modulo.db.engine)
+
+    assert atualizado == novo
+    assert saldos == [(modulo.DEPOSITO_PADRAO_ID, 7)]
@@ -0,0 +1,163 @@
+from concurrent.futures import ThreadPoolExecutor
+
+
+def _lancar(cliente, cabecalhos, produto_id, quantidade):
+    for _ in range(quantidade):
+        resposta = cliente.post('/movimentacoes', headers=cabecalhos, json={
+            'produto_id': produto_id, 'tipo_movimentacao': 'saida', 'quantidade': 1
+        })
+        assert resposta.status_code == 201
+
+
+def _consultas(modulo, aplicacao, cliente, cabecalhos, url):
+    with aplicacao.app_context():
+        with modulo.contar_consultas() as consultas:
+            resposta = cliente.get(url, headers=cabecalhos)
+    assert resposta.status_code == 200
+    return len(consultas)
+
+
+def test_listagens_de_movimentacoes_sem_consulta_por_linha(modulo, aplicacao, cliente, cabecalhos, criar_produto):
+    produto = criar_produto(estoque_atual=1000)
+    urls = [
+        f"/movimentacoes?produto_id={produto['id']}&per_page=100&fields=id,quantidade,produto_nome,produto_codigo,cliente_nome",
+        f"/produtos/{produto['id']}/movimentacoes?per_page=100",
+    ]
+
+    _lancar(cliente, cabecalhos, produto['id'], 5)
+    for url in urls:
+        _consultas(modulo, aplicacao, cliente, cabecalhos, url) # Aquece caches (usuário, limite do arquivo)
+    poucas = [_consultas(modulo, aplicacao, cliente, cabecalhos, url) for url in urls]
+
+    _lancar(cliente, cabecalhos, produto['id'], 60)
+    muitas = [_consultas(modulo, aplicacao, cliente, cabecalhos, url) for url in urls]
+
+    assert poucas == muitas
+
+
+def test_saidas_concorrentes_respeitam_o_estoque(modulo, aplicacao, cliente, cabecalhos, criar_produto):
+    produto = criar_produto(estoque_atual=60)
+
+    def sair(_):
+        return aplicacao.test_client().post('/movimentacoes', headers=cabecalhos, json={
+            'produto_id': produto['id'], 'tipo_movimentacao': 'saida', 'quantidade': 1
+        }).status_code
+
+    with ThreadPoolExecutor(16) as executor:
+        status = list(executor.map(sair, range(120)))
+
+    assert status.count(201) == 60
+    assert status.count(400) == 60
+    with aplicacao.app_context():
+        modulo.consolidar_estoque()
+    assert cliente.get(f"/produtos/{produto['id']}", headers=cabecalhos).get_json()['estoque_atual'] == 0
+    saldos = cliente.get(f"/produtos/{produto['id']}/depositos", headers=cabecalhos).get_json()
+    assert sum(saldo['estoque'] for saldo in saldos['depositos']) == 0
+    movimentacoes = cliente.get(f"/produtos/{produto['id']}/movimentacoes", headers=cabecalhos).get_json()
+    assert movimentacoes['total_items'] == 60
+
+
+def test_cursor_percorre_todas_as_movimentacoes_sem_repetir(modulo, aplicacao, cliente, cabecalhos, criar_produto):
+    produto = criar_produto(estoque_atual=100)
+    _lancar(cliente, cabecalhos, produto['id'], 10)
+    with aplicacao.app_context():
+        # Empates em data_hora: a ordem cai para o id
+        modulo.db.session.execute(
+            modulo.update(modulo.Movimentacao).where(modulo.Movimentacao.produto_id == produto['id'])
+            .values(data_hora=modulo.datetime(2026, 1, 1, 12))
+        )
+        modulo.db.session.commit()
+    _lancar(cliente, cabecalhos, produto['id'], 13)
+
+    vistos, cursor = [], ''
+    while cursor is not None:
+        pagina = cliente.get(
+            f"/movimentacoes?produto_id={produto['id']}&cursor={cursor}&limit=4", headers=cabecalhos
+        ).get_json()
+        vistos += [item['id'] for item in pagina['items']]
+        cursor = pagina['next_cursor']
+
+    offset = cliente.get(f"/movimentacoes?produto_id={produto['id']}&per_page=100", headers=cabecalhos).get_json()
+    assert vistos == [item['id'] for item in offset['items']]
+    assert len(set(vistos)) == 23
+
+
+def test_consolidacao_aplica_movimentacoes_de_varios_depositos(modulo, aplicacao, cliente, cabecalhos, criar_produto):
+    produto = criar_produto(estoque_atual=10, estoque_minimo=8)
+    deposito = cliente.post('/depositos', headers=cabecalhos, json={'nome': f"Depósito {produto['codigo']}"}).get_json()['deposito']
+    assert cliente.post('/transferencias', headers=cabecalhos, json={
+        'produto_id': produto['id'], 'deposito_origem_id': modulo.DEPOSITO_PADRAO_ID,
+        'deposito_destino_id': deposito['id'], 'quantidade': 5
+    }).status_code == 201
+    with aplicacao.app_context():
+        modulo.consolidar_estoque()
+        antes = modulo.reconciliar_resumo_dashboard().to_dict()
+
+    for deposito_id in (modulo.DEPOSITO_PADRAO_ID, deposito['id']):
+        assert cliente.post('/movimentacoes', headers=cabecalhos, json={
+            'produto_id': produto['id'], 'tipo_movimentacao': 'saida', 'quantidade': 3, 'deposito_id': deposito_id
+        }).status_code == 201
+
+    # Depósitos já debitados; o agregado espera a consolidação
+    assert cliente.get(f"/produtos/{produto['id']}/depositos", headers=cabecalhos).get_json()['estoque_atual'] == 4
+    with aplicacao.app_context():
+        assert modulo.db.session.get(modulo.Produto, produto['id']).estoque_atual == 10
+        # A reconciliação no meio do caminho não conta as saídas pendentes duas vezes
+        modulo.reconciliar_resumo_dashboard()
+        assert modulo.consolidar_estoque() == 2
+        depois = modulo.db.session.get(modulo.ResumoDashboard, 1).to_dict()
+        rollup = modulo.db.session.query(
+            modulo.MovimentacaoRollup.saidas, modulo.MovimentacaoRollup.quantidade_saida, modulo.MovimentacaoRollup.saldo_final
+        ).filter_by(dimensao='produto', dimensao_id=produto['id'], granularidade='dia').one()
+        reconciliado = modulo.reconciliar_resumo_dashboard().to_dict()
+
+    assert cliente.get(f"/produtos/{produto['id']}", headers=cabecalhos).get_json()['estoque_atual'] == 4
+    assert depois['total_saidas'] - antes['total_saidas'] == 6
+    assert depois['produtos_estoque_baixo'] - antes['produtos_estoque_baixo'] == 1
+    assert tuple(rollup) == (2, 6, 4)
+    assert reconciliado == depois
+
+
+def test_ajuste_de_estoque_concorrente_com_saidas(modulo, aplicacao, cliente, cabecalhos, criar_produto):
+    produto = criar_produto(estoque_atual=40, estoque_minimo=5)
+
+    def operar(numero):
+        cliente_thread = aplicacao.test_client()
+        if numero % 10 == 0:
+            return 'ajuste', cliente_thread.put(f"/produtos/{produto['id']}", headers=cabecalhos, json={
+                'estoque_atual': 40, 'estoque_minimo': 5 + numero % 3
+            }).status_code
+        return 'saida', cliente_thread.post('/movimentacoes', headers=cabecalhos, json={
+            'produto_id': produto['id'], 'tipo_movimentacao': 'saida', 'quantidade': 1
+        }).status_code
+
+    with ThreadPoolExecutor(8) as executor:
+        resultados = list(executor.map(operar, range(60)))
+
+    assert all(status == 200 for tipo, status in resultados if tipo == 'ajuste')
+    assert all(status in (201, 400) for tipo, status in resultados if tipo == 'saida')
+    with aplicacao.app_context():
+        modulo.consolidar_estoque()
+    saldos = cliente.get(f"/produtos/{produto['id']}/depositos", headers=cabecalhos).get_json()
+    atual = cliente.get(f"/produtos/{produto['id']}", headers=cabecalhos).get_json()['estoque_atual']
+    assert atual == sum(saldo['estoque'] for saldo in saldos['depositos']) >= 0
+
+
+def test_lote_recusa_ids_que_nao_sao_inteiros(modulo, aplicacao, cliente, cabecalhos, criar_produto):
+    produto = criar_produto(estoque_atual=10)
+    linhas = [
+        {'produto_id': [produto['id']], 'tipo_movimentacao': 'entrada', 'quantidade': 1},
+        {'produto_id': {'id': produto['id']}, 'tipo_movimentacao': 'entrada', 'quantidade': 1},
+        {'produto_id': True, 'tipo_movimentacao': 'entrada', 'quantidade': 1},
+        {'produto_id': produto['id'], 'tipo_movimentacao': 'saida', 'quantidade': 1, 'cliente_id': [1]},
+        {'produto_id': produto['id'], 'tipo_movimentacao': 'saida', 'quantidade': 1, 'cliente_id': {'id': 1}},
+        {'produto_id': produto['id'], 'tipo_movimentacao': 'entrada', 'quantidade': 2},
+    ]
+
+    resposta = cliente.post('/movimentacoes/lote', headers=cabecalhos, json={'movimentacoes': linhas})
+
+    assert resposta.status_code == 200, resposta.get_json()
+    resultados = resposta.get_json()['resultados']
+    assert [r['message'] for r in resultados[:3]] == ["Produto inválido."] * 3
+    assert [r['message'] for r in resultados[3:5]] == ["Cliente inválido."] * 2
+    assert resultados[5]['status'] == 'ok'
@@ -0,0 +1,53 @@
+import sqlite3
+import time
+import uuid
+
+import pytest
+
+
+@pytest.fixture
+def replicada(modulo, aplicacao, cabecalhos, tmp_path):
+    # Réplica = cópia do primário feita antes das escritas do teste; nada replica depois disso
+    primario = aplicacao.config['SQLALCHEMY_DATABASE_URI'].removeprefix('sqlite:///')
+    replica = tmp_path / 'replica.db'
+    with sqlite3.connect(primario) as origem, sqlite3.connect(replica) as destino:
+        origem.backup(destino)
+    aplicacao_replicada = modulo.create_app({
+        'TESTING': True,
+        'SQLALCHEMY_BINDS': {'replica_0': f'sqlite:///{replica}'},
+        'DB_REPLICAS': ['replica_0'],
+        'REPLICA_ATRASO_MAX_SEGUNDOS': 0.5,
+    })
+    return aplicacao_replicada.test_client(), replica
+
+
+def _listar(cliente, cabecalhos, unidade, **extras):
+    resposta = cliente.get(f'/produtos?unidade_medida={unidade}', headers=dict(cabecalhos, **extras))
+    assert resposta.status_code == 200
+    return [produto['codigo'] for produto in resposta.get_json()['items']]
+
+
+def _produtos(replica):
+    with sqlite3.connect(replica) as conexao:
+        return conexao.execute('SELECT COUNT(*) FROM produtos').fetchone()[0]
+
+
+def test_leituras_vao_a_replica_exceto_logo_apos_escrever(replicada, cabecalhos):
+    cliente, replica = replicada
+    produtos_na_replica = _produtos(replica)
+    unidade, codigo = uuid.uuid4().hex[:12], uuid.uuid4().hex[:20]
+
+    resposta = cliente.post('/produtos', headers=cabecalhos, json={
+        'nome': 'Produto replicado', 'codigo': codigo, 'unidade_medida': unidade, 'preco_compra': 1, 'preco_venda': 2
+    })
+    assert resposta.status_code == 201, resposta.get_json()
+
+    # Read-your-writes: logo após a escrita o mesmo usuário lê do primário
+    assert _listar(cliente, cabecalhos, unidade) == [codigo]
+
+    # Passado o atraso máximo, a leitura vai à réplica, que não tem o produto
+    time.sleep(0.6)
+    assert _listar(cliente, cabecalhos, unidade) == []
+    assert _listar(cliente, cabecalhos, unidade, **{'X-Ler-Primario': 'true'}) == [codigo]
+
+    assert _produtos(replica) == produtos_na_replica